@@ -57,20 +57,15 @@ def debug_inpainting(video_path, bbox_shift, extra_margin=10, parsing_mode="jaw"
     os.makedirs(args.result_dir, exist_ok=True)
     
     # Read first frame
-    if get_file_type(video_path) == "video":
-        reader = imageio.get_reader(video_path)
-        first_frame = reader.get_data(0)
-        reader.close()
-    else:
-        first_frame = cv2.imread(video_path)
-        first_frame = cv2.cvtColor(first_frame, cv2.COLOR_BGR2RGB)
+    with open_frame_source(video_path) as source:
+        first_frame = source[0]
     
     # Save first frame
     debug_frame_path = os.path.join(args.result_dir, "debug_frame.png")
-    cv2.imwrite(debug_frame_path, cv2.cvtColor(first_frame, cv2.COLOR_RGB2BGR))
+    cv2.imwrite(debug_frame_path, first_frame)
     
     # Get face coordinates
-    coord_list, frame_list = get_landmark_and_bbox([debug_frame_path], bbox_shift)
+    coord_list, frame_list = get_landmark_and_bbox([first_frame], bbox_shift)
     bbox = coord_list[0]
     frame = frame_list[0]
     
@@ -165,11 +160,15 @@ def download_model():
 
 download_model()  # for huggingface deployment.
 
-from musetalk.utils.blending import get_image
+from musetalk.utils.blending import get_image, BlendingMaskCache, FrameCompositor
 from musetalk.utils.face_parsing import FaceParsing
 from musetalk.utils.audio_processor import AudioProcessor
+from musetalk.utils.frame_sink import open_frame_sink
+from musetalk.utils.frame_source import FrameWindow, open_frame_source
 from musetalk.utils.utils import get_file_type, get_video_fps, datagen, load_all_model
-from musetalk.utils.preprocessing import get_landmark_and_bbox, read_imgs, coord_placeholder, get_bbox_range
+from musetalk.utils.landmark_cache import LandmarkCache
+from musetalk.utils.preprocessing import (get_landmark_and_bbox, get_landmark_and_bbox_cached, read_imgs,
+                                          coord_placeholder, bbox_range_text)
 
 
 def fast_check_ffmpeg():
@@ -181,64 +180,7 @@ def fast_check_ffmpeg():
 
 
 @torch.no_grad()
-def inference(audio_path, video_path, bbox_shift, extra_margin=10, parsing_mode="jaw", 
-              left_cheek_width=90, right_cheek_width=90, progress=gr.Progress(track_tqdm=True)):
-    # Set default parameters, aligned with inference.py
-    args_dict = {
-        "result_dir": './results/output', 
-        "fps": 25, 
-        "batch_size": 8, 
-        "output_vid_name": '', 
-        "use_saved_coord": False,
-        "audio_padding_length_left": 2,
-        "audio_padding_length_right": 2,
-        "version": "v15",  # Fixed use v15 version
-        "extra_margin": extra_margin,
-        "parsing_mode": parsing_mode,
-        "left_cheek_width": left_cheek_width,
-        "right_cheek_width": right_cheek_width
-    }
-    args = Namespace(**args_dict)
-
-    # Check ffmpeg
-    if not fast_check_ffmpeg():
-        print("Warning: Unable to find ffmpeg, please ensure ffmpeg is properly installed")
-
-    input_basename = os.path.basename(video_path).split('.')[0]
-    audio_basename = os.path.basename(audio_path).split('.')[0]
-    output_basename = f"{input_basename}_{audio_basename}"
-    
-    # Create temporary directory
-    temp_dir = os.path.join(args.result_dir, f"{args.version}")
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    # Set result save path
-    result_img_save_path = os.path.join(temp_dir, output_basename)
-    crop_coord_save_path = os.path.join(args.result_dir, "../", input_basename+".pkl")
-    os.makedirs(result_img_save_path, exist_ok=True)
-
-    if args.output_vid_name == "":
-        output_vid_name = os.path.join(temp_dir, output_basename+".mp4")
-    else:
-        output_vid_name = os.path.join(temp_dir, args.output_vid_name)
-        
-    ############################################## extract frames from source video ##############################################
-    if get_file_type(video_path) == "video":
-        save_dir_full = os.path.join(temp_dir, input_basename)
-        os.makedirs(save_dir_full, exist_ok=True)
-        # Read video
-        reader = imageio.get_reader(video_path)
-
-        # Save images
-        for i, im in enumerate(reader):
-            imageio.imwrite(f"{save_dir_full}/{i:08d}.png", im)
-        input_img_list = sorted(glob.glob(os.path.join(save_dir_full, '*.[jpJP][pnPN]*[gG]')))
-        fps = get_video_fps(video_path)
-    else: # input img folder
-        input_img_list = glob.glob(os.path.join(video_path, '*.[jpJP][pnPN]*[gG]'))
-        input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-        fps = args.fps
-        
+def render_talking_video(source, fps, video_path, audio_path, bbox_shift, output_vid_name, args):
     ############################################## extract audio feature ##############################################
     # Extract audio features
     whisper_input_features, librosa_length = audio_processor.get_audio_feature(audio_path)
@@ -254,17 +196,11 @@ def inference(audio_path, video_path, bbox_shift, extra_margin=10, parsing_mode=
     )
         
     ############################################## preprocess input image  ##############################################
-    if os.path.exists(crop_coord_save_path) and args.use_saved_coord:
-        print("using extracted coordinates")
-        with open(crop_coord_save_path,'rb') as f:
-            coord_list = pickle.load(f)
-        frame_list = read_imgs(input_img_list)
-    else:
-        print("extracting landmarks...time consuming")
-        coord_list, frame_list = get_landmark_and_bbox(input_img_list, bbox_shift)
-        with open(crop_coord_save_path, 'wb') as f:
-            pickle.dump(coord_list, f)
-    bbox_shift_text = get_bbox_range(input_img_list, bbox_shift)
+    # known videos are served from the landmark cache
+    coord_list, _, raw = get_landmark_and_bbox_cached(source, bbox_shift, source_path=video_path,
+                                                      cache=landmark_cache, return_raw=True)
+    # the detected frames, the container's frame count is only an estimate
+    num_source_frames = len(coord_list)
     
     # Initialize face parser
     fp = FaceParsing(
@@ -272,23 +208,30 @@ def inference(audio_path, video_path, bbox_shift, extra_margin=10, parsing_mode=
         right_cheek_width=args.right_cheek_width
     )
     
-    i = 0
-    input_latent_list = []
-    for bbox, frame in zip(coord_list, frame_list):
-        if bbox == coord_placeholder:
-            continue
-        x1, y1, x2, y2 = bbox
-        y2 = y2 + args.extra_margin
-        y2 = min(y2, frame.shape[0])
-        crop_frame = frame[y1:y2, x1:x2]
-        crop_frame = cv2.resize(crop_frame,(256,256),interpolation = cv2.INTER_LANCZOS4)
-        latents = vae.get_latents_for_unet(crop_frame)
-        input_latent_list.append(latents)
+    def face_crops():
+        for bbox, frame in zip(coord_list, source):
+            if bbox == coord_placeholder:
+                continue
+            x1, y1, x2, y2 = bbox
+            y2 = y2 + args.extra_margin
+            y2 = min(y2, frame.shape[0])
+            crop_frame = frame[y1:y2, x1:x2]
+            yield cv2.resize(crop_frame,(256,256),interpolation = cv2.INTER_LANCZOS4)
+    input_latents = vae.get_latents_for_unet_batch(face_crops())
 
     # to smooth the first and the last frame
-    frame_list_cycle = frame_list + frame_list[::-1]
-    coord_list_cycle = coord_list + coord_list[::-1]
-    input_latent_list_cycle = input_latent_list + input_latent_list[::-1]
+    input_latent_list_cycle = torch.cat([input_latents, input_latents.flip(0)], dim=0)
+
+    def source_index(i):
+        # position in frame_list + frame_list[::-1]
+        i = i % (2 * num_source_frames)
+        return i if i < num_source_frames else 2 * num_source_frames - 1 - i
+
+    def blend_box(j, frame):
+        x1, y1, x2, y2 = coord_list[j]
+        y2 = y2 + args.extra_margin
+        y2 = min(y2, frame.shape[0])
+        return [x1, y1, x2, y2]
     
     ############################################## inference batch by batch ##############################################
     print("start inference")
@@ -301,87 +244,90 @@ def inference(audio_path, video_path, bbox_shift, extra_margin=10, parsing_mode=
         delay_frame=0,
         device=device,
     )
-    res_frame_list = []
-    for i, (whisper_batch,latent_batch) in enumerate(tqdm(gen,total=int(np.ceil(float(video_num)/batch_size)))):
-        audio_feature_batch = pe(whisper_batch)
-        # Ensure latent_batch is consistent with model weight type
-        latent_batch = latent_batch.to(dtype=weight_dtype)
-        
-        pred_latents = unet.model(latent_batch, timesteps, encoder_hidden_states=audio_feature_batch).sample
-        recon = vae.decode_latents(pred_latents)
-        for res_frame in recon:
-            res_frame_list.append(res_frame)
-            
-    ############################################## pad to full image ##############################################
-    print("pad talking image to original video")
-    for i, res_frame in enumerate(tqdm(res_frame_list)):
-        bbox = coord_list_cycle[i%(len(coord_list_cycle))]
-        ori_frame = copy.deepcopy(frame_list_cycle[i%(len(frame_list_cycle))])
-        x1, y1, x2, y2 = bbox
-        y2 = y2 + args.extra_margin
-        y2 = min(y2, frame.shape[0])
-        try:
-            res_frame = cv2.resize(res_frame.astype(np.uint8),(x2-x1,y2-y1))
-        except:
-            continue
-        
-        # Use v15 version blending
-        combine_frame = get_image(ori_frame, res_frame, [x1, y1, x2, y2], mode=args.parsing_mode, fp=fp)
+    # every decoded batch is padded to the full image and streamed into one
+    # ffmpeg process that also muxes the driving audio
+    sink = open_frame_sink(output_vid_name, fps=fps, audio_path=audio_path, audio_codec='aac')
+    frame_list = FrameWindow(source, size=max(32, batch_size))
+    mask_cache = BlendingMaskCache(fp, mode=args.parsing_mode, max_bytes=256 * 1024 * 1024)
+    compositor = FrameCompositor()
+    try:
+        for i, (whisper_batch,latent_batch) in enumerate(tqdm(gen,total=int(np.ceil(float(video_num)/batch_size)))):
+            audio_feature_batch = pe(whisper_batch)
+            # Ensure latent_batch is consistent with model weight type
+            latent_batch = latent_batch.to(dtype=weight_dtype)
             
-        cv2.imwrite(f"{result_img_save_path}/{str(i).zfill(8)}.png",combine_frame)
-        
-    # Frame rate
-    fps = 25
-    # Output video path
-    output_video = 'temp.mp4'
-
-    # Read images
-    def is_valid_image(file):
-        pattern = re.compile(r'\d{8}\.png')
-        return pattern.match(file)
-
-    images = []
-    files = [file for file in os.listdir(result_img_save_path) if is_valid_image(file)]
-    files.sort(key=lambda x: int(x.split('.')[0]))
-
-    for file in files:
-        filename = os.path.join(result_img_save_path, file)
-        images.append(imageio.imread(filename))
-        
-
-    # Save video
-    imageio.mimwrite(output_video, images, 'FFMPEG', fps=fps, codec='libx264', pixelformat='yuv420p')
-
-    input_video = './temp.mp4'
-    # Check if the input_video and audio_path exist
-    if not os.path.exists(input_video):
-        raise FileNotFoundError(f"Input video file not found: {input_video}")
-    if not os.path.exists(audio_path):
-        raise FileNotFoundError(f"Audio file not found: {audio_path}")
-    
-    # Read video
-    reader = imageio.get_reader(input_video)
-    fps = reader.get_meta_data()['fps']  # Get original video frame rate
-    reader.close() # Otherwise, error on win11: PermissionError: [WinError 32] Another program is using this file, process cannot access. : 'temp.mp4'
-    # Store frames in list
-    frames = images
-    
-    print(len(frames))
-
-    # Load the video
-    video_clip = VideoFileClip(input_video)
+            pred_latents = unet.model(latent_batch, timesteps, encoder_hidden_states=audio_feature_batch).sample
+            recon = vae.decode_latents(pred_latents)
+
+            ############################################## pad to full image ##############################################
+            # parse the source frames of this batch that are not cached yet in one call
+            items = []
+            for k in range(len(recon)):
+                j = source_index(i * batch_size + k)
+                if coord_list[j] != coord_placeholder:
+                    items.append((j, frame_list[j], blend_box(j, frame_list[j])))
+            mask_cache.prepare(items)
+
+            for k, res_frame in enumerate(recon):
+                j = source_index(i * batch_size + k)
+                ori_frame = frame_list[j]
+                x1, y1, x2, y2 = blend_box(j, ori_frame)
+                try:
+                    res_frame = cv2.resize(res_frame.astype(np.uint8),(x2-x1,y2-y1))
+                except:
+                    continue
+                
+                # Use v15 version blending with the cached mask of this source frame
+                mask_array, crop_box = mask_cache.get(j, ori_frame, [x1, y1, x2, y2])
+                combine_frame = compositor(ori_frame, res_frame, [x1, y1, x2, y2], mask_array, crop_box)
+                sink.write(combine_frame)
+    finally:
+        sink.close()
+    # the adjustment range comes from the same detections, no second pass over the video
+    return bbox_range_text(raw, bbox_shift)
 
-    # Load the audio
-    audio_clip = AudioFileClip(audio_path)
 
-    # Set the audio to the video
-    video_clip = video_clip.set_audio(audio_clip)
+@torch.no_grad()
+def inference(audio_path, video_path, bbox_shift, extra_margin=10, parsing_mode="jaw", 
+              left_cheek_width=90, right_cheek_width=90, progress=gr.Progress(track_tqdm=True)):
+    # Set default parameters, aligned with inference.py
+    args_dict = {
+        "result_dir": './results/output', 
+        "fps": 25, 
+        "batch_size": 8, 
+        "output_vid_name": '', 
+        "audio_padding_length_left": 2,
+        "audio_padding_length_right": 2,
+        "version": "v15",  # Fixed use v15 version
+        "extra_margin": extra_margin,
+        "parsing_mode": parsing_mode,
+        "left_cheek_width": left_cheek_width,
+        "right_cheek_width": right_cheek_width
+    }
+    args = Namespace(**args_dict)
 
-    # Write the output video
-    video_clip.write_videofile(output_vid_name, codec='libx264', audio_codec='aac',fps=25)
+    # Check ffmpeg
+    if not fast_check_ffmpeg():
+        print("Warning: Unable to find ffmpeg, please ensure ffmpeg is properly installed")
 
-    os.remove("temp.mp4")
-    #shutil.rmtree(result_img_save_path)
+    input_basename = os.path.basename(video_path).split('.')[0]
+    audio_basename = os.path.basename(audio_path).split('.')[0]
+    output_basename = f"{input_basename}_{audio_basename}"
+    
+    # Create temporary directory
+    temp_dir = os.path.join(args.result_dir, f"{args.version}")
+    os.makedirs(temp_dir, exist_ok=True)
+    
+    if args.output_vid_name == "":
+        output_vid_name = os.path.join(temp_dir, output_basename+".mp4")
+    else:
+        output_vid_name = os.path.join(temp_dir, args.output_vid_name)
+        
+    ############################################## extract frames from source video ##############################################
+    # frames are decoded on demand, only a window of them is held in memory
+    with open_frame_source(video_path, fps=args.fps) as source:
+        fps = source.fps
+        bbox_shift_text = render_talking_video(source, fps, video_path, audio_path, bbox_shift, output_vid_name, args)
     print(f"result is save to {output_vid_name}")
     return output_vid_name,bbox_shift_text
 
@@ -424,6 +370,7 @@ timesteps = torch.tensor([0], device=device)
 
 # Initialize audio processor and Whisper model
 audio_processor = AudioProcessor(feature_extractor_path="./models/whisper")
+landmark_cache = LandmarkCache()
 whisper = WhisperModel.from_pretrained("./models/whisper")
 whisper = whisper.to(device=device, dtype=weight_dtype).eval()
 whisper.requires_grad_(False)
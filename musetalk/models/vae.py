@@ -121,6 +121,47 @@ class VAE():
         latent_model_input = torch.cat([masked_latents, ref_latents], dim=1)
         return latent_model_input
 
+    def preprocess_imgs(self, imgs):
+        """
+        Preprocess a batch of resized crops for the VAE in one vectorized step.
+
+        :param imgs: Sequence or [N, H, W, 3] array of BGR uint8 crops of resized_img size.
+        :return: (masked, ref) [N, 3, H, W] tensors on the VAE device; masked has the lower half zeroed.
+        """
+        x = torch.from_numpy(np.ascontiguousarray(np.asarray(imgs)[..., ::-1]))  # BGR to RGB
+        x = x.to(self.vae.device).permute(0, 3, 1, 2).float() / 255.
+        masked = x * (self._mask_tensor > 0.5).to(x.device)
+        return self.transform(masked), self.transform(x)
+
+    def get_latents_for_unet_batch(self, imgs, batch_size=32):
+        """
+        Batched get_latents_for_unet.
+
+        :param imgs: Iterable of 256x256 BGR crops (list, [N, H, W, 3] array or generator);
+                     it is consumed batch_size crops at a time.
+        :param batch_size: Number of crops per encoder call.
+        :return: A [N, 8, 32, 32] tensor of masked and reference latents.
+        """
+        latents = []
+        batch = []
+
+        def encode(batch):
+            masked, ref = self.preprocess_imgs(batch)
+            # masked and reference crops go through the encoder together
+            encoded = self.encode_latents(torch.cat([masked, ref], dim=0))
+            return torch.cat([encoded[:len(batch)], encoded[len(batch):]], dim=1)
+
+        for img in imgs:
+            batch.append(img)
+            if len(batch) == batch_size:
+                latents.append(encode(batch))
+                batch = []
+        if batch:
+            latents.append(encode(batch))
+        if not latents:
+            return torch.zeros((0, 8, self._resized_img // 8, self._resized_img // 8), device=self.vae.device)
+        return torch.cat(latents, dim=0)
+
 if __name__ == "__main__":
     vae_mode_path = "./models/sd-vae-ft-mse/"
     vae = VAE(model_path = vae_mode_path,use_float16=False)
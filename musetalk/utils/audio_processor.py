@@ -8,6 +8,18 @@ from einops import rearrange
 from transformers import AutoFeatureExtractor
 
 
+def pcm_to_float32(pcm):
+    """Convert a raw PCM chunk (int16 bytes, int16 array or float array) to float32 in [-1, 1]."""
+    if isinstance(pcm, (bytes, bytearray, memoryview)):
+        pcm = np.frombuffer(pcm, dtype=np.int16)
+    pcm = np.asarray(pcm)
+    if pcm.ndim > 1:
+        pcm = pcm.mean(axis=-1)
+    if np.issubdtype(pcm.dtype, np.integer):
+        return pcm.astype(np.float32) / 32768.0
+    return pcm.astype(np.float32)
+
+
 class AudioProcessor:
     def __init__(self, feature_extractor_path="openai/whisper-tiny/"):
         self.feature_extractor = AutoFeatureExtractor.from_pretrained(feature_extractor_path)
@@ -45,7 +57,6 @@ class AudioProcessor:
         audio_padding_length_left=2,
         audio_padding_length_right=2,
     ):
-        audio_feature_length_per_frame = 2 * (audio_padding_length_left + audio_padding_length_right + 1)
         whisper_feature = []
         # Process multiple 30s mel input features
         for input_feature in whisper_input_features:
@@ -55,6 +66,62 @@ class AudioProcessor:
             whisper_feature.append(audio_feats)
 
         whisper_feature = torch.cat(whisper_feature, dim=1)
+        return self._feature_to_chunks(
+            whisper_feature,
+            librosa_length,
+            fps=fps,
+            audio_padding_length_left=audio_padding_length_left,
+            audio_padding_length_right=audio_padding_length_right,
+        )
+
+    def get_whisper_chunks(
+        self,
+        tracks,
+        device,
+        weight_dtype,
+        whisper,
+        fps=25,
+        audio_padding_length_left=2,
+        audio_padding_length_right=2,
+        batch_size=8,
+    ):
+        """
+        get_whisper_chunk for several tracks at once.
+
+        :param tracks: A list of (whisper_input_features, librosa_length) from get_audio_feature.
+        :param batch_size: 30s segments per encoder call; segments of all tracks share the batches.
+        :return: A list with the whisper chunks of every track.
+        """
+        segments = [input_feature for input_features, _ in tracks for input_feature in input_features]
+        encoded = []
+        for i in range(0, len(segments), batch_size):
+            input_feature = torch.cat(segments[i:i + batch_size], dim=0).to(device).to(weight_dtype)
+            audio_feats = whisper.encoder(input_feature, output_hidden_states=True).hidden_states
+            encoded += list(torch.stack(audio_feats, dim=2).split(1, dim=0))
+
+        results = []
+        start = 0
+        for input_features, librosa_length in tracks:
+            whisper_feature = torch.cat(encoded[start:start + len(input_features)], dim=1)
+            start += len(input_features)
+            results.append(self._feature_to_chunks(
+                whisper_feature,
+                librosa_length,
+                fps=fps,
+                audio_padding_length_left=audio_padding_length_left,
+                audio_padding_length_right=audio_padding_length_right,
+            ))
+        return results
+
+    def _feature_to_chunks(
+        self,
+        whisper_feature,
+        librosa_length,
+        fps=25,
+        audio_padding_length_left=2,
+        audio_padding_length_right=2,
+    ):
+        audio_feature_length_per_frame = 2 * (audio_padding_length_left + audio_padding_length_right + 1)
         # Trim the last segment to remove padding
         sr = 16000
         audio_fps = 50
@@ -93,6 +160,183 @@ class AudioProcessor:
         audio_prompts = rearrange(audio_prompts, 'b c h w -> b (c h) w')
         return audio_prompts
 
+    def create_stream_session(
+        self,
+        device,
+        weight_dtype,
+        whisper,
+        fps=25,
+        audio_padding_length_left=2,
+        audio_padding_length_right=2,
+        sampling_rate=16000,
+    ):
+        """Open an AudioStreamSession that turns pushed PCM chunks into whisper chunks."""
+        return AudioStreamSession(
+            self,
+            device,
+            weight_dtype,
+            whisper,
+            fps=fps,
+            audio_padding_length_left=audio_padding_length_left,
+            audio_padding_length_right=audio_padding_length_right,
+            sampling_rate=sampling_rate,
+        )
+
+
+class AudioStreamSession:
+    """
+    Incremental counterpart of AudioProcessor.get_audio_feature + get_whisper_chunk.
+
+    PCM is pushed in arbitrary sized chunks. Audio is split into the same 30s
+    segments as the offline path; finished segments are encoded once, the open
+    segment is re-encoded whenever new frames can be emitted. A frame is only
+    emitted once every whisper feature in its window (including the right
+    context of audio_padding_length_right) is backed by real audio, so the
+    window layout matches get_whisper_chunk. finish() flushes the tail with the
+    same zero padding as the offline path.
+
+    Only the window layout is exact. Whisper attends over the whole segment, so
+    features of the open segment come from the audio received so far and are an
+    approximation of the offline ones until the segment is complete. Each push
+    that emits frames re-encodes the open segment, i.e. one full encoder pass
+    per push regardless of the chunk size; push chunks of a few frames or more.
+    """
+
+    sr = 16000
+    audio_fps = 50
+
+    def __init__(
+        self,
+        audio_processor,
+        device,
+        weight_dtype,
+        whisper,
+        fps=25,
+        audio_padding_length_left=2,
+        audio_padding_length_right=2,
+        sampling_rate=16000,
+    ):
+        self.audio_processor = audio_processor
+        self.device = device
+        self.weight_dtype = weight_dtype
+        self.whisper = whisper
+        self.fps = int(fps)
+        self.audio_padding_length_left = audio_padding_length_left
+        self.audio_padding_length_right = audio_padding_length_right
+        self.sampling_rate = sampling_rate
+
+        self.audio_feature_length_per_frame = 2 * (audio_padding_length_left + audio_padding_length_right + 1)
+        self.whisper_idx_multiplier = self.audio_fps / self.fps
+        self.padding_nums = math.ceil(self.whisper_idx_multiplier)
+        self.segment_length = 30 * self.sr
+
+        self.num_samples = 0          # samples received so far (at 16kHz)
+        self.num_emitted = 0          # whisper chunks handed out so far
+        self.finished = False
+        self._segment = np.zeros(0, dtype=np.float32)  # pcm of the open 30s segment
+        self._committed = None        # [1, T, 5, 384] left padding + encoded finished segments
+        self._base = 0                # index of _committed[:, 0] in padded feature coordinates
+
+    def _encode(self, pcm):
+        input_feature = self.audio_processor.feature_extractor(
+            pcm,
+            return_tensors="pt",
+            sampling_rate=self.sr
+        ).input_features
+        input_feature = input_feature.to(self.device).to(self.weight_dtype)
+        audio_feats = self.whisper.encoder(input_feature, output_hidden_states=True).hidden_states
+        return torch.stack(audio_feats, dim=2)
+
+    def _commit(self, audio_feats):
+        if self._committed is None:
+            num_left = self.padding_nums * self.audio_padding_length_left
+            self._committed = audio_feats.new_zeros((audio_feats.shape[0], num_left) + tuple(audio_feats.shape[2:]))
+        self._committed = torch.cat([self._committed, audio_feats], dim=1)
+
+    def _num_ready(self, final=False):
+        num_frames = math.floor((self.num_samples / self.sr) * self.fps)
+        if final:
+            return num_frames
+        # real features available, in padded coordinates
+        available = math.floor((self.num_samples / self.sr) * self.audio_fps) + \
+            self.padding_nums * self.audio_padding_length_left
+        ready = self.num_emitted
+        while ready < num_frames and \
+                math.floor(ready * self.whisper_idx_multiplier) + self.audio_feature_length_per_frame <= available:
+            ready += 1
+        return ready
+
+    def _features(self, final=False):
+        """Padded features from self._base up to the end of the received audio."""
+        features = self._committed
+        if len(self._segment) > 0:
+            segment_feats = self._encode(self._segment)
+            valid = math.floor((len(self._segment) / self.sr) * self.audio_fps)
+            segment_feats = segment_feats[:, :valid]
+            if self._committed is None:
+                self._commit(segment_feats[:, :0])
+            features = torch.cat([self._committed, segment_feats], dim=1)
+        if final:
+            features = torch.cat([
+                features,
+                torch.zeros_like(features[:, :self.padding_nums * 3 * self.audio_padding_length_right])
+            ], dim=1)
+        return features
+
+    def _emit(self, ready, final=False):
+        if ready <= self.num_emitted:
+            return []
+        features = self._features(final=final)
+        audio_prompts = []
+        for frame_index in range(self.num_emitted, ready):
+            audio_index = math.floor(frame_index * self.whisper_idx_multiplier) - self._base
+            audio_clip = features[:, audio_index: audio_index + self.audio_feature_length_per_frame]
+            assert audio_clip.shape[1] == self.audio_feature_length_per_frame
+            audio_prompts.append(audio_clip)
+        self.num_emitted = ready
+
+        # drop committed features no later frame can reach
+        drop = math.floor(self.num_emitted * self.whisper_idx_multiplier) - self._base
+        drop = min(drop, self._committed.shape[1])
+        if drop > 0:
+            self._committed = self._committed[:, drop:]
+            self._base += drop
+
+        audio_prompts = torch.cat(audio_prompts, dim=0)  # T, 10, 5, 384
+        audio_prompts = rearrange(audio_prompts, 'b c h w -> b (c h) w')
+        return list(audio_prompts)
+
+    def push(self, pcm):
+        """
+        Add a PCM chunk and return the whisper chunks that became ready.
+
+        :param pcm: int16 bytes, or an int16/float array sampled at self.sampling_rate.
+        :return: A list of [50, 384] tensors, possibly empty.
+        """
+        assert not self.finished, "push() called after finish()"
+        pcm = pcm_to_float32(pcm)
+        if self.sampling_rate != self.sr:
+            pcm = librosa.resample(pcm, orig_sr=self.sampling_rate, target_sr=self.sr)
+        self.num_samples += len(pcm)
+
+        while len(self._segment) + len(pcm) >= self.segment_length:
+            take = self.segment_length - len(self._segment)
+            self._segment = np.concatenate([self._segment, pcm[:take]])
+            pcm = pcm[take:]
+            self._commit(self._encode(self._segment))
+            self._segment = np.zeros(0, dtype=np.float32)
+        self._segment = np.concatenate([self._segment, pcm])
+
+        return self._emit(self._num_ready())
+
+    def finish(self):
+        """Flush the remaining frames with right zero padding and close the session."""
+        if self.finished:
+            return []
+        chunks = self._emit(self._num_ready(final=True), final=True)
+        self.finished = True
+        return chunks
+
 if __name__ == "__main__":
     audio_processor = AudioProcessor()
     wav_path = "./2.wav"
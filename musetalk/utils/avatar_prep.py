@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import pickle
+import shutil
+
+import cv2
+import numpy as np
+import torch
+
+from musetalk.utils.avatar_store import AvatarStore, write_avatar_store
+from musetalk.utils.blending import get_image_prepare_material_batch
+from musetalk.utils.preprocessing import get_landmark_and_bbox_cached, coord_placeholder, DETECT_BATCH_SIZE
+from musetalk.utils.frame_source import open_frame_source
+
+# what to do with an avatar directory that already exists
+PREPARE_POLICIES = ["resume", "rebuild", "skip"]
+
+
+def get_avatar_path(avatar_id, version):
+    if version == "v15":
+        return f"./results/{version}/avatars/{avatar_id}"
+    return f"./results/avatars/{avatar_id}"
+
+
+def _atomic_pickle(path, obj):
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(path + ".tmp", path)
+
+
+class AvatarJob:
+    """
+    Preparation state of one avatar.
+
+    Detection and VAE encoding leave checkpoints in the avatar directory
+    (coords.pkl, latents.pt) so an interrupted preparation resumes after the
+    last finished one; the checkpoints are removed once the store is written.
+    """
+
+    def __init__(self, avatar_id, video_path, bbox_shift, version, avatar_path=None):
+        self.avatar_id = avatar_id
+        self.video_path = video_path
+        self.bbox_shift = bbox_shift
+        self.version = version
+        self.avatar_path = avatar_path or get_avatar_path(avatar_id, version)
+        self.full_imgs_path = f"{self.avatar_path}/full_imgs"
+        self.coords_path = f"{self.avatar_path}/coords.pkl"
+        self.latents_out_path = f"{self.avatar_path}/latents.pt"
+        self.video_out_path = f"{self.avatar_path}/vid_output/"
+        self.mask_coords_path = f"{self.avatar_path}/mask_coords.pkl"
+        self.avatar_info_path = f"{self.avatar_path}/avator_info.json"
+        self.store_path = f"{self.avatar_path}/store"
+        self.avatar_info = {
+            "avatar_id": avatar_id,
+            "video_path": video_path,
+            "bbox_shift": bbox_shift,
+            "version": version
+        }
+        self.frames = None
+        self.coords = None
+        self.latents = None
+        self.masks = None
+        self.crop_boxes = None
+        self.status = "pending"  # pending, prepared, resumed, reused, skipped, failed
+        self.error = None
+        self.timings = {}
+
+    @property
+    def complete(self):
+        """True once the avatar directory holds a finished store (or a complete pre-store avatar)."""
+        if AvatarStore.exists(self.store_path):
+            return True
+        return all(os.path.exists(path) for path in [self.mask_coords_path, self.coords_path, self.latents_out_path])
+
+    @property
+    def done(self):
+        return self.status in ("reused", "skipped", "failed")
+
+    def run_step(self, name, fn, *args, **kwargs):
+        """Run one step, timing it and turning an exception into a failed job."""
+        if self.done:
+            return self
+        start = time.time()
+        try:
+            fn(self, *args, **kwargs)
+        except Exception as e:
+            self.status = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            # keep the checkpoints but drop the frames so a failure doesn't pin memory
+            self.frames = self.masks = None
+        self.timings[name] = round(time.time() - start, 3)
+        return self
+
+
+def apply_policy(job, policy):
+    """
+    Decide what to do with the avatar directory before preparing it.
+
+    resume:  keep a complete avatar with the same settings, continue a partial
+             one, and rebuild it if video_path/bbox_shift/version changed.
+    rebuild: always prepare from scratch.
+    skip:    leave any existing avatar directory untouched.
+    """
+    if policy not in PREPARE_POLICIES:
+        raise ValueError(f"unknown policy {policy}, expected one of {PREPARE_POLICIES}")
+    if not os.path.exists(job.avatar_path):
+        return
+    if policy == "skip":
+        job.status = "skipped"
+        return
+    saved_info = None
+    if os.path.exists(job.avatar_info_path):
+        with open(job.avatar_info_path, "r") as f:
+            saved_info = json.load(f)
+    if policy == "rebuild" or saved_info != job.avatar_info:
+        if policy == "resume":
+            print(f"{job.avatar_id}: settings changed ({saved_info} -> {job.avatar_info}), rebuilding")
+        shutil.rmtree(job.avatar_path)
+        return
+    # avatars prepared before the binary store existed are complete too
+    if job.complete:
+        job.status = "reused"
+        return
+    job.status = "resumed"
+
+
+def extract_frames(job):
+    os.makedirs(job.avatar_path, exist_ok=True)
+    os.makedirs(job.video_out_path, exist_ok=True)
+    with open(job.avatar_info_path, "w") as f:
+        json.dump(job.avatar_info, f)
+
+    # frames are decoded straight into memory; decoding again on resume is
+    # cheap next to detection, so they are not checkpointed as images
+    with open_frame_source(job.video_path) as source:
+        job.frames = list(source)
+    if len(job.frames) == 0:
+        raise ValueError(f"no frames in {job.video_path}")
+
+
+def detect_faces(job, landmark_cache=None, batch_size=DETECT_BATCH_SIZE, max_side=None, refine=False,
+                 track_interval=0, policy="s3fd"):
+    if os.path.exists(job.coords_path):
+        with open(job.coords_path, "rb") as f:
+            job.coords = pickle.load(f)
+        return
+    print(f"{job.avatar_id}: extracting landmarks...")
+    job.coords, job.frames = get_landmark_and_bbox_cached(job.frames, job.bbox_shift, source_path=job.video_path,
+                                                          cache=landmark_cache, batch_size=batch_size,
+                                                          detect_max_side=max_side, detect_refine=refine,
+                                                          track_interval=track_interval, detect_policy=policy)
+    _atomic_pickle(job.coords_path, job.coords)
+
+
+def _crop_boxes(job, extra_margin=None):
+    """(idx, x1, y1, x2, y2) of the frames with a face; extra_margin (v15) extends job.coords downwards first."""
+    coords = list(job.coords)
+    crop_boxes = []
+    for idx, (bbox, frame) in enumerate(zip(coords, job.frames)):
+        if bbox == coord_placeholder:
+            continue
+        x1, y1, x2, y2 = bbox
+        if extra_margin is not None:
+            y2 = y2 + extra_margin
+            y2 = min(y2, frame.shape[0])
+            coords[idx] = [x1, y1, x2, y2]
+        crop_boxes.append((idx, x1, y1, x2, y2))
+    job.coords = coords
+    return crop_boxes
+
+
+def _encode_crops(job, vae, crop_boxes, batch_size=32):
+    crops = (cv2.resize(job.frames[idx][y1:y2, x1:x2], (256, 256), interpolation=cv2.INTER_LANCZOS4)
+             for idx, x1, y1, x2, y2 in crop_boxes)
+    return vae.get_latents_for_unet_batch(crops, batch_size=batch_size).cpu()
+
+
+def encode_latents(job, vae, extra_margin=None, batch_size=32):
+    """VAE-encode the face crops; extra_margin (v15) extends the boxes downwards first."""
+    cached = None
+    if os.path.exists(job.latents_out_path):
+        cached = torch.load(job.latents_out_path)
+    crop_boxes = _crop_boxes(job, extra_margin)
+    if cached is not None:
+        job.latents = cached
+        return
+    job.latents = _encode_crops(job, vae, crop_boxes, batch_size=batch_size)
+    torch.save(job.latents, job.latents_out_path + ".tmp")
+    os.replace(job.latents_out_path + ".tmp", job.latents_out_path)
+
+
+def parse_masks(job, fp, mode="raw", batch_size=16):
+    # the cycle is frames + frames[::-1] and a mask only depends on its frame
+    # and box, so only the unique frames are parsed
+    job.masks = []
+    job.crop_boxes = []
+    for i in range(0, len(job.frames), batch_size):
+        boxes = [list(box) for box in job.coords[i:i + batch_size]]
+        for mask, crop_box in get_image_prepare_material_batch(job.frames[i:i + batch_size], boxes,
+                                                               fp=fp, mode=mode):
+            job.masks.append(mask)
+            job.crop_boxes.append(crop_box)
+
+
+def write_store(job):
+    # the store keeps the unique frames and plays them as a ping-pong cycle
+    write_avatar_store(
+        job.store_path,
+        frames=job.frames,
+        masks=job.masks,
+        latents=job.latents,
+        coords=job.coords,
+        crop_boxes=job.crop_boxes,
+        avatar_info=job.avatar_info,
+        cycle="pingpong",
+    )
+    # the checkpoints (and frames extracted by older versions) now live in the store
+    shutil.rmtree(job.full_imgs_path, ignore_errors=True)
+    for path in [job.coords_path, job.latents_out_path]:
+        if os.path.exists(path):
+            os.remove(path)
+    job.frames = job.masks = job.latents = None
+    if job.status == "pending":
+        job.status = "prepared"
+
+
+def prepare_avatar(job, vae, fp, mode="raw", extra_margin=None, vae_batch_size=32, parse_batch_size=16,
+                   landmark_cache=None, detect_batch_size=DETECT_BATCH_SIZE, detect_max_side=None,
+                   detect_refine=False, track_interval=0, detect_policy="s3fd"):
+    """Run all preparation steps for one avatar in the calling thread."""
+    extract_frames(job)
+    detect_faces(job, landmark_cache=landmark_cache, batch_size=detect_batch_size, max_side=detect_max_side,
+                 refine=detect_refine, track_interval=track_interval, policy=detect_policy)
+    encode_latents(job, vae, extra_margin=extra_margin, batch_size=vae_batch_size)
+    parse_masks(job, fp, mode=mode, batch_size=parse_batch_size)
+    write_store(job)
+    return job
+
+
+def reshift_avatar(job, vae, fp, mode="raw", extra_margin=None, vae_batch_size=32, parse_batch_size=16,
+                   landmark_cache=None, detect_batch_size=DETECT_BATCH_SIZE, detect_max_side=None,
+                   detect_refine=False, track_interval=0, detect_policy="s3fd"):
+    """
+    Move a prepared avatar to job.bbox_shift in place.
+
+    Only the face crops depend on bbox_shift: the frames are read back from the
+    store, the crops are derived again from the detections (a landmark cache
+    hit skips detection) and only frames whose crop changed are VAE-encoded and
+    parsed again. Avatars without a ping-pong store are prepared again.
+    """
+    # checkpoints hold crops of the old bbox_shift and must not be resumed
+    for path in [job.coords_path, job.latents_out_path]:
+        if os.path.exists(path):
+            os.remove(path)
+    if not AvatarStore.exists(job.store_path) or AvatarStore(job.store_path).cycle != "pingpong":
+        return prepare_avatar(job, vae, fp, mode=mode, extra_margin=extra_margin, vae_batch_size=vae_batch_size,
+                              parse_batch_size=parse_batch_size, landmark_cache=landmark_cache,
+                              detect_batch_size=detect_batch_size, detect_max_side=detect_max_side,
+                              detect_refine=detect_refine, track_interval=track_interval,
+                              detect_policy=detect_policy)
+
+    # copy the unique entries out of the store, write_store overwrites its files
+    store = AvatarStore(job.store_path)
+    num_frames = len(store.coords) // 2
+    job.frames = [np.array(store.frames[i]) for i in range(num_frames)]
+    old_coords = [tuple(store.coords[i]) for i in range(num_frames)]
+    masks = [np.array(store.masks[i]) for i in range(num_frames)]
+    crop_boxes = [list(store.crop_boxes[i]) for i in range(num_frames)]
+    # latents are stored for the frames with a face only
+    face_idxs = [idx for idx, box in enumerate(old_coords) if box != coord_placeholder]
+    latents = {idx: store.latents[k] for k, idx in enumerate(face_idxs)}
+    del store
+
+    detect_faces(job, landmark_cache=landmark_cache, batch_size=detect_batch_size, max_side=detect_max_side,
+                 refine=detect_refine, track_interval=track_interval, policy=detect_policy)
+    face_boxes = _crop_boxes(job, extra_margin)
+    changed = [idx for idx, box in enumerate(job.coords) if tuple(box) != old_coords[idx]]
+    print(f"{job.avatar_id}: bbox_shift changed, encoding {len(changed)} of {num_frames} face crops again")
+
+    changed_set = set(changed)
+    encode = [box for box in face_boxes if box[0] in changed_set]
+    if encode:
+        for (idx, *_), latent in zip(encode, _encode_crops(job, vae, encode, batch_size=vae_batch_size)):
+            latents[idx] = latent[None]
+    job.latents = torch.cat([latents[idx] for idx, *_ in face_boxes], dim=0)
+
+    for i in range(0, len(changed), parse_batch_size):
+        batch = changed[i:i + parse_batch_size]
+        results = get_image_prepare_material_batch([job.frames[idx] for idx in batch],
+                                                   [list(job.coords[idx]) for idx in batch], fp=fp, mode=mode)
+        for idx, (mask, crop_box) in zip(batch, results):
+            masks[idx] = mask
+            crop_boxes[idx] = crop_box
+    job.masks = masks
+    job.crop_boxes = crop_boxes
+
+    write_store(job)
+    # the settings are updated last, an interrupted reshift is rebuilt by --policy resume
+    with open(job.avatar_info_path, "w") as f:
+        json.dump(job.avatar_info, f)
+    return job
@@ -0,0 +1,322 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+AVATAR_STORE_FORMAT = "musetalk-avatar"
+# v2 stores only the unique frames and records how they are cycled
+AVATAR_STORE_VERSION = 2
+SUPPORTED_STORE_VERSIONS = (1, 2)
+HEADER_NAME = "header.json"
+# cycle layouts: "none" stores the cycle as is, "pingpong" stores the unique
+# entries and plays them as items + items[::-1]
+CYCLE_MODES = ("none", "pingpong")
+
+
+class RaggedArrayView:
+    """
+    Sequence of 2D uint8 arrays of different sizes packed into one flat array.
+
+    index is an [N, 3] array of (offset, height, width); items are zero-copy
+    views into the (memory-mapped) flat buffer.
+    """
+
+    def __init__(self, flat, index):
+        self._flat = flat
+        self._index = index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        offset, h, w = (int(v) for v in self._index[i])
+        return self._flat[offset:offset + h * w].reshape(h, w)
+
+
+class LatentView:
+    """
+    Sequence of [1, 8, 32, 32] torch tensors backed by one [N, 8, 32, 32] array,
+    so it can stand in for the list of latents that datagen expects.
+    """
+
+    def __init__(self, array):
+        self._array = array
+
+    def __len__(self):
+        return len(self._array)
+
+    def __getitem__(self, i):
+        return torch.from_numpy(np.array(self._array[i:i + 1]))
+
+
+class PingPongView:
+    """
+    The cycle items + items[::-1] of a sequence, without storing the reversed half.
+    Indices wrap around, so callers can pass a running frame index.
+    """
+
+    def __init__(self, items):
+        self._items = items
+
+    def __len__(self):
+        return 2 * len(self._items)
+
+    def unique_index(self, i):
+        n = len(self._items)
+        i = i % (2 * n)
+        return i if i < n else 2 * n - 1 - i
+
+    def __getitem__(self, i):
+        return self._items[self.unique_index(i)]
+
+
+class FrameCache:
+    """
+    LRU cache of decoded arrays bounded by a byte budget, shared by the frame
+    providers of one avatar. Cached arrays are read-only.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key):
+        with self._lock:
+            array = self._items.get(key)
+            if array is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return array
+
+    def put(self, key, array):
+        if array.nbytes > self.budget_bytes:
+            return
+        array.flags.writeable = False
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = array
+            self.nbytes += array.nbytes
+            while self.nbytes > self.budget_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+
+class AvatarFrameProvider:
+    """
+    Cycle-indexed access to frames or masks of a store.
+
+    Cycle indices are mapped onto the unique entries (see PingPongView). With a
+    cache, entries are copied out of the memory-mapped store on first use and
+    kept under the cache's byte budget, and the next `prefetch` cycle indices
+    are loaded in the background; without one the memory-mapped views are
+    returned directly.
+    """
+
+    def __init__(self, name, items, cycle="none", cache=None, prefetch=0, executor=None):
+        self.name = name
+        self._items = items
+        self._view = PingPongView(items) if cycle == "pingpong" else None
+        self._cache = cache
+        self._prefetch = prefetch if cache is not None and executor is not None else 0
+        self._executor = executor
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._view) if self._view is not None else len(self._items)
+
+    def _unique_index(self, i):
+        if self._view is not None:
+            return self._view.unique_index(i)
+        return i % len(self._items)
+
+    def _load(self, j):
+        array = self._cache.get((self.name, j))
+        if array is None:
+            array = np.array(self._items[j])
+            self._cache.put((self.name, j), array)
+        return array
+
+    def _prefetch_one(self, j):
+        try:
+            if (self.name, j) not in self._cache:
+                self._load(j)
+        finally:
+            with self._lock:
+                self._pending.discard(j)
+
+    def __getitem__(self, i):
+        j = self._unique_index(i)
+        if self._cache is None:
+            return self._items[j]
+        array = self._load(j)
+        for k in range(1, self._prefetch + 1):
+            nxt = self._unique_index(i + k)
+            with self._lock:
+                if nxt in self._pending:
+                    continue
+                self._pending.add(nxt)
+            self._executor.submit(self._prefetch_one, nxt)
+        return array
+
+
+def _write_array(path, array):
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=array.dtype, shape=array.shape)
+    out[...] = array
+    out.flush()
+    del out
+
+
+def write_avatar_store(store_path, frames, masks, latents, coords, crop_boxes, avatar_info=None, cycle="none"):
+    """
+    Write prepared avatar material as a versioned, memory-mappable store.
+
+    With cycle="pingpong" the sequences hold the unique entries only and
+    readers play them forwards then backwards; with "none" they are stored as
+    the cycle itself.
+
+    :param store_path: Directory of the store, created if needed.
+    :param frames: Sequence of equally sized HxWx3 uint8 BGR frames.
+    :param masks: Sequence of 2D uint8 blending masks (sizes may differ per frame).
+    :param latents: Sequence of [1, 8, 32, 32] tensors or an [N, 8, 32, 32] tensor.
+    :param coords: Sequence of face boxes (x1, y1, x2, y2).
+    :param crop_boxes: Sequence of mask crop boxes (x_s, y_s, x_e, y_e).
+    :param avatar_info: Optional dict stored in the header.
+    :param cycle: One of CYCLE_MODES.
+    """
+    if cycle not in CYCLE_MODES:
+        raise ValueError(f"unknown cycle mode {cycle}, expected one of {CYCLE_MODES}")
+    os.makedirs(store_path, exist_ok=True)
+    header_path = os.path.join(store_path, HEADER_NAME)
+    if os.path.exists(header_path):
+        # the header marks a complete store, drop it first so a crash leaves no stale one
+        os.remove(header_path)
+    arrays = {}
+
+    # frames are copied one by one so the whole clip is never duplicated in RAM
+    frame_shape = tuple(frames[0].shape)
+    frames_out = np.lib.format.open_memmap(os.path.join(store_path, "frames.npy"), mode="w+",
+                                           dtype=np.uint8, shape=(len(frames),) + frame_shape)
+    for i, frame in enumerate(frames):
+        if tuple(frame.shape) != frame_shape:
+            raise ValueError(f"frame {i} has shape {frame.shape}, expected {frame_shape}")
+        frames_out[i] = frame
+    frames_out.flush()
+    del frames_out
+    arrays["frames"] = {"file": "frames.npy", "shape": [len(frames)] + list(frame_shape), "dtype": "uint8"}
+
+    mask_index = np.zeros((len(masks), 3), dtype=np.int64)
+    offset = 0
+    for i, mask in enumerate(masks):
+        if mask.ndim == 3:
+            mask = mask[:, :, 0]
+        mask_index[i] = (offset, mask.shape[0], mask.shape[1])
+        offset += mask.shape[0] * mask.shape[1]
+    masks_out = np.lib.format.open_memmap(os.path.join(store_path, "masks.npy"), mode="w+",
+                                          dtype=np.uint8, shape=(max(offset, 1),))
+    for i, mask in enumerate(masks):
+        if mask.ndim == 3:
+            mask = mask[:, :, 0]
+        start, h, w = mask_index[i]
+        masks_out[start:start + h * w] = mask.reshape(-1)
+    masks_out.flush()
+    del masks_out
+    _write_array(os.path.join(store_path, "mask_index.npy"), mask_index)
+    arrays["masks"] = {"file": "masks.npy", "index": "mask_index.npy", "shape": [len(masks)], "dtype": "uint8"}
+
+    if isinstance(latents, torch.Tensor):
+        latents = latents.detach().cpu().numpy()
+    else:
+        latents = torch.cat([latent.detach().cpu() for latent in latents], dim=0).numpy()
+    _write_array(os.path.join(store_path, "latents.npy"), latents)
+    arrays["latents"] = {"file": "latents.npy", "shape": list(latents.shape), "dtype": str(latents.dtype)}
+
+    coords = np.asarray(coords, dtype=np.int32).reshape(-1, 4)
+    _write_array(os.path.join(store_path, "coords.npy"), coords)
+    arrays["coords"] = {"file": "coords.npy", "shape": list(coords.shape), "dtype": "int32"}
+
+    crop_boxes = np.asarray(crop_boxes, dtype=np.int32).reshape(-1, 4)
+    _write_array(os.path.join(store_path, "crop_boxes.npy"), crop_boxes)
+    arrays["crop_boxes"] = {"file": "crop_boxes.npy", "shape": list(crop_boxes.shape), "dtype": "int32"}
+
+    header = {
+        "format": AVATAR_STORE_FORMAT,
+        "version": AVATAR_STORE_VERSION,
+        "cycle": cycle,
+        "avatar_info": avatar_info or {},
+        "arrays": arrays,
+    }
+    with open(header_path + ".tmp", "w") as f:
+        json.dump(header, f, indent=2)
+    os.replace(header_path + ".tmp", header_path)
+
+
+class AvatarStore:
+    """
+    Read-only view of an avatar written by write_avatar_store.
+
+    All arrays are opened with mmap_mode='r': opening is O(1) in the clip length
+    apart from the small coordinate tables, pages are only read when a frame is
+    touched, and several processes serving the same avatar share them through
+    the OS page cache.
+
+    frames, masks, latents, coords and crop_boxes are indexed by position in the
+    cycle whatever the stored layout. With cache_bytes > 0, frames and masks are
+    served from an LRU cache of that many bytes with `prefetch` look-ahead.
+    """
+
+    def __init__(self, store_path, cache_bytes=0, prefetch=0):
+        self.store_path = store_path
+        with open(os.path.join(store_path, HEADER_NAME), "r") as f:
+            self.header = json.load(f)
+        if self.header.get("format") != AVATAR_STORE_FORMAT:
+            raise ValueError(f"{store_path} is not a {AVATAR_STORE_FORMAT} store")
+        if self.header.get("version") not in SUPPORTED_STORE_VERSIONS:
+            raise ValueError(f"unsupported avatar store version {self.header.get('version')} in {store_path}, "
+                             f"expected one of {SUPPORTED_STORE_VERSIONS}")
+        self.avatar_info = self.header["avatar_info"]
+        self.cycle = self.header.get("cycle", "none")
+
+        arrays = self.header["arrays"]
+        self.cache = FrameCache(cache_bytes) if cache_bytes > 0 else None
+        self._executor = ThreadPoolExecutor(max_workers=1) if self.cache is not None and prefetch > 0 else None
+        self.frames = AvatarFrameProvider("frames", self._load(arrays["frames"]["file"]), self.cycle,
+                                          self.cache, prefetch, self._executor)
+        self.masks = AvatarFrameProvider("masks",
+                                         RaggedArrayView(self._load(arrays["masks"]["file"]),
+                                                         self._load(arrays["masks"]["index"])),
+                                         self.cycle, self.cache, prefetch, self._executor)
+        latents = LatentView(self._load(arrays["latents"]["file"]))
+        # the box tables are tiny; plain int tuples keep cv2/slicing call sites unchanged
+        coords = [tuple(int(v) for v in box) for box in self._load(arrays["coords"]["file"])]
+        crop_boxes = [[int(v) for v in box] for box in self._load(arrays["crop_boxes"]["file"])]
+        if self.cycle == "pingpong":
+            self.latents = PingPongView(latents)
+            self.coords = PingPongView(coords)
+            self.crop_boxes = PingPongView(crop_boxes)
+        else:
+            self.latents = latents
+            self.coords = coords
+            self.crop_boxes = crop_boxes
+
+    def _load(self, name):
+        return np.load(os.path.join(self.store_path, name), mmap_mode="r")
+
+    @staticmethod
+    def exists(store_path):
+        return os.path.isfile(os.path.join(store_path, HEADER_NAME))
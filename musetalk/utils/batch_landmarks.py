@@ -0,0 +1,207 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+from mmengine.dataset import Compose, pseudo_collate
+from mmengine.registry import init_default_scope
+from mmpose.structures import merge_data_samples
+
+# mean DWPose face keypoint score below which a frame is not trusted to show a face
+FACE_SCORE_THRESHOLD = 0.3
+
+_pipelines = {}
+
+
+def _test_pipeline(model):
+    # building the pipeline is not free, keep one per model
+    pipeline = _pipelines.get(id(model))
+    if pipeline is None:
+        pipeline = _pipelines[id(model)] = Compose(model.cfg.test_dataloader.dataset.pipeline)
+    return pipeline
+
+
+def dwpose_face_landmarks(model, images, return_scores=False):
+    """
+    The 68 face landmarks DWPose finds in each image, as [68, 2] int32 arrays.
+
+    Same as calling mmpose's inference_topdown on every image with its
+    whole-image box, but all images go through the model in one test_step.
+    With return_scores=True the mean keypoint score of each face comes second.
+    """
+    if len(images) == 0:
+        return ([], []) if return_scores else []
+    scope = model.cfg.get('default_scope', 'mmpose')
+    if scope is not None:
+        init_default_scope(scope)
+    pipeline = _test_pipeline(model)
+    data_list = []
+    for img in images:
+        h, w = img.shape[:2]
+        data_info = dict(img=img)
+        data_info['bbox'] = np.array([[0, 0, w, h]], dtype=np.float32)
+        data_info['bbox_score'] = np.ones(1, dtype=np.float32)
+        data_info.update(model.dataset_meta)
+        data_list.append(pipeline(data_info))
+    with torch.no_grad():
+        results = model.test_step(pseudo_collate(data_list))
+    landmarks, scores = [], []
+    for result in results:
+        instances = merge_data_samples([result]).pred_instances
+        landmarks.append(instances.keypoints[0][23:91].astype(np.int32))
+        scores.append(float(np.mean(instances.keypoint_scores[0][23:91])))
+    if return_scores:
+        return landmarks, scores
+    return landmarks
+
+
+def s3fd_face_boxes(fa, images, max_side=None, refine=False):
+    """
+    fa.get_detections_for_batch over images of any sizes: consecutive images
+    of the same size are stacked into one S3FD forward. max_side and refine
+    are passed on, see FaceAlignment.get_detections_for_batch.
+    """
+    boxes = []
+    start = 0
+    while start < len(images):
+        end = start + 1
+        while end < len(images) and images[end].shape == images[start].shape:
+            end += 1
+        boxes += fa.get_detections_for_batch(np.stack(images[start:end]), max_side=max_side, refine=refine)
+        start = end
+    return boxes
+
+
+def dwpose_face_boxes(fa, images, landmarks, scores, box_check=None, max_side=None, refine=False):
+    """
+    Face boxes taken from the DWPose face landmarks, with S3FD as a fallback.
+
+    S3FD only runs, in one batch, on the images whose landmarks score below
+    FACE_SCORE_THRESHOLD or fail box_check(landmarks). Returns the box or None
+    of every image and the indices of the images that needed S3FD.
+    """
+    boxes = [tuple(int(v) for v in np.clip([lm[:, 0].min(), lm[:, 1].min(), lm[:, 0].max(), lm[:, 1].max()], 0, None))
+             for lm in landmarks]
+    fallback = [j for j, (lm, score) in enumerate(zip(landmarks, scores))
+                if score < FACE_SCORE_THRESHOLD or (box_check is not None and not box_check(lm))]
+    for j, box in zip(fallback, s3fd_face_boxes(fa, [images[j] for j in fallback], max_side, refine)):
+        boxes[j] = box
+    return boxes, fallback
+
+
+def _face_extent(landmarks):
+    return max(float(np.ptp(landmarks[:, 0])), float(np.ptp(landmarks[:, 1])), 1.0)
+
+
+class FaceTracker:
+    """
+    S3FD boxes for consecutive batches of one video, detecting only on keyframes.
+
+    A frame is a keyframe every `interval` frames, when its DWPose face
+    landmarks score below min_score, or when they moved or changed size by more
+    than `drift` times the face size since the last keyframe. Other frames get
+    the keyframe's box moved and scaled along with the landmarks.
+    """
+
+    def __init__(self, interval=10, drift=0.1, min_score=FACE_SCORE_THRESHOLD):
+        self.interval = interval
+        self.drift = drift
+        self.min_score = min_score
+        self._ref = None  # landmarks and box of the last keyframe with a face
+        self._since = 0
+
+    def _is_keyframe(self, ref_landmarks, landmarks, score):
+        if self._since >= self.interval or score < self.min_score:
+            return True
+        size = _face_extent(ref_landmarks)
+        if abs(_face_extent(landmarks) / size - 1) > self.drift:
+            return True
+        shift = np.linalg.norm(landmarks.mean(axis=0) - ref_landmarks.mean(axis=0))
+        return shift > self.drift * size
+
+    @staticmethod
+    def _move_box(box, ref_landmarks, landmarks):
+        scale = _face_extent(landmarks) / _face_extent(ref_landmarks)
+        (rx, ry), (cx, cy) = ref_landmarks.mean(axis=0), landmarks.mean(axis=0)
+        x1, y1, x2, y2 = box
+        moved = [cx + (x1 - rx) * scale, cy + (y1 - ry) * scale, cx + (x2 - rx) * scale, cy + (y2 - ry) * scale]
+        return tuple(int(v) for v in np.clip(moved, 0, None))
+
+    def boxes(self, fa, images, landmarks, scores, max_side=None, refine=False):
+        """The box or None of every image, like s3fd_face_boxes."""
+        # keyframes only depend on landmarks, so all of them go through S3FD together
+        key_boxes = {-1: None if self._ref is None else self._ref[1]}
+        ref = None if self._ref is None else (self._ref[0], -1)
+        refs, keys = [], []
+        for j, (lm, score) in enumerate(zip(landmarks, scores)):
+            if ref is None or self._is_keyframe(ref[0], lm, score):
+                keys.append(j)
+                ref = (lm, j)
+                self._since = 0
+            self._since += 1
+            refs.append(ref)
+        key_boxes.update(zip(keys, s3fd_face_boxes(fa, [images[j] for j in keys], max_side, refine)))
+
+        boxes = [key_boxes.get(j) for j in range(len(images))]
+        # frames following a keyframe without a face are detected themselves
+        lost = [j for j, (_, k) in enumerate(refs) if j not in key_boxes and key_boxes[k] is None]
+        for j, box in zip(lost, s3fd_face_boxes(fa, [images[j] for j in lost], max_side, refine)):
+            boxes[j] = box
+        for j, (ref_lm, k) in enumerate(refs):
+            if j not in key_boxes and key_boxes[k] is not None:
+                boxes[j] = self._move_box(key_boxes[k], ref_lm, landmarks[j])
+
+        if refs:
+            ref_lm, k = refs[-1]
+            self._ref = None if key_boxes[k] is None else (ref_lm, key_boxes[k])
+        return boxes
+
+
+_STOP = object()
+
+
+def prefetch_batches(frames, batch_size, prefetch=2):
+    """
+    Lists of up to batch_size frames from an iterable; a background thread
+    reads (decodes) up to `prefetch` batches ahead of the consumer.
+    """
+    q = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def reader():
+        try:
+            batch = []
+            for frame in frames:
+                if stop.is_set():
+                    return
+                batch.append(frame)
+                if len(batch) == batch_size:
+                    put(batch)
+                    batch = []
+            if batch:
+                put(batch)
+        except Exception as e:
+            put(e)
+        put(_STOP)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _STOP:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,83 @@
+import numpy as np
+
+# maker if the bbox is not sufficient
+coord_placeholder = (0.0,0.0,0.0,0.0)
+
+
+def landmark_bboxes(landmarks, upperbondrange=0):
+    """
+    The crop boxes get_landmark_and_bbox derives from DWPose face landmarks, [N, 4] for [N, 68, 2].
+
+    bbox_shift moves landmark 29 (truncated to whole pixels), and the moved
+    point also counts for the lower edge of the box, as it always has.
+    """
+    landmarks = np.asarray(landmarks, dtype=np.int32).reshape(-1, 68, 2)
+    ys = landmarks[:, :, 1].copy()
+    if upperbondrange != 0:
+        ys[:, 29] = upperbondrange + ys[:, 29] #手动调整  + 向下（偏29）  - 向上（偏28）
+    half_face_coord = ys[:, 29]
+    y2 = ys.max(axis=1)
+    half_face_dist = y2 - half_face_coord
+    upper_bond = np.maximum(0, half_face_coord - half_face_dist)
+    return np.stack([landmarks[:, :, 0].min(axis=1), upper_bond, landmarks[:, :, 0].max(axis=1), y2], axis=1)
+
+def landmark_bbox(face_land_mark, upperbondrange=0):
+    """landmark_bboxes for the landmarks of one frame, as a tuple."""
+    return tuple(int(v) for v in landmark_bboxes(face_land_mark, upperbondrange)[0])
+
+def valid_bboxes(boxes):
+    """is_valid_bbox for [N, 4] boxes."""
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    x1, y1, x2, y2 = boxes.T
+    return ~((y2 - y1 <= 0) | (x2 - x1 <= 0) | (x1 < 0))
+
+def is_valid_bbox(bbox):
+    """False for the landmark boxes get_landmark_and_bbox replaces with the face detector's box."""
+    x1, y1, x2, y2 = bbox
+    return not (y2-y1<=0 or x2-x1<=0 or x1<0)
+
+def missing_fallback_boxes(raw, upperbondrange=0):
+    """
+    Frames whose landmark box is invalid at this bbox_shift but whose raw box
+    is not an S3FD box (the dwpose policy skips S3FD for trusted landmarks).
+    """
+    invalid = ~valid_bboxes(landmark_bboxes(raw["landmarks"], upperbondrange))
+    missing = invalid & np.asarray(raw["has_face"], dtype=bool) & ~np.asarray(raw["s3fd_box"], dtype=bool)
+    return np.flatnonzero(missing).tolist()
+
+def add_fallback_boxes(raw, frames, upperbondrange, detect_fn):
+    """
+    Run detect_fn (frames -> S3FD box or None each) on the missing_fallback_boxes
+    frames so coords_from_raw gives the baseline crops at this bbox_shift.
+    Updates raw in place and returns the number of frames detected.
+    """
+    missing = missing_fallback_boxes(raw, upperbondrange)
+    if not missing:
+        return 0
+    boxes = detect_fn([frames[j] for j in missing])
+    raw["boxes"], raw["has_face"], raw["s3fd_box"] = list(raw["boxes"]), list(raw["has_face"]), list(raw["s3fd_box"])
+    for j, box in zip(missing, boxes):
+        raw["boxes"][j] = (0, 0, 0, 0) if box is None else box
+        raw["has_face"][j] = box is not None
+        raw["s3fd_box"][j] = True
+    return len(missing)
+
+def coords_from_raw(raw, upperbondrange=0):
+    """
+    Crop coordinates per frame (coord_placeholder without a face) for a bbox_shift.
+
+    Uses the landmark box, or the face detector's box where the landmark box is
+    degenerate; pure arithmetic on the stored detections. With the dwpose
+    policy, run add_fallback_boxes for the shift first.
+    """
+    landmark_boxes = landmark_bboxes(raw["landmarks"], upperbondrange)
+    coords_list = []
+    for f_landmark, f, has_face in zip(landmark_boxes, raw["boxes"], raw["has_face"]):
+        if not has_face: # no face in the image
+            coords_list += [coord_placeholder]
+        elif not is_valid_bbox(f_landmark): # if the landmark bbox is not suitable, reuse the bbox
+            coords_list += [tuple(int(v) for v in f)]
+            print("error bbox:",tuple(int(v) for v in f))
+        else:
+            coords_list += [tuple(int(v) for v in f_landmark)]
+    return coords_list
@@ -68,9 +68,60 @@ class FaceAlignment:
         
         self.face_detector = face_detector_module.FaceDetector(device=device, verbose=verbose)
 
-    def get_detections_for_batch(self, images):
-        images = images[..., ::-1]
-        detected_faces = self.face_detector.detect_from_batch(images.copy())
+    def get_detections_for_batch(self, images, max_side=None, refine=False):
+        """
+        The top face box (x1, y1, x2, y2) or None of every image in a batch.
+
+        With max_side, images whose longer side exceeds it are searched at that
+        size and the boxes scaled back. refine runs a second pass on a square crop
+        around each coarse box, no larger than max_side either, to recover the
+        precision lost by downscaling.
+        """
+        images = np.ascontiguousarray(images[..., ::-1])
+        h, w = images.shape[1:3]
+        if not max_side or max(h, w) <= max_side:
+            return self._top_boxes(self.face_detector.detect_from_batch(images))
+
+        scale = max_side / max(h, w)
+        small = np.stack([cv2.resize(img, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+                          for img in images])
+        detected_faces = self.face_detector.detect_from_batch(small)
+        coarse = [d[0][:4] / scale if len(d) else None for d in detected_faces]
+        if refine:
+            coarse = self._refine(images, coarse, max_side)
+        return self._top_boxes([[] if d is None else [np.append(d, 1.0)] for d in coarse])
+
+    def _refine(self, images, boxes, max_side):
+        found = [i for i, d in enumerate(boxes) if d is not None]
+        if not found:
+            return boxes
+        h, w = images.shape[1:3]
+        # one crop size for the whole batch so the crops go through one forward:
+        # twice the largest face, clamped to the frame
+        face = max(max(boxes[i][2] - boxes[i][0], boxes[i][3] - boxes[i][1]) for i in found)
+        side = int(min(h, w, max(2 * face, 1)))
+        scale = min(1.0, max_side / side)
+        size = round(side * scale)
+        crops, origins = [], []
+        for i in found:
+            x1, y1, x2, y2 = boxes[i]
+            cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+            x0 = int(np.clip(round(cx - side / 2), 0, w - side))
+            y0 = int(np.clip(round(cy - side / 2), 0, h - side))
+            crop = images[i, y0:y0 + side, x0:x0 + side]
+            if scale < 1.0:
+                crop = cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA)
+            crops.append(np.ascontiguousarray(crop))
+            origins.append((x0, y0))
+        refined = list(boxes)
+        for i, (x0, y0), d in zip(found, origins, self.face_detector.detect_from_batch(np.stack(crops))):
+            # keep the coarse box when the crop loses the face
+            if len(d):
+                refined[i] = d[0][:4] / scale + np.array([x0, y0, x0, y0])
+        return refined
+
+    @staticmethod
+    def _top_boxes(detected_faces):
         results = []
 
         for i, d in enumerate(detected_faces):
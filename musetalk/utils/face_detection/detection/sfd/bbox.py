@@ -64,6 +64,36 @@ def nms(dets, thresh):
     return keep
 
 
+def batch_nms(dets, idxs, thresh):
+    """
+    nms over the detections of several images at once, idxs holds the image
+    of each detection; boxes of different images never suppress each other.
+
+    Returns the kept indices in descending score order, as nms does per image.
+    """
+    if 0 == len(dets):
+        return np.zeros(0, dtype=np.int64)
+    x1, y1, x2, y2, scores = dets[:, 0], dets[:, 1], dets[:, 2], dets[:, 3], dets[:, 4]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+
+    # one pass per kept box of the whole batch instead of one loop per image
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        xx1, yy1 = np.maximum(x1[i], x1[rest]), np.maximum(y1[i], y1[rest])
+        xx2, yy2 = np.minimum(x2[i], x2[rest]), np.minimum(y2[i], y2[rest])
+
+        w, h = np.maximum(0.0, xx2 - xx1 + 1), np.maximum(0.0, yy2 - yy1 + 1)
+        ovr = w * h / (areas[i] + areas[rest] - w * h)
+
+        order = rest[(ovr <= thresh) | (idxs[rest] != idxs[i])]
+
+    return np.array(keep, dtype=np.int64)
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
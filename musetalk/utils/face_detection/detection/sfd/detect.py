@@ -16,6 +16,49 @@ from .net_s3fd import s3fd
 from .bbox import *
 
 
+def prior_boxes(FH, FW, stride, device):
+    """Anchors of one feature map in center-offset form, [FH * FW, 4] in raster order."""
+    ys, xs = torch.meshgrid(torch.arange(FH, device=device, dtype=torch.float32),
+                            torch.arange(FW, device=device, dtype=torch.float32), indexing='ij')
+    axc = (stride / 2 + xs * stride).reshape(-1)
+    ayc = (stride / 2 + ys * stride).reshape(-1)
+    anchor = torch.full_like(axc, stride * 4)
+    return torch.stack([axc, ayc, anchor, anchor], 1)
+
+
+def anchor_outputs(olist):
+    """
+    Face scores [B, A], box regressions [B, A, 4], anchors [A, 4] and the
+    feature map of each anchor [A], for the anchors of all feature maps.
+    """
+    scores, locs, priors, levels = [], [], [], []
+    for i in range(len(olist) // 2):
+        ocls, oreg = F.softmax(olist[i * 2], dim=1), olist[i * 2 + 1]
+        FB, FC, FH, FW = ocls.size()  # feature map size
+        stride = 2**(i + 2)    # 4,8,16,32,64,128
+        scores.append(ocls[:, 1].reshape(FB, -1))
+        locs.append(oreg.permute(0, 2, 3, 1).reshape(FB, -1, 4))
+        priors.append(prior_boxes(FH, FW, stride, ocls.device))
+        levels.append(torch.full((FH * FW,), i, dtype=torch.long, device=ocls.device))
+    return torch.cat(scores, 1), torch.cat(locs, 1), torch.cat(priors, 0), torch.cat(levels, 0)
+
+
+def decode_detections(olist, score_thresh=0.05):
+    """
+    Every anchor of every feature map scoring above score_thresh, decoded at once.
+
+    Returns the image index of each detection, [N], and the detections,
+    [N, 5] as x1, y1, x2, y2, score, ordered by image, feature map and anchor.
+    Only the selected detections leave the device.
+    """
+    scores, locs, priors, _ = anchor_outputs(olist)
+    idxs, poss = torch.nonzero(scores > score_thresh, as_tuple=True)
+    variances = [0.1, 0.2]
+    boxes = decode(locs[idxs, poss], priors[poss], variances)
+    dets = torch.cat([boxes, scores[idxs, poss].unsqueeze(1)], 1)
+    return idxs.cpu().numpy(), dets.cpu().numpy()
+
+
 def detect(net, img, device):
     img = img - np.array([104, 117, 123])
     img = img.transpose(2, 0, 1)
@@ -25,37 +68,15 @@ def detect(net, img, device):
         torch.backends.cudnn.benchmark = True
 
     img = torch.from_numpy(img).float().to(device)
-    BB, CC, HH, WW = img.size()
     with torch.no_grad():
         olist = net(img)
-
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[0, 1, hindex, windex]
-            loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
-            variances = [0.1, 0.2]
-            box = decode(loc, priors, variances)
-            x1, y1, x2, y2 = box[0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append([x1, y1, x2, y2, score])
-    bboxlist = np.array(bboxlist)
+        _, bboxlist = decode_detections(olist)
     if 0 == len(bboxlist):
         bboxlist = np.zeros((1, 5))
 
     return bboxlist
 
-def batch_detect(net, imgs, device):
+def batch_forward(net, imgs, device):
     imgs = imgs - np.array([104, 117, 123])
     imgs = imgs.transpose(0, 3, 1, 2)
 
@@ -63,38 +84,42 @@ def batch_detect(net, imgs, device):
         torch.backends.cudnn.benchmark = True
 
     imgs = torch.from_numpy(imgs).float().to(device)
-    BB, CC, HH, WW = imgs.size()
     with torch.no_grad():
-        olist = net(imgs)
-#     print(olist)
-    
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    
-    olist = [oelem.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-            variances = [0.1, 0.2]
-            box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
+        return net(imgs)
+
+def batch_detect(net, imgs, device):
+    """
+    Candidate boxes of a batch of images, [N, B, 5] as x1, y1, x2, y2, score.
+
+    There is one candidate for every image and anchor scoring above 0.05, in
+    the order of feature map, image and anchor, and it holds the box and
+    score of that anchor in every image of the batch.
+    """
+    with torch.no_grad():
+        scores, locs, priors, levels = anchor_outputs(batch_forward(net, imgs, device))
+        BB = scores.size(0)
+        idxs, poss = torch.nonzero(scores > 0.05, as_tuple=True)
+        # nonzero orders by image and anchor, candidates go feature map by feature map
+        order = torch.sort(levels[poss] * BB + idxs, stable=True)[1]
+        poss = poss[order]
+        variances = [0.1, 0.2]
+        boxes = decode(locs[:, poss].reshape(-1, 4), priors[poss].repeat(BB, 1), variances).reshape(BB, -1, 4)
+        bboxlist = torch.cat([boxes, scores[:, poss].unsqueeze(2)], 2).permute(1, 0, 2).cpu().numpy()
     if 0 == len(bboxlist):
         bboxlist = np.zeros((1, BB, 5))
 
     return bboxlist
 
+def batch_detect_flat(net, imgs, device, score_thresh=0.05):
+    """
+    Detections of a batch of images from one forward, without batch_detect's
+    per-candidate copy of every image.
+
+    Returns the image index of each detection and the detections, see decode_detections.
+    """
+    with torch.no_grad():
+        return decode_detections(batch_forward(net, imgs, device), score_thresh)
+
 def flip_detect(net, img, device):
     img = cv2.flip(img, 1)
     b = detect(net, img, device)
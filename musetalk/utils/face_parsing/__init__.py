@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import time
 import os
 import cv2
@@ -95,11 +96,7 @@ class FaceParsing():
                 parsing[np.where(parsing!=255)] = 0
             elif mode == "jaw":
                 face_region = np.isin(parsing, [1])*255
-                face_region = face_region.astype(np.uint8)
-                original_dilated = cv2.dilate(face_region, self.kernel, iterations=1)
-                eroded = cv2.erode(original_dilated, self.cheek_kernel, iterations=2)
-                face_region = cv2.bitwise_and(eroded, self.cheek_mask)
-                face_region = cv2.bitwise_or(face_region, cv2.bitwise_and(original_dilated, ~self.cheek_mask))
+                face_region = self._jaw_region(face_region.astype(np.uint8))
                 parsing[(face_region==255) & (~np.isin(parsing, [10]))] = 255         
                 parsing[np.isin(parsing, [11, 12, 13])] = 255
                 parsing[np.where(parsing!=255)] = 0
@@ -110,6 +107,77 @@ class FaceParsing():
         parsing = Image.fromarray(parsing.astype(np.uint8))
         return parsing
 
+    @staticmethod
+    def _label_lut(labels):
+        lut = np.zeros(256, dtype=np.uint8)
+        lut[labels] = 255
+        return lut
+
+    def _jaw_region(self, face_region):
+        original_dilated = cv2.dilate(face_region, self.kernel, iterations=1)
+        eroded = cv2.erode(original_dilated, self.cheek_kernel, iterations=2)
+        face_region = cv2.bitwise_and(eroded, self.cheek_mask)
+        return cv2.bitwise_or(face_region, cv2.bitwise_and(original_dilated, ~self.cheek_mask))
+
+    @staticmethod
+    def _morph(x, kernel, erode=False):
+        """
+        cv2.dilate/cv2.erode with a binary kernel (anchor at its center) of a
+        [B, 1, H, W] 0/1 float tensor, as a convolution counting the set pixels.
+        Like cv2, dilation treats the border as 0 and erosion as 1.
+        """
+        kh, kw = kernel.shape[-2:]
+        x = F.pad(x, (kw // 2, kw // 2, kh // 2, kh // 2), value=1.0 if erode else 0.0)
+        count = F.conv2d(x, kernel)
+        if erode:
+            return (count >= kernel.sum()).float()
+        return (count > 0).float()
+
+    def _jaw_region_batch(self, face_regions):
+        """_jaw_region for a [B, H, W] bool tensor of face pixels, on its device; True in the jaw region."""
+        device = face_regions.device
+        kernel = torch.from_numpy(self.kernel).float().to(device)[None, None]
+        cheek_kernel = torch.from_numpy(self.cheek_kernel).float().to(device)[None, None]
+        cheek = torch.from_numpy(self.cheek_mask > 0).to(device)
+        dilated = self._morph(face_regions.float().unsqueeze(1), kernel)
+        eroded = self._morph(self._morph(dilated, cheek_kernel, erode=True), cheek_kernel, erode=True)
+        return torch.where(cheek, eroded[:, 0] > 0, dilated[:, 0] > 0)
+
+    def parse_batch(self, images, size=(512, 512), mode="raw"):
+        """
+        Batched __call__: a list of PIL images in, a list of 512x512 'L' masks out.
+
+        BiSeNet runs on the stacked batch and the argmax stays on the GPU, as
+        does the jaw morphology, run once for the whole batch with the kernels
+        of __call__. The label -> mask mapping is a lookup table over the batch.
+        """
+        if len(images) == 0:
+            return []
+        images = [Image.open(image) if isinstance(image, str) else image for image in images]
+        with torch.no_grad():
+            batch = np.stack([np.asarray(image.convert("RGB").resize(size, Image.BILINEAR)) for image in images])
+            img = torch.from_numpy(batch).permute(0, 3, 1, 2).float().div(255)
+            mean = torch.tensor((0.485, 0.456, 0.406)).view(1, 3, 1, 1)
+            std = torch.tensor((0.229, 0.224, 0.225)).view(1, 3, 1, 1)
+            img = (img - mean) / std
+            if torch.cuda.is_available():
+                img = img.cuda()
+            out = self.net(img)[0]
+            labels = out.argmax(1)  # [B, H, W]
+            if mode == "jaw":
+                jaw = (self._jaw_region_batch(labels == 1) & (labels != 10)).cpu().numpy()
+            parsing = labels.to(torch.uint8).cpu().numpy()
+
+        # Add 14:neck, remove 10:nose and 7:8:9
+        if mode == "neck":
+            masks = self._label_lut([1, 11, 12, 13, 14])[parsing]
+        elif mode == "jaw":
+            masks = self._label_lut([11, 12, 13])[parsing]
+            masks[jaw] = 255
+        else:
+            masks = self._label_lut([1, 11, 12, 13])[parsing]
+        return [Image.fromarray(mask) for mask in masks]
+
 if __name__ == "__main__":
     fp = FaceParsing()
     segmap = fp('154_small.png')
@@ -0,0 +1,141 @@
+import os
+import subprocess
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+
+
+class FrameSink(ABC):
+    """
+    Consumer of blended BGR frames, written in order.
+    """
+
+    @abstractmethod
+    def write(self, frame):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FFmpegPipeSink(FrameSink):
+    """
+    Encode raw BGR frames with a single long-lived ffmpeg process.
+
+    Frames are streamed to ffmpeg's stdin as rawvideo, so nothing touches the
+    disk before encoding. If audio_path is given the driving audio is muxed in
+    the same invocation. The process is started on the first frame, once the
+    frame size is known.
+    """
+
+    def __init__(self, output_path, fps, audio_path=None, crf=18, audio_codec=None, ffmpeg_bin="ffmpeg"):
+        self.output_path = output_path
+        self.fps = fps
+        self.audio_path = audio_path
+        self.crf = crf
+        self.audio_codec = audio_codec
+        self.ffmpeg_bin = ffmpeg_bin
+        self.frame_size = None
+        self.num_frames = 0
+        self._proc = None
+
+    def _start(self, height, width):
+        cmd = [
+            self.ffmpeg_bin, "-y", "-v", "warning",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(self.fps),
+            "-i", "-",
+        ]
+        if self.audio_path is not None:
+            cmd += ["-i", self.audio_path, "-map", "0:v:0", "-map", "1:a:0"]
+            if self.audio_codec is not None:
+                cmd += ["-c:a", self.audio_codec]
+        cmd += ["-vcodec", "libx264", "-vf", "format=yuv420p", "-crf", str(self.crf), self.output_path]
+        self.frame_size = (height, width)
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        if self._proc is None:
+            self._start(frame.shape[0], frame.shape[1])
+        if frame.shape[:2] != self.frame_size:
+            raise ValueError(f"frame size {frame.shape[:2]} does not match the stream size {self.frame_size}")
+        try:
+            self._proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        except BrokenPipeError:
+            raise RuntimeError(f"ffmpeg exited early while writing {self.output_path}")
+        self.num_frames += 1
+
+    def close(self):
+        if self._proc is None:
+            return
+        self._proc.stdin.close()
+        returncode = self._proc.wait()
+        self._proc = None
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed with exit code {returncode} while writing {self.output_path}")
+
+
+class PNGSink(FrameSink):
+    """
+    Debug sink that dumps every frame as {index:08d}.png into save_dir.
+    """
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.num_frames = 0
+        os.makedirs(save_dir, exist_ok=True)
+
+    def write(self, frame):
+        cv2.imwrite(os.path.join(self.save_dir, f"{str(self.num_frames).zfill(8)}.png"), frame)
+        self.num_frames += 1
+
+
+class TeeSink(FrameSink):
+    """
+    Forward every frame to several sinks.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def write(self, frame):
+        for sink in self.sinks:
+            sink.write(frame)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def open_frame_sink(output_path=None, fps=25, audio_path=None, png_dir=None, **kwargs):
+    """
+    Build the sink for an inference run: an ffmpeg pipe for output_path, plus an
+    optional PNG dump into png_dir for debugging. Returns None if neither is set.
+    """
+    sinks = []
+    if output_path is not None:
+        sinks.append(FFmpegPipeSink(output_path, fps, audio_path=audio_path, **kwargs))
+    if png_dir is not None:
+        sinks.append(PNGSink(png_dir))
+    if len(sinks) == 0:
+        return None
+    if len(sinks) == 1:
+        return sinks[0]
+    return TeeSink(sinks)
+
+
+def mux_audio(video_path, audio_path, output_path):
+    """Add an audio track to an encoded video without re-encoding the video stream."""
+    cmd = [
+        "ffmpeg", "-y", "-v", "warning",
+        "-i", video_path, "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy",
+        output_path,
+    ]
+    subprocess.run(cmd, check=True)
@@ -0,0 +1,211 @@
+import os
+import glob
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+
+try:
+    import decord
+except ImportError:
+    decord = None
+
+IMAGE_EXTS = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff']
+
+
+class FrameSource(ABC):
+    """
+    Source frames as HxWx3 uint8 BGR arrays (what cv2.imread returns).
+
+    Supports streaming iteration, len() and random access by index; nothing is
+    written to disk. Use as a context manager or call close().
+    """
+
+    fps = None
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def __getitem__(self, idx):
+        pass
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def read_range(self, start, end):
+        """Frames start..end-1 in order; shorter if the source ends first."""
+        frames = []
+        for i in range(start, end):
+            try:
+                frames.append(self[i])
+            except IndexError:
+                break
+        return frames
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class VideoFrameSource(FrameSource):
+    """
+    Decode a video file straight into memory.
+
+    Uses decord (frame-accurate random access, also used by the training code)
+    when it is installed and OpenCV otherwise.
+    """
+
+    def __init__(self, video_path):
+        self.video_path = video_path
+        self._reader = None
+        self._cap = None
+        self._next_idx = 0
+        if decord is not None:
+            self._reader = decord.VideoReader(video_path, ctx=decord.cpu(0))
+            self.fps = self._reader.get_avg_fps()
+            self._len = len(self._reader)
+        else:
+            self._cap = cv2.VideoCapture(video_path)
+            if not self._cap.isOpened():
+                raise ValueError(f"cannot open video {video_path}")
+            self.fps = self._cap.get(cv2.CAP_PROP_FPS)
+            self._len = int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        if self._reader is not None:
+            return np.ascontiguousarray(self._reader[idx].asnumpy()[:, :, ::-1])
+        if idx != self._next_idx:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+        ret, frame = self._cap.read()
+        if not ret:
+            raise IndexError(idx)
+        self._next_idx = idx + 1
+        return frame
+
+    def read_range(self, start, end):
+        if self._reader is not None:
+            end = min(end, len(self))
+            if end <= start:
+                return []
+            batch = self._reader.get_batch(list(range(start, end))).asnumpy()
+            return [np.ascontiguousarray(frame[:, :, ::-1]) for frame in batch]
+        return super().read_range(start, end)
+
+    def __iter__(self):
+        if self._reader is not None:
+            self._reader.seek(0)
+            for i in range(len(self)):
+                yield np.ascontiguousarray(self._reader.next().asnumpy()[:, :, ::-1])
+            return
+        # the container's frame count is only an estimate for OpenCV, read until the end
+        self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self._next_idx = 0
+        while True:
+            ret, frame = self._cap.read()
+            if not ret:
+                break
+            self._next_idx += 1
+            yield frame
+
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+        self._reader = None
+
+
+class ImageListSource(FrameSource):
+    """Frames read lazily from a list of image files."""
+
+    def __init__(self, img_list, fps=None):
+        self.img_list = list(img_list)
+        self.fps = fps
+
+    def __len__(self):
+        return len(self.img_list)
+
+    def __getitem__(self, idx):
+        frame = cv2.imread(self.img_list[idx])
+        if frame is None:
+            raise ValueError(f"cannot read image {self.img_list[idx]}")
+        return frame
+
+
+class FrameWindow:
+    """
+    Random access to a FrameSource that keeps only `size` consecutive frames decoded.
+
+    A miss moving forward decodes the next window starting at the requested
+    frame, which is a plain sequential read; a miss moving backward (the
+    reversed half of a ping-pong cycle) decodes the window ending at it, so
+    there is one seek per window instead of one per frame.
+    """
+
+    def __init__(self, source, size=32):
+        self.source = source
+        self.size = size
+        self._start = 0
+        self._frames = []
+
+    def __len__(self):
+        return len(self.source)
+
+    def __getitem__(self, idx):
+        offset = idx - self._start
+        if 0 <= offset < len(self._frames):
+            return self._frames[offset]
+        if idx < self._start:
+            start = max(0, idx - self.size + 1)
+        else:
+            start = idx
+        self._frames = []  # release the old window before decoding the next one
+        self._start = start
+        self._frames = self.source.read_range(start, start + self.size)
+        if not 0 <= idx - start < len(self._frames):
+            raise IndexError(idx)
+        return self._frames[idx - start]
+
+
+def list_image_dir(img_dir):
+    """Images of a directory, in numeric order when the file names are frame numbers."""
+    img_list = glob.glob(os.path.join(img_dir, '*.[jpJP][pnPN]*[gG]'))
+    stems = [os.path.splitext(os.path.basename(x))[0] for x in img_list]
+    if all(stem.isdigit() for stem in stems):
+        return sorted(img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+    return sorted(img_list)
+
+
+def open_frame_source(path, fps=None):
+    """
+    FrameSource for a video file, a single image or a directory of images.
+
+    :param fps: Frame rate reported for image inputs; videos report their own.
+    """
+    if os.path.isdir(path):
+        return ImageListSource(list_image_dir(path), fps=fps)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXTS:
+        return ImageListSource([path], fps=fps)
+    return VideoFrameSource(path)
+
+
+def dump_frames(frames, save_dir):
+    """Write frames as %08d.png into save_dir; only for explicit debugging dumps."""
+    os.makedirs(save_dir, exist_ok=True)
+    for i, frame in enumerate(frames):
+        cv2.imwrite(os.path.join(save_dir, f"{i:08d}.png"), frame)
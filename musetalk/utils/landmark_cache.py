@@ -0,0 +1,104 @@
+import os
+import io
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+from musetalk.utils.frame_source import list_image_dir
+
+LANDMARK_CACHE_FORMAT = "musetalk-landmarks"
+LANDMARK_CACHE_VERSION = 2
+# models that produced the raw landmarks and boxes; part of every key
+LANDMARK_DETECTOR = "dwpose-rtmpose-l_384x288+s3fd"
+DEFAULT_LANDMARK_CACHE_DIR = "./results/landmark_cache"
+
+
+def content_digest(path, chunk_size=1 << 20):
+    """sha1 of a file's bytes, or of the names and bytes of a directory's images in frame order."""
+    files = list_image_dir(path) if os.path.isdir(path) else [path]
+    h = hashlib.sha1()
+    for file_path in files:
+        if len(files) > 1:
+            h.update(os.path.basename(file_path).encode("utf-8") + b"\0")
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class LandmarkCache:
+    """
+    Per-frame detection results keyed by the content of the source and the detector settings.
+
+    An entry is one .npz file holding the raw DWPose face landmarks
+    ([N, 68, 2] int32), the face boxes ([N, 4] int32), which frames have a
+    face and which boxes came from S3FD. Crop coordinates for any bbox_shift are derived from it
+    (preprocessing.coords_from_raw), so bbox_shift is not part of the key.
+    Renaming or moving a video keeps its entry, and editing it or changing the
+    detection settings gives a new one.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_LANDMARK_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        """content_digest, remembered per path/size/mtime so a file is hashed once per process."""
+        # a directory's own mtime does not change when one of its images is rewritten
+        files = list_image_dir(path) if os.path.isdir(path) else [path]
+        stats = [(os.path.basename(f), os.stat(f)) for f in files]
+        memo_key = (os.path.abspath(path),) + tuple((name, st.st_size, st.st_mtime_ns) for name, st in stats)
+        with self._lock:
+            if memo_key in self._digests:
+                return self._digests[memo_key]
+        digest = content_digest(path)
+        with self._lock:
+            self._digests[memo_key] = digest
+        return digest
+
+    def key(self, source_path, detect_max_side=None, detect_refine=False, track_interval=0, detect_policy="s3fd"):
+        params = {
+            "format": LANDMARK_CACHE_FORMAT,
+            "version": LANDMARK_CACHE_VERSION,
+            "detector": LANDMARK_DETECTOR,
+            "content": self.digest(source_path),
+        }
+        # only non-default detection settings add parameters, so default entries keep their keys
+        if detect_max_side:
+            params["detect_max_side"] = int(detect_max_side)
+            params["detect_refine"] = bool(detect_refine)
+        if track_interval:
+            params["track_interval"] = int(track_interval)
+        if detect_policy != "s3fd":
+            params["detect_policy"] = detect_policy
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def load(self, key):
+        """The raw detections saved under key (landmarks, boxes, has_face, s3fd_box), or None."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            raw = {name: data[name] for name in ("landmarks", "boxes", "has_face", "s3fd_box")}
+        return raw
+
+    def save(self, key, raw):
+        """Store raw detections as returned by preprocessing.detect_raw_landmarks."""
+        buf = io.BytesIO()
+        np.savez_compressed(buf, has_face=np.asarray(raw["has_face"], dtype=bool),
+                            s3fd_box=np.asarray(raw["s3fd_box"], dtype=bool),
+                            landmarks=np.asarray(raw["landmarks"], dtype=np.int32).reshape(-1, 68, 2),
+                            boxes=np.asarray(raw["boxes"], dtype=np.int32).reshape(-1, 4))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        # unique temp name, concurrent tasks may detect the same video
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buf.getvalue())
+        os.replace(tmp_path, path)
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+# per-frame events in pipeline order: audio_ready when the frame's whisper
+# chunk is produced, batch_ready when its batch is pulled by the renderer
+FRAME_EVENTS = ["audio_ready", "batch_ready", "unet_start", "unet_end", "vae_end", "blend_end", "sink_write"]
+
+# stage name -> (start event, end event); a None start is the recorder's start time
+STAGE_SPANS = {
+    "audio": (None, "audio_ready"),
+    "batching": ("audio_ready", "batch_ready"),
+    "queue_unet": ("batch_ready", "unet_start"),
+    "unet": ("unet_start", "unet_end"),
+    "vae": ("unet_end", "vae_end"),
+    "blend": ("vae_end", "blend_end"),
+    "sink": ("blend_end", "sink_write"),
+    "total": ("audio_ready", "sink_write"),
+}
+
+
+def _percentiles(values_ms):
+    if len(values_ms) == 0:
+        return None
+    values_ms = np.asarray(values_ms, dtype=np.float64)
+    p50, p95, p99 = np.percentile(values_ms, [50, 95, 99])
+    return {
+        "p50": round(float(p50), 2),
+        "p95": round(float(p95), 2),
+        "p99": round(float(p99), 2),
+        "mean": round(float(values_ms.mean()), 2),
+        "max": round(float(values_ms.max()), 2),
+    }
+
+
+class LatencyRecorder:
+    """
+    Timestamps of every frame as it moves through the realtime renderer.
+
+    Stages call mark()/mark_range() with one of FRAME_EVENTS; report() turns the
+    timestamps into per-stage percentiles, time-to-first-frame and achieved fps.
+    All times are time.perf_counter() seconds, reported in milliseconds.
+    """
+
+    def __init__(self, target_fps, start_time=None, live_interval=0):
+        self.target_fps = target_fps
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.live_interval = live_interval
+        self._events = {name: {} for name in FRAME_EVENTS}
+        self._lock = threading.Lock()
+        self._last_live = self.start_time
+        self._live_from = 0
+
+    def mark(self, frame_idx, event, t=None):
+        t = time.perf_counter() if t is None else t
+        with self._lock:
+            self._events[event][frame_idx] = t
+
+    def mark_range(self, first, count, event, t=None):
+        t = time.perf_counter() if t is None else t
+        with self._lock:
+            events = self._events[event]
+            for idx in range(first, first + count):
+                events[idx] = t
+
+    def maybe_print_live(self):
+        """Print a summary of the frames written since the previous one every live_interval seconds."""
+        if not self.live_interval:
+            return
+        now = time.perf_counter()
+        if now - self._last_live < self.live_interval:
+            return
+        with self._lock:
+            written = sorted(self._events["sink_write"])
+        frames = [idx for idx in written if idx >= self._live_from]
+        if frames:
+            summary = self.summary(frames, now - self._last_live)
+            print("latency " + json.dumps(summary))
+            self._live_from = frames[-1] + 1
+        self._last_live = now
+
+    def summary(self, frames, elapsed):
+        with self._lock:
+            events = {name: dict(values) for name, values in self._events.items()}
+        stages = {}
+        for stage, (begin, end) in STAGE_SPANS.items():
+            begins = events[begin] if begin is not None else dict.fromkeys(events[end], self.start_time)
+            spans = [(events[end][idx] - begins[idx]) * 1000
+                     for idx in frames if idx in begins and idx in events[end]]
+            stages[stage] = _percentiles(spans)
+        return {
+            "frames": len(frames),
+            "fps": round(len(frames) / max(elapsed, 1e-9), 2),
+            "stages_ms": stages,
+        }
+
+    def report(self, pipeline_report=None):
+        """
+        Full report for the clip as a JSON-serialisable dict.
+
+        achieved_fps covers the whole run including audio processing,
+        steady_fps only the span between the first and last written frame.
+        """
+        with self._lock:
+            written = self._events["sink_write"]
+            frames = sorted(written)
+            first_write = min(written.values()) if written else None
+            last_write = max(written.values()) if written else None
+        report = {
+            "target_fps": self.target_fps,
+            "frames": len(frames),
+            "time_to_first_frame_ms": None if first_write is None
+                else round((first_write - self.start_time) * 1000, 2),
+            "achieved_fps": None,
+            "steady_fps": None,
+            "realtime": None,
+        }
+        if frames:
+            report["achieved_fps"] = round(len(frames) / max(last_write - self.start_time, 1e-9), 2)
+            if len(frames) > 1:
+                report["steady_fps"] = round((len(frames) - 1) / max(last_write - first_write, 1e-9), 2)
+            report["realtime"] = (report["steady_fps"] or report["achieved_fps"]) >= self.target_fps
+        report["stages_ms"] = self.summary(frames, 1.0)["stages_ms"]
+        if pipeline_report is not None:
+            report["wall_time_s"] = pipeline_report["wall_time_s"]
+            report["queues"] = {
+                name: {
+                    "occupancy": stats["occupancy"],
+                    "queue_size": stats["queue_size"],
+                    "queue_depth_mean": stats["queue_depth_mean"],
+                    "queue_depth_max": stats["queue_depth_max"],
+                }
+                for name, stats in pipeline_report["stages"].items()
+            }
+        return report
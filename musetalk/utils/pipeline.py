@@ -0,0 +1,270 @@
+import heapq
+import threading
+import time
+from collections import deque
+
+_STOP = object()
+
+
+class StageQueue:
+    """
+    Bounded FIFO between two stages (maxsize <= 0 for no bound).
+
+    put() and get() block without polling; abort() wakes every blocked caller,
+    after which put() drops its item and get() returns the stop marker.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._aborted = False
+
+    def qsize(self):
+        with self._lock:
+            return len(self._items)
+
+    def put(self, item):
+        with self._not_full:
+            while 0 < self.maxsize <= len(self._items) and not self._aborted:
+                self._not_full.wait()
+            if self._aborted:
+                return
+            self._items.append(item)
+            self._not_empty.notify()
+
+    def get(self):
+        with self._not_empty:
+            while not self._items and not self._aborted:
+                self._not_empty.wait()
+            if self._aborted:
+                return _STOP
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def abort(self):
+        with self._lock:
+            self._aborted = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+
+class Stage:
+    """
+    One step of a StagedPipeline.
+
+    fn(seq, item) is called for every input. With expand=True it returns an
+    iterable and every element becomes its own downstream item (e.g. a decoded
+    batch becoming frames). A single-worker stage may return None to drop an
+    item. Stages with more than one worker cannot expand and forward None like
+    any other result, so the next stage can put their outputs back in order.
+    """
+
+    def __init__(self, name, fn, num_workers=1, queue_size=4, expand=False):
+        assert num_workers >= 1
+        assert not (expand and num_workers > 1), "only single-worker stages can expand items"
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.expand = expand
+
+
+class StageStats:
+    """Counters for one stage, filled in by the worker threads."""
+
+    def __init__(self, name, num_workers, queue_size):
+        self.name = name
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.items = 0
+        self.busy_time = 0.0        # seconds spent inside fn, summed over workers
+        self.wait_input_time = 0.0  # seconds blocked on an empty input queue
+        self.wait_output_time = 0.0 # seconds blocked on a full output queue
+        self.queue_depth_sum = 0
+        self.queue_depth_max = 0
+        self._lock = threading.Lock()
+
+    def record_get(self, depth, waited):
+        with self._lock:
+            self.queue_depth_sum += depth
+            self.queue_depth_max = max(self.queue_depth_max, depth)
+            self.wait_input_time += waited
+
+    def record_call(self, busy):
+        with self._lock:
+            self.items += 1
+            self.busy_time += busy
+
+    def record_put(self, waited):
+        with self._lock:
+            self.wait_output_time += waited
+
+    def as_dict(self, wall_time):
+        capacity = max(wall_time * self.num_workers, 1e-9)
+        return {
+            "workers": self.num_workers,
+            "items": self.items,
+            "busy_s": round(self.busy_time, 4),
+            "occupancy": round(self.busy_time / capacity, 4),
+            "wait_input_s": round(self.wait_input_time, 4),
+            "wait_output_s": round(self.wait_output_time, 4),
+            "queue_size": self.queue_size,
+            "queue_depth_mean": round(self.queue_depth_sum / max(self.items, 1), 2),
+            "queue_depth_max": self.queue_depth_max,
+        }
+
+
+class StagedPipeline:
+    """
+    Threaded stages connected by bounded queues.
+
+    Items enter through run(source) from the calling thread, so the source
+    iterable is the first stage (e.g. audio features). Each stage runs on its
+    own worker threads; a full queue blocks the producer, so throughput is set
+    by the slowest stage and memory by the queue sizes. Items carry a sequence
+    number assigned by the last expanding/single-worker stage, and the stage
+    after a multi-worker stage reassembles them in order. The first exception
+    aborts all stages and is re-raised from run(); on_abort() is then called
+    to wake anything a stage blocks on outside the pipeline's queues.
+    """
+
+    def __init__(self, stages, on_abort=None):
+        self.stages = list(stages)
+        self.on_abort = on_abort
+        for prev, stage in zip(self.stages, self.stages[1:]):
+            assert prev.num_workers == 1 or stage.num_workers == 1, \
+                "a multi-worker stage must be followed by a single-worker stage"
+        self.queues = [StageQueue(maxsize=stage.queue_size) for stage in self.stages]
+        self.stats = [StageStats(s.name, s.num_workers, s.queue_size) for s in self.stages]
+        self.source_stats = StageStats("source", 1, 0)
+        self.wall_time = 0.0
+        self._abort = threading.Event()
+        self._error = None
+        self._remaining = [s.num_workers for s in self.stages]
+        self._lock = threading.Lock()
+
+    def _put(self, q, item):
+        start = time.time()
+        q.put(item)
+        return time.time() - start
+
+    def _get(self, q):
+        start = time.time()
+        depth = q.qsize()
+        return q.get(), depth, time.time() - start
+
+    def _fail(self, e):
+        with self._lock:
+            if self._error is None:
+                self._error = e
+        self._abort.set()
+        for q in self.queues:
+            q.abort()
+        if self.on_abort is not None:
+            self.on_abort()
+
+    def _ordered_inputs(self, index):
+        """Yield (seq, item) from the input queue of stage index, reordered if the producer had several workers."""
+        q = self.queues[index]
+        stats = self.stats[index]
+        reorder = index > 0 and self.stages[index - 1].num_workers > 1
+        pending = []
+        next_seq = 0
+        while True:
+            entry, depth, waited = self._get(q)
+            stats.record_get(depth, waited)
+            if entry is _STOP:
+                break
+            if not reorder:
+                yield entry
+                continue
+            heapq.heappush(pending, entry)
+            while pending and pending[0][0] == next_seq:
+                yield heapq.heappop(pending)
+                next_seq += 1
+        # anything left means a producer dropped a sequence number; keep the order anyway
+        while pending and not self._abort.is_set():
+            yield heapq.heappop(pending)
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        stats = self.stats[index]
+        out_q = self.queues[index + 1] if index + 1 < len(self.stages) else None
+        out_seq = 0
+        try:
+            for seq, item in self._ordered_inputs(index):
+                start = time.time()
+                result = stage.fn(seq, item)
+                if stage.expand:
+                    results = list(result) if result is not None else []
+                elif stage.num_workers > 1:
+                    results = [result]
+                else:
+                    results = [] if result is None else [result]
+                stats.record_call(time.time() - start)
+                if out_q is None:
+                    continue
+                for r in results:
+                    # single-worker stages renumber their outputs, parallel stages keep the input order key
+                    key = out_seq if stage.num_workers == 1 else seq
+                    stats.record_put(self._put(out_q, (key, r)))
+                    out_seq += 1
+                if self._abort.is_set():
+                    break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            with self._lock:
+                self._remaining[index] -= 1
+                last = self._remaining[index] == 0
+            if last and out_q is not None:
+                for _ in range(self.stages[index + 1].num_workers):
+                    self._put(out_q, _STOP)
+
+    def run(self, source):
+        """Push every item of source through the stages and block until the last stage is done."""
+        start_time = time.time()
+        threads = []
+        for index, stage in enumerate(self.stages):
+            # workers of one stage share its input queue
+            threads += [threading.Thread(target=self._worker, args=(index,), daemon=True)
+                        for _ in range(stage.num_workers)]
+        for t in threads:
+            t.start()
+
+        first_q = self.queues[0]
+        seq = 0
+        try:
+            it = iter(source)
+            while not self._abort.is_set():
+                start = time.time()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                self.source_stats.record_call(time.time() - start)
+                self.source_stats.record_put(self._put(first_q, (seq, item)))
+                seq += 1
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.stages[0].num_workers):
+                self._put(first_q, _STOP)
+            for t in threads:
+                t.join()
+            self.wall_time = time.time() - start_time
+
+        if self._error is not None:
+            raise self._error
+        return self.report()
+
+    def report(self):
+        """Per-stage counters and occupancy (busy time / (wall time * workers))."""
+        stages = {"source": self.source_stats.as_dict(self.wall_time)}
+        for stats in self.stats:
+            stages[stats.name] = stats.as_dict(self.wall_time)
+        return {"wall_time_s": round(self.wall_time, 4), "stages": stages}
@@ -7,11 +7,16 @@ import cv2
 import pickle
 import os
 import json
-from mmpose.apis import inference_topdown, init_model
-from mmpose.structures import merge_data_samples
+from mmpose.apis import init_model
 import torch
 from tqdm import tqdm
 
+from musetalk.utils.frame_source import FrameSource
+from musetalk.utils.face_boxes import (coord_placeholder, landmark_bboxes, landmark_bbox, is_valid_bbox,
+                                       coords_from_raw, add_fallback_boxes)
+from musetalk.utils.batch_landmarks import (dwpose_face_landmarks, dwpose_face_boxes, s3fd_face_boxes,
+                                            prefetch_batches, FaceTracker)
+
 # initialize the mmpose model
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 config_file = './musetalk/utils/dwpose/rtmpose-l_8xb32-270e_coco-ubody-wholebody-384x288.py'
@@ -22,8 +27,11 @@ model = init_model(config_file, checkpoint_file, device=device)
 device = "cuda" if torch.cuda.is_available() else "cpu"
 fa = FaceAlignment(LandmarksType._2D, flip_input=False,device=device)
 
-# maker if the bbox is not sufficient 
-coord_placeholder = (0.0,0.0,0.0,0.0)
+# frames per DWPose/S3FD forward
+DETECT_BATCH_SIZE = 4
+# "s3fd": S3FD checks every frame for a face; "dwpose": confident DWPose face
+# landmarks are trusted and S3FD only runs as a fallback
+DETECT_POLICIES = ("s3fd", "dwpose")
 
 def resize_landmark(landmark, w, h, new_w, new_h):
     w_ratio = new_w / w
@@ -33,110 +41,160 @@ def resize_landmark(landmark, w, h, new_w, new_h):
     return landmark_resized
 
 def read_imgs(img_list):
+    """Load a list of image paths; decoded frames (e.g. from a FrameSource) are passed through."""
     frames = []
     print('reading images...')
     for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
+        frame = cv2.imread(img_path) if isinstance(img_path, str) else img_path
         frames.append(frame)
     return frames
 
-def get_bbox_range(img_list,upperbondrange =0):
-    frames = read_imgs(img_list)
-    batch_size_fa = 1
-    batches = [frames[i:i + batch_size_fa] for i in range(0, len(frames), batch_size_fa)]
-    coords_list = []
-    landmarks = []
+def iter_frames(img_list):
+    """A FrameSource is streamed as is, anything else goes through read_imgs."""
+    if isinstance(img_list, FrameSource):
+        return img_list
+    return read_imgs(img_list)
+
+def iter_detections(frames, batch_size=DETECT_BATCH_SIZE, prefetch=2, detect_max_side=None, detect_refine=False,
+                    track_interval=0, detect_policy="s3fd", box_check=None):
+    """
+    (DWPose face landmarks, face box or None, whether S3FD gave the box) per frame.
+
+    Frames are read in a background thread and both detectors run on batches
+    of batch_size frames. S3FD searches frames larger than detect_max_side at
+    that size, see FaceAlignment.get_detections_for_batch. With track_interval,
+    S3FD only runs on keyframes and the boxes in between follow the landmarks,
+    see FaceTracker. With detect_policy "dwpose" the boxes come from the
+    landmarks and S3FD only runs on frames with low landmark scores or whose
+    landmarks fail box_check, see dwpose_face_boxes.
+    """
+    if detect_policy not in DETECT_POLICIES:
+        raise ValueError(f"unknown detect_policy {detect_policy!r}, expected one of {DETECT_POLICIES}")
+    tracker = FaceTracker(track_interval) if track_interval and detect_policy == "s3fd" else None
+    num_fallback = 0
+    with tqdm(total=len(frames)) as progress:
+        for fb in prefetch_batches(frames, batch_size, prefetch):
+            landmarks, scores = dwpose_face_landmarks(model, fb, return_scores=True)
+            from_s3fd = [True] * len(fb)
+            if detect_policy == "dwpose":
+                boxes, fallback = dwpose_face_boxes(fa, fb, landmarks, scores, box_check,
+                                                    max_side=detect_max_side, refine=detect_refine)
+                num_fallback += len(fallback)
+                from_s3fd = [j in fallback for j in range(len(fb))]
+            elif tracker is None:
+                boxes = s3fd_face_boxes(fa, fb, max_side=detect_max_side, refine=detect_refine)
+            else:
+                boxes = tracker.boxes(fa, fb, landmarks, scores, max_side=detect_max_side, refine=detect_refine)
+            for face_land_mark, f, s3fd_box in zip(landmarks, boxes, from_s3fd):
+                yield face_land_mark, f, s3fd_box
+            progress.update(len(fb))
+    if detect_policy == "dwpose":
+        print(f"S3FD fallback ran on {num_fallback} of {len(frames)} frames")
+
+def detect_raw_landmarks(img_list, batch_size=DETECT_BATCH_SIZE, detect_max_side=None, detect_refine=False,
+                         track_interval=0, detect_policy="s3fd", upperbondrange=0):
+    """
+    Raw detections of every frame and the frames.
+
+    The detections are a dict of DWPose face landmarks, face boxes, which
+    frames have a face and whether S3FD gave the box; none of it depends on
+    bbox_shift, so one run serves coords_from_raw and bbox_range_text for any
+    shift. The dwpose policy only runs S3FD where the landmark box is invalid
+    at upperbondrange, see add_fallback_boxes for other shifts. See
+    iter_detections for the detector settings.
+    """
+    frames = iter_frames(img_list)
+    raw = {"landmarks": [], "boxes": [], "has_face": [], "s3fd_box": []}
+    box_check = lambda face_land_mark: is_valid_bbox(landmark_bbox(face_land_mark, upperbondrange))
+    for face_land_mark, f, s3fd_box in iter_detections(frames, batch_size, detect_max_side=detect_max_side,
+                                                       detect_refine=detect_refine, track_interval=track_interval,
+                                                       detect_policy=detect_policy, box_check=box_check):
+        raw["landmarks"].append(face_land_mark)
+        raw["boxes"].append((0, 0, 0, 0) if f is None else f)
+        raw["has_face"].append(f is not None)
+        raw["s3fd_box"].append(s3fd_box)
+    return raw, frames
+
+def bbox_range_text(raw, upperbondrange=0):
+    """The bbox_shift adjustment range get_bbox_range reports, computed from raw detections."""
+    landmarks = np.asarray(raw["landmarks"]).reshape(-1, 68, 2)[np.asarray(raw["has_face"], dtype=bool)]
+    if len(landmarks) == 0:
+        return f"Total frame:「{len(raw['has_face'])}」 no face detected, bbox_shift cannot be adjusted"
+    range_minus = landmarks[:, 30, 1] - landmarks[:, 29, 1]
+    range_plus = landmarks[:, 29, 1] - landmarks[:, 28, 1]
+    return f"Total frame:「{len(raw['has_face'])}」 Manually adjust range : [ -{int(range_minus.sum() / len(range_minus))}~{int(range_plus.sum() / len(range_plus))} ] , the current value: {upperbondrange}"
+
+def print_bbox_range(raw, upperbondrange=0):
+    print("********************************************bbox_shift parameter adjustment**********************************************************")
+    print(bbox_range_text(raw, upperbondrange))
+    print("*************************************************************************************************************************************")
+
+def get_bbox_range(img_list,upperbondrange =0, batch_size=DETECT_BATCH_SIZE, detect_max_side=None, detect_refine=False,
+                   track_interval=0, detect_policy="s3fd"):
+    raw, _ = detect_raw_landmarks(img_list, batch_size, detect_max_side=detect_max_side, detect_refine=detect_refine,
+                                  track_interval=track_interval, detect_policy=detect_policy)
+    return bbox_range_text(raw, upperbondrange)
+
+
+def get_landmark_and_bbox(img_list,upperbondrange =0, return_raw=False, batch_size=DETECT_BATCH_SIZE,
+                          detect_max_side=None, detect_refine=False, track_interval=0, detect_policy="s3fd"):
+    """
+    Crop coordinates per frame (coord_placeholder without a face) and the frames.
+
+    With return_raw=True a third value holds the raw detections for a
+    LandmarkCache, see detect_raw_landmarks for them and the detector settings.
+    """
     if upperbondrange != 0:
         print('get key_landmark and face bounding boxes with the bbox_shift:',upperbondrange)
     else:
         print('get key_landmark and face bounding boxes with the default value')
-    average_range_minus = []
-    average_range_plus = []
-    for fb in tqdm(batches):
-        results = inference_topdown(model, np.asarray(fb)[0])
-        results = merge_data_samples(results)
-        keypoints = results.pred_instances.keypoints
-        face_land_mark= keypoints[0][23:91]
-        face_land_mark = face_land_mark.astype(np.int32)
-        
-        # get bounding boxes by face detetion
-        bbox = fa.get_detections_for_batch(np.asarray(fb))
-        
-        # adjust the bounding box refer to landmark
-        # Add the bounding box to a tuple and append it to the coordinates list
-        for j, f in enumerate(bbox):
-            if f is None: # no face in the image
-                coords_list += [coord_placeholder]
-                continue
-            
-            half_face_coord =  face_land_mark[29]#np.mean([face_land_mark[28], face_land_mark[29]], axis=0)
-            range_minus = (face_land_mark[30]- face_land_mark[29])[1]
-            range_plus = (face_land_mark[29]- face_land_mark[28])[1]
-            average_range_minus.append(range_minus)
-            average_range_plus.append(range_plus)
-            if upperbondrange != 0:
-                half_face_coord[1] = upperbondrange+half_face_coord[1] #手动调整  + 向下（偏29）  - 向上（偏28）
-
-    text_range=f"Total frame:「{len(frames)}」 Manually adjust range : [ -{int(sum(average_range_minus) / len(average_range_minus))}~{int(sum(average_range_plus) / len(average_range_plus))} ] , the current value: {upperbondrange}"
-    return text_range
-    
+    raw, frames = detect_raw_landmarks(img_list, batch_size, detect_max_side=detect_max_side,
+                                       detect_refine=detect_refine, track_interval=track_interval,
+                                       detect_policy=detect_policy, upperbondrange=upperbondrange)
+    coords_list = coords_from_raw(raw, upperbondrange)
+    print_bbox_range(raw, upperbondrange)
+    if return_raw:
+        return coords_list,frames,raw
+    return coords_list,frames
 
-def get_landmark_and_bbox(img_list,upperbondrange =0):
-    frames = read_imgs(img_list)
-    batch_size_fa = 1
-    batches = [frames[i:i + batch_size_fa] for i in range(0, len(frames), batch_size_fa)]
-    coords_list = []
-    landmarks = []
-    if upperbondrange != 0:
-        print('get key_landmark and face bounding boxes with the bbox_shift:',upperbondrange)
+
+def get_landmark_and_bbox_cached(img_list, upperbondrange=0, source_path=None, cache=None, return_raw=False,
+                                 batch_size=DETECT_BATCH_SIZE, detect_max_side=None, detect_refine=False,
+                                 track_interval=0, detect_policy="s3fd"):
+    """
+    get_landmark_and_bbox through a LandmarkCache keyed by the content of source_path.
+
+    Entries hold the raw detections, so a hit for any bbox_shift skips DWPose
+    and S3FD; only with the dwpose policy S3FD runs on frames whose landmark box
+    becomes invalid at a new shift, and the entry is updated with their boxes.
+    Without a cache or source_path this is get_landmark_and_bbox.
+    """
+    if cache is None or source_path is None:
+        return get_landmark_and_bbox(img_list, upperbondrange, return_raw=return_raw, batch_size=batch_size,
+                                     detect_max_side=detect_max_side, detect_refine=detect_refine,
+                                     track_interval=track_interval, detect_policy=detect_policy)
+    key = cache.key(source_path, detect_max_side=detect_max_side, detect_refine=detect_refine,
+                    track_interval=track_interval, detect_policy=detect_policy)
+    raw = cache.load(key)
+    if raw is None:
+        raw, frames = detect_raw_landmarks(img_list, batch_size, detect_max_side=detect_max_side,
+                                           detect_refine=detect_refine, track_interval=track_interval,
+                                           detect_policy=detect_policy, upperbondrange=upperbondrange)
+        cache.save(key, raw)
     else:
-        print('get key_landmark and face bounding boxes with the default value')
-    average_range_minus = []
-    average_range_plus = []
-    for fb in tqdm(batches):
-        results = inference_topdown(model, np.asarray(fb)[0])
-        results = merge_data_samples(results)
-        keypoints = results.pred_instances.keypoints
-        face_land_mark= keypoints[0][23:91]
-        face_land_mark = face_land_mark.astype(np.int32)
-        
-        # get bounding boxes by face detetion
-        bbox = fa.get_detections_for_batch(np.asarray(fb))
-        
-        # adjust the bounding box refer to landmark
-        # Add the bounding box to a tuple and append it to the coordinates list
-        for j, f in enumerate(bbox):
-            if f is None: # no face in the image
-                coords_list += [coord_placeholder]
-                continue
-            
-            half_face_coord =  face_land_mark[29]#np.mean([face_land_mark[28], face_land_mark[29]], axis=0)
-            range_minus = (face_land_mark[30]- face_land_mark[29])[1]
-            range_plus = (face_land_mark[29]- face_land_mark[28])[1]
-            average_range_minus.append(range_minus)
-            average_range_plus.append(range_plus)
-            if upperbondrange != 0:
-                half_face_coord[1] = upperbondrange+half_face_coord[1] #手动调整  + 向下（偏29）  - 向上（偏28）
-            half_face_dist = np.max(face_land_mark[:,1]) - half_face_coord[1]
-            min_upper_bond = 0
-            upper_bond = max(min_upper_bond, half_face_coord[1] - half_face_dist)
-            
-            f_landmark = (np.min(face_land_mark[:, 0]),int(upper_bond),np.max(face_land_mark[:, 0]),np.max(face_land_mark[:,1]))
-            x1, y1, x2, y2 = f_landmark
-            
-            if y2-y1<=0 or x2-x1<=0 or x1<0: # if the landmark bbox is not suitable, reuse the bbox
-                coords_list += [f]
-                w,h = f[2]-f[0], f[3]-f[1]
-                print("error bbox:",f)
-            else:
-                coords_list += [f_landmark]
-    
-    print("********************************************bbox_shift parameter adjustment**********************************************************")
-    print(f"Total frame:「{len(frames)}」 Manually adjust range : [ -{int(sum(average_range_minus) / len(average_range_minus))}~{int(sum(average_range_plus) / len(average_range_plus))} ] , the current value: {upperbondrange}")
-    print("*************************************************************************************************************************************")
+        print(f"using cached landmarks of {source_path}")
+        frames = iter_frames(img_list)
+        detect_fn = lambda fb: s3fd_face_boxes(fa, fb, max_side=detect_max_side, refine=detect_refine)
+        if add_fallback_boxes(raw, frames, upperbondrange, detect_fn) > 0:
+            cache.save(key, raw)
+    coords_list = coords_from_raw(raw, upperbondrange)
+    print_bbox_range(raw, upperbondrange)
+    if return_raw:
+        return coords_list,frames,raw
     return coords_list,frames
     
 
+    
 if __name__ == "__main__":
     img_list = ["./results/lyria/00000.png","./results/lyria/00001.png","./results/lyria/00002.png","./results/lyria/00003.png"]
     crop_coord_path = "./coord_face.pkl"
@@ -0,0 +1,129 @@
+import math
+
+import numpy as np
+
+
+def window_start(frame_idx, fps, sr=16000, context=2):
+    """First sample of the window window_db reads for video frame frame_idx."""
+    return max(0, int(round((frame_idx - context) * sr / fps)))
+
+
+def window_db(pcm, frame_idx, fps, sr=16000, context=2, offset=0):
+    """
+    RMS level in dBFS of the audio around video frame frame_idx, +-context frames.
+    pcm[0] is sample number offset of the stream.
+    """
+    start = window_start(frame_idx, fps, sr, context)
+    end = int(round((frame_idx + 1 + context) * sr / fps))
+    window = pcm[max(0, start - offset):max(0, end - offset)]
+    if len(window) == 0:
+        return -math.inf
+    rms = float(np.sqrt(np.mean(np.square(window, dtype=np.float64))))
+    return 20 * math.log10(max(rms, 1e-10))
+
+
+class PcmBuffer:
+    """
+    Audio received so far by a streaming session, kept for SilenceGate.update().
+
+    A float32 buffer that grows by doubling; trim() drops the samples before a
+    stream position so that only the part the gate can still read is kept.
+    view() starts at sample number offset of the stream.
+    """
+
+    def __init__(self, capacity=16000):
+        self.data = np.zeros(capacity, dtype=np.float32)
+        self.start = 0
+        self.end = 0
+        self.offset = 0
+
+    def append(self, pcm):
+        n = len(pcm)
+        if self.end + n > len(self.data):
+            size = self.end - self.start
+            if size + n > len(self.data):
+                data = np.zeros(max(2 * len(self.data), size + n), dtype=np.float32)
+            else:
+                data = self.data
+            data[:size] = self.data[self.start:self.end]
+            self.data, self.start, self.end = data, 0, size
+        self.data[self.end:self.end + n] = pcm
+        self.end += n
+
+    def trim(self, position):
+        """Drop the samples before stream position position."""
+        drop = min(position - self.offset, self.end - self.start)
+        if drop > 0:
+            self.start += drop
+            self.offset += drop
+
+    def view(self):
+        return self.data[self.start:self.end]
+
+
+class SilenceGate:
+    """
+    Causal voice-activity gate on the signal energy around each video frame.
+
+    update() returns a render weight per frame: 1 renders the frame normally,
+    0 marks it silent (UNet/VAE are skipped and the avatar frame is shown as
+    is) and values in between cross-fade the rendered face into the avatar
+    frame. A frame only counts as silent after min_silence_frames quiet frames
+    in a row, so pauses between words are still rendered, and the energy window
+    reaches `context` frames ahead so the mouth fades back in before speech.
+    """
+
+    def __init__(self, fps, threshold_db=-40.0, min_silence_frames=5, crossfade_frames=2, context=2, sr=16000):
+        self.fps = fps
+        self.threshold_db = threshold_db
+        self.min_silence_frames = min_silence_frames
+        self.crossfade_frames = crossfade_frames
+        self.context = context
+        self.sr = sr
+        self.silent_run = 0
+        self.weight = 1.0
+        self.num_frames = 0
+        self.num_skipped = 0
+        self.num_faded = 0
+
+    def update(self, pcm, frame_idx, offset=0):
+        """
+        Weight of frame frame_idx; frames must be passed in order and pcm must cover its window.
+        pcm may start at stream sample offset, see window_start() for the first sample it needs.
+        """
+        if window_db(pcm, frame_idx, self.fps, self.sr, self.context, offset) < self.threshold_db:
+            self.silent_run += 1
+        else:
+            self.silent_run = 0
+        target = 0.0 if self.silent_run >= self.min_silence_frames else 1.0
+        if self.crossfade_frames <= 0:
+            self.weight = target
+        elif target > self.weight:
+            self.weight = min(target, self.weight + 1.0 / self.crossfade_frames)
+        else:
+            self.weight = max(target, self.weight - 1.0 / self.crossfade_frames)
+
+        self.num_frames += 1
+        if self.weight == 0:
+            self.num_skipped += 1
+        elif self.weight < 1:
+            self.num_faded += 1
+        return self.weight
+
+    def window_start(self, frame_idx):
+        """
+        First sample update() reads for frame_idx, context frames before it. The
+        cross-fade only keeps the last weight, so earlier audio is never needed.
+        """
+        return window_start(frame_idx, self.fps, self.sr, self.context)
+
+    def weights(self, pcm, num_frames):
+        return np.array([self.update(pcm, i) for i in range(num_frames)], dtype=np.float32)
+
+    def stats(self):
+        return {
+            "frames": self.num_frames,
+            "skipped_frames": self.num_skipped,
+            "crossfaded_frames": self.num_faded,
+            "skipped_ratio": round(self.num_skipped / max(self.num_frames, 1), 4),
+        }
@@ -56,7 +56,11 @@ def datagen(
     whisper_batch, latent_batch = [], []
     for i, w in enumerate(whisper_chunks):
         idx = (i+delay_frame)%len(vae_encode_latents)
-        latent = vae_encode_latents[idx]
+        if isinstance(vae_encode_latents, torch.Tensor):
+            # stacked [N, 8, 32, 32] latents
+            latent = vae_encode_latents[idx:idx+1]
+        else:
+            latent = vae_encode_latents[idx]
         whisper_batch.append(w)
         latent_batch.append(latent)
 
@@ -73,6 +77,46 @@ def datagen(
 
         yield whisper_batch.to(device), latent_batch.to(device)
 
+def interleave_tracks(track_lengths):
+    """(track, frame index) for several tracks, frame-major: frame i of every track before frame i + 1."""
+    for i in range(max(track_lengths, default=0)):
+        for t, length in enumerate(track_lengths):
+            if i < length:
+                yield t, i
+
+def datagen_tracks(
+    tracks_whisper_chunks,
+    vae_encode_latents,
+    batch_size=8,
+    delay_frame=0,
+    device="cuda:0",
+):
+    """
+    datagen for several audio tracks driving the same latents.
+
+    The tracks are interleaved with interleave_tracks, so one batch mixes
+    tracks and their frames at the same position share a latent. Yields
+    (items, whisper_batch, latent_batch) with items the (track, frame index)
+    of every row.
+    """
+    items, whisper_batch, latent_batch = [], [], []
+    for t, i in interleave_tracks([len(chunks) for chunks in tracks_whisper_chunks]):
+        idx = (i+delay_frame)%len(vae_encode_latents)
+        if isinstance(vae_encode_latents, torch.Tensor):
+            latent = vae_encode_latents[idx:idx+1]
+        else:
+            latent = vae_encode_latents[idx]
+        items.append((t, i))
+        whisper_batch.append(tracks_whisper_chunks[t][i])
+        latent_batch.append(latent)
+
+        if len(latent_batch) >= batch_size:
+            yield items, torch.stack(whisper_batch).to(device), torch.cat(latent_batch, dim=0).to(device)
+            items, whisper_batch, latent_batch = [], [], []
+
+    if len(latent_batch) > 0:
+        yield items, torch.stack(whisper_batch).to(device), torch.cat(latent_batch, dim=0).to(device)
+
 def cast_training_params(
     model: Union[torch.nn.Module, List[torch.nn.Module]],
     dtype=torch.float32,
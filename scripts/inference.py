@@ -9,16 +9,22 @@ import pickle
 import argparse
 import numpy as np
 import subprocess
+import time
 from tqdm import tqdm
 from omegaconf import OmegaConf
 from transformers import WhisperModel
 import sys
 
-from musetalk.utils.blending import get_image
+from musetalk.utils.blending import (BlendingMaskCache, FrameCompositor, StillFrameCompositor,
+                                     get_image_prepare_material)
 from musetalk.utils.face_parsing import FaceParsing
 from musetalk.utils.audio_processor import AudioProcessor
-from musetalk.utils.utils import get_file_type, get_video_fps, datagen, load_all_model
-from musetalk.utils.preprocessing import get_landmark_and_bbox, read_imgs, coord_placeholder
+from musetalk.utils.frame_sink import open_frame_sink
+from musetalk.utils.frame_source import FrameWindow, open_frame_source, dump_frames
+from musetalk.utils.pipeline import Stage, StagedPipeline
+from musetalk.utils.utils import get_file_type, get_video_fps, datagen_tracks, interleave_tracks, load_all_model
+from musetalk.utils.landmark_cache import LandmarkCache, DEFAULT_LANDMARK_CACHE_DIR
+from musetalk.utils.preprocessing import get_landmark_and_bbox_cached, coord_placeholder
 
 def fast_check_ffmpeg():
     try:
@@ -27,6 +33,276 @@ def fast_check_ffmpeg():
     except:
         return False
 
+@torch.no_grad()
+def render_still_image(frame, bbox, tracks_whisper_chunks, sinks, vae, unet, pe, timesteps, fp, args):
+    """
+    Fast path for a single image: its one face box, latent and blending mask
+    serve every output frame. The latent batch is built once and reused by every
+    UNet call, and frames are composited through one precomputed ROI/alpha and
+    streamed to the sink of their track as they are decoded.
+    """
+    if bbox == coord_placeholder:
+        raise ValueError("no face detected in the source image")
+    x1, y1, x2, y2 = bbox
+    if args.version == "v15":
+        y2 = y2 + args.extra_margin
+        y2 = min(y2, frame.shape[0])
+    crop_frame = cv2.resize(frame[y1:y2, x1:x2], (256,256), interpolation=cv2.INTER_LANCZOS4)
+    latents = vae.get_latents_for_unet_batch([crop_frame])
+    latent_batch = latents.to(dtype=unet.model.dtype).repeat(args.batch_size, 1, 1, 1)
+
+    mode = args.parsing_mode if args.version == "v15" else "raw"
+    # blur_ratio of get_image, which the general path reproduces as well
+    mask_array, crop_box = get_image_prepare_material(frame, [x1, y1, x2, y2], fp=fp, mode=mode, blur_ratio=0.05)
+    compositor = StillFrameCompositor(frame, [x1, y1, x2, y2], mask_array, crop_box)
+
+    items = list(interleave_tracks([len(chunks) for chunks in tracks_whisper_chunks]))
+    for i in tqdm(range(0, len(items), args.batch_size)):
+        batch_items = items[i:i + args.batch_size]
+        whisper_batch = torch.stack([tracks_whisper_chunks[t][k] for t, k in batch_items])
+        audio_feature_batch = pe(whisper_batch)
+        pred_latents = unet.model(latent_batch[:len(whisper_batch)], timesteps,
+                                  encoder_hidden_states=audio_feature_batch).sample
+        for (t, _), res_frame in zip(batch_items, vae.decode_latents(pred_latents)):
+            res_frame = cv2.resize(res_frame.astype(np.uint8), (x2-x1, y2-y1))
+            sinks[t].write(compositor(res_frame))
+
+
+class InferenceTask:
+    """
+    One entry of the inference config on its way through main()'s pipeline:
+    prepare (decoding, landmarks, audio features and latents), render (UNet,
+    VAE and blending, streamed into the encoders) and finish (encoder flush).
+
+    audio_path may be a list of tracks (with result_name a list of the same
+    length). The video side is then prepared once and every track is written
+    to its own output.
+    """
+
+    def __init__(self, task_id, task_config, args):
+        self.task_id = str(task_id)
+        self.video_path = task_config["video_path"]
+        audio_paths = task_config["audio_path"]
+        self.audio_paths = [audio_paths] if isinstance(audio_paths, str) else list(audio_paths)
+        # Set bbox_shift based on version
+        if args.version == "v15":
+            self.bbox_shift = 0  # v15 uses fixed bbox_shift
+        else:
+            self.bbox_shift = task_config.get("bbox_shift", args.bbox_shift)  # v1 uses config or default
+
+        # Set output paths
+        input_basename = os.path.basename(self.video_path).split('.')[0]
+        self.temp_dir = os.path.join(args.result_dir, f"{args.version}")
+        self.source_frames_dir = os.path.join(self.temp_dir, input_basename)
+        result_names = task_config.get("result_name", args.output_vid_name)
+        if result_names is None or isinstance(result_names, str):
+            result_names = [result_names] * len(self.audio_paths)
+        self.result_img_save_paths = []
+        self.output_vid_names = []
+        for audio_path, output_vid_name in zip(self.audio_paths, result_names):
+            audio_basename = os.path.basename(audio_path).split('.')[0]
+            output_basename = f"{input_basename}_{audio_basename}"
+            self.result_img_save_paths.append(os.path.join(self.temp_dir, output_basename))
+            if output_vid_name is None:
+                self.output_vid_names.append(os.path.join(self.temp_dir, output_basename + ".mp4"))
+            else:
+                self.output_vid_names.append(os.path.join(self.temp_dir, output_vid_name))
+
+        self.source = None
+        self.sinks = []
+        self.fps = None
+        self.whisper_chunks = None  # one tensor per track
+        self.coord_list = None
+        self.input_latents = None
+        self.status = "pending"  # pending, done, failed
+        self.error = None
+        self.timings = {}
+        if len(list(result_names)) != len(self.audio_paths) or \
+                len(set(self.output_vid_names)) != len(self.output_vid_names):
+            self.status = "failed"
+            self.error = "result_name needs one distinct output name per audio track"
+
+    def run_step(self, name, fn, *args, **kwargs):
+        """Run one step, timing it and turning an exception into a failed task."""
+        if self.status == "failed":
+            return self
+        start = time.time()
+        try:
+            fn(self, *args, **kwargs)
+        except Exception as e:
+            print(f"Error occurred during processing {self.task_id}:", e)
+            self.status = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            self.release()
+        self.timings[name] = round(time.time() - start, 3)
+        return self
+
+    def release(self):
+        for resource in self.sinks + [self.source]:
+            if resource is not None:
+                try:
+                    resource.close()
+                except Exception as e:
+                    print(f"{self.task_id}: error while closing {type(resource).__name__}:", e)
+        self.sinks = []
+        self.source = None
+        self.whisper_chunks = self.input_latents = None
+
+
+def prepare_task(task, audio_processor, whisper, vae, device, weight_dtype, landmark_cache, args):
+    os.makedirs(task.temp_dir, exist_ok=True)
+
+    # Frames are decoded on demand, only a window of them is held in memory
+    if get_file_type(task.video_path) not in ("video", "image") and not os.path.isdir(task.video_path):
+        raise ValueError(f"{task.video_path} should be a video file, an image file or a directory of images")
+    task.source = open_frame_source(task.video_path, fps=args.fps)
+    task.fps = task.source.fps
+    if args.save_source_frames:
+        dump_frames(task.source, task.source_frames_dir)
+        print(f"Source frames saved to {task.source_frames_dir}")
+
+    # Extract audio features; the 30s segments of all tracks share the whisper batches
+    tracks = []
+    for audio_path in task.audio_paths:
+        audio_feature = audio_processor.get_audio_feature(audio_path)
+        if audio_feature is None:
+            raise FileNotFoundError(audio_path)
+        tracks.append(audio_feature)
+    task.whisper_chunks = audio_processor.get_whisper_chunks(
+        tracks,
+        device,
+        weight_dtype,
+        whisper,
+        fps=task.fps,
+        audio_padding_length_left=args.audio_padding_length_left,
+        audio_padding_length_right=args.audio_padding_length_right,
+        batch_size=args.whisper_batch_size,
+    )
+
+    # Preprocess input images; known videos are served from the landmark cache
+    task.coord_list, _ = get_landmark_and_bbox_cached(task.source, task.bbox_shift, source_path=task.video_path,
+                                                      cache=landmark_cache, batch_size=args.detect_batch_size,
+                                                      detect_max_side=args.detect_max_side,
+                                                      detect_refine=args.detect_refine,
+                                                      track_interval=args.track_interval,
+                                                      detect_policy=args.detect_policy)
+    # the detected frames, the container's frame count is only an estimate
+    print(f"Number of frames: {len(task.coord_list)}")
+    if get_file_type(task.video_path) == "image":
+        return
+
+    # Crop every frame and encode the crops in batches
+    def face_crops():
+        for bbox, frame in zip(task.coord_list, task.source):
+            if bbox == coord_placeholder:
+                continue
+            x1, y1, x2, y2 = bbox
+            if args.version == "v15":
+                y2 = y2 + args.extra_margin
+                y2 = min(y2, frame.shape[0])
+            crop_frame = frame[y1:y2, x1:x2]
+            yield cv2.resize(crop_frame, (256,256), interpolation=cv2.INTER_LANCZOS4)
+    task.input_latents = vae.get_latents_for_unet_batch(face_crops(), batch_size=args.vae_batch_size)
+
+
+def render_task(task, vae, unet, pe, timesteps, fp, device, args):
+    # one encoder per track, all fed while the tracks render together
+    for audio_path, output_vid_name, result_img_save_path in zip(
+            task.audio_paths, task.output_vid_names, task.result_img_save_paths):
+        task.sinks.append(open_frame_sink(
+            output_vid_name,
+            fps=task.fps,
+            audio_path=audio_path,
+            png_dir=result_img_save_path if args.save_png_frames else None,
+        ))
+    coord_list = task.coord_list
+    if get_file_type(task.video_path) == "image":
+        print("Single image: rendering with the still-image fast path")
+        render_still_image(task.source[0], coord_list[0], task.whisper_chunks, task.sinks,
+                           vae, unet, pe, timesteps, fp, args)
+        return
+
+    # Smooth first and last frames
+    input_latent_list_cycle = torch.cat([task.input_latents, task.input_latents.flip(0)], dim=0)
+    num_source_frames = len(coord_list)
+
+    def source_index(i):
+        # position in frame_list + frame_list[::-1]
+        i = i % (2 * num_source_frames)
+        return i if i < num_source_frames else 2 * num_source_frames - 1 - i
+
+    def blend_box(j, frame):
+        x1, y1, x2, y2 = coord_list[j]
+        if args.version == "v15":
+            y2 = y2 + args.extra_margin
+            y2 = min(y2, frame.shape[0])
+        return [x1, y1, x2, y2]
+
+    # Batch inference; the tracks are interleaved frame by frame so they share
+    # source frames and masks, and every decoded batch is blended and handed
+    # to the encoders right away, so nothing grows with the clip length
+    print(f"Starting inference of {task.task_id} ({len(task.audio_paths)} audio tracks)")
+    video_num = sum(len(chunks) for chunks in task.whisper_chunks)
+    batch_size = args.batch_size
+    gen = datagen_tracks(
+        tracks_whisper_chunks=task.whisper_chunks,
+        vae_encode_latents=input_latent_list_cycle,
+        batch_size=batch_size,
+        delay_frame=0,
+        device=device,
+    )
+    frame_list = FrameWindow(task.source, size=max(args.source_window, batch_size))
+    mask_cache = BlendingMaskCache(fp, mode=args.parsing_mode if args.version == "v15" else "raw",
+                                   max_bytes=args.mask_cache_mb * 1024 * 1024)
+    compositor = FrameCompositor()
+    total = int(np.ceil(float(video_num) / batch_size))
+    for items, whisper_batch, latent_batch in tqdm(gen, total=total):
+        audio_feature_batch = pe(whisper_batch)
+        latent_batch = latent_batch.to(dtype=unet.model.dtype)
+        
+        pred_latents = unet.model(latent_batch, timesteps, encoder_hidden_states=audio_feature_batch).sample
+        recon = vae.decode_latents(pred_latents)
+
+        # Parse the source frames of this batch that are not cached yet in one call
+        mask_items = []
+        for _, i in items:
+            j = source_index(i)
+            if coord_list[j] != coord_placeholder:
+                mask_items.append((j, frame_list[j], blend_box(j, frame_list[j])))
+        mask_cache.prepare(mask_items)
+
+        for (t, i), res_frame in zip(items, recon):
+            j = source_index(i)
+            ori_frame = frame_list[j]
+            x1, y1, x2, y2 = blend_box(j, ori_frame)
+            try:
+                res_frame = cv2.resize(res_frame.astype(np.uint8), (x2-x1, y2-y1))
+            except:
+                continue
+
+            # Merge results with the cached mask of this source frame
+            mask_array, crop_box = mask_cache.get(j, ori_frame, [x1, y1, x2, y2])
+            combine_frame = compositor(ori_frame, res_frame, [x1, y1, x2, y2], mask_array, crop_box)
+            task.sinks[t].write(combine_frame)
+
+
+def finish_task(task, args):
+    # closing a sink waits for ffmpeg to encode the frames still in its pipe
+    sinks, task.sinks = task.sinks, []
+    errors = []
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception as e:
+            errors.append(e)
+    task.release()
+    if errors:
+        raise errors[0]
+    task.status = "done"
+    for output_vid_name in task.output_vid_names:
+        print(f"Results saved to {output_vid_name}")
+
+
 @torch.no_grad()
 def main(args):
     # Configure ffmpeg path
@@ -79,174 +355,46 @@ def main(args):
     # Load inference configuration
     inference_config = OmegaConf.load(args.inference_config)
     print("Loaded inference config:", inference_config)
-    
-    # Process each task
-    for task_id in inference_config:
-        try:
-            # Get task configuration
-            video_path = inference_config[task_id]["video_path"]
-            audio_path = inference_config[task_id]["audio_path"]
-            if "result_name" in inference_config[task_id]:
-                args.output_vid_name = inference_config[task_id]["result_name"]
-            
-            # Set bbox_shift based on version
-            if args.version == "v15":
-                bbox_shift = 0  # v15 uses fixed bbox_shift
-            else:
-                bbox_shift = inference_config[task_id].get("bbox_shift", args.bbox_shift)  # v1 uses config or default
-            
-            # Set output paths
-            input_basename = os.path.basename(video_path).split('.')[0]
-            audio_basename = os.path.basename(audio_path).split('.')[0]
-            output_basename = f"{input_basename}_{audio_basename}"
-            
-            # Create temporary directories
-            temp_dir = os.path.join(args.result_dir, f"{args.version}")
-            os.makedirs(temp_dir, exist_ok=True)
-            
-            # Set result save paths
-            result_img_save_path = os.path.join(temp_dir, output_basename)
-            crop_coord_save_path = os.path.join(args.result_dir, "../", input_basename+".pkl")
-            os.makedirs(result_img_save_path, exist_ok=True)
-            
-            # Set output video paths
-            if args.output_vid_name is None:
-                output_vid_name = os.path.join(temp_dir, output_basename + ".mp4")
-            else:
-                output_vid_name = os.path.join(temp_dir, args.output_vid_name)
-            output_vid_name_concat = os.path.join(temp_dir, output_basename + "_concat.mp4")
-            
-            # Extract frames from source video
-            if get_file_type(video_path) == "video":
-                save_dir_full = os.path.join(temp_dir, input_basename)
-                os.makedirs(save_dir_full, exist_ok=True)
-                cmd = f"ffmpeg -v fatal -i {video_path} -start_number 0 {save_dir_full}/%08d.png"
-                os.system(cmd)
-                input_img_list = sorted(glob.glob(os.path.join(save_dir_full, '*.[jpJP][pnPN]*[gG]')))
-                fps = get_video_fps(video_path)
-            elif get_file_type(video_path) == "image":
-                input_img_list = [video_path]
-                fps = args.fps
-            elif os.path.isdir(video_path):
-                input_img_list = glob.glob(os.path.join(video_path, '*.[jpJP][pnPN]*[gG]'))
-                input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                fps = args.fps
-            else:
-                raise ValueError(f"{video_path} should be a video file, an image file or a directory of images")
-
-            # Extract audio features
-            whisper_input_features, librosa_length = audio_processor.get_audio_feature(audio_path)
-            whisper_chunks = audio_processor.get_whisper_chunk(
-                whisper_input_features, 
-                device, 
-                weight_dtype, 
-                whisper, 
-                librosa_length,
-                fps=fps,
-                audio_padding_length_left=args.audio_padding_length_left,
-                audio_padding_length_right=args.audio_padding_length_right,
-            )
-            
-            # Preprocess input images
-            if os.path.exists(crop_coord_save_path) and args.use_saved_coord:
-                print("Using saved coordinates")
-                with open(crop_coord_save_path, 'rb') as f:
-                    coord_list = pickle.load(f)
-                frame_list = read_imgs(input_img_list)
-            else:
-                print("Extracting landmarks... time-consuming operation")
-                coord_list, frame_list = get_landmark_and_bbox(input_img_list, bbox_shift)
-                with open(crop_coord_save_path, 'wb') as f:
-                    pickle.dump(coord_list, f)
-            
-            print(f"Number of frames: {len(frame_list)}")         
-            
-            # Process each frame
-            input_latent_list = []
-            for bbox, frame in zip(coord_list, frame_list):
-                if bbox == coord_placeholder:
-                    continue
-                x1, y1, x2, y2 = bbox
-                if args.version == "v15":
-                    y2 = y2 + args.extra_margin
-                    y2 = min(y2, frame.shape[0])
-                crop_frame = frame[y1:y2, x1:x2]
-                crop_frame = cv2.resize(crop_frame, (256,256), interpolation=cv2.INTER_LANCZOS4)
-                latents = vae.get_latents_for_unet(crop_frame)
-                input_latent_list.append(latents)
-        
-            # Smooth first and last frames
-            frame_list_cycle = frame_list + frame_list[::-1]
-            coord_list_cycle = coord_list + coord_list[::-1]
-            input_latent_list_cycle = input_latent_list + input_latent_list[::-1]
-            
-            # Batch inference
-            print("Starting inference")
-            video_num = len(whisper_chunks)
-            batch_size = args.batch_size
-            gen = datagen(
-                whisper_chunks=whisper_chunks,
-                vae_encode_latents=input_latent_list_cycle,
-                batch_size=batch_size,
-                delay_frame=0,
-                device=device,
-            )
-            
-            res_frame_list = []
-            total = int(np.ceil(float(video_num) / batch_size))
-            
-            # Execute inference
-            for i, (whisper_batch, latent_batch) in enumerate(tqdm(gen, total=total)):
-                audio_feature_batch = pe(whisper_batch)
-                latent_batch = latent_batch.to(dtype=unet.model.dtype)
-                
-                pred_latents = unet.model(latent_batch, timesteps, encoder_hidden_states=audio_feature_batch).sample
-                recon = vae.decode_latents(pred_latents)
-                for res_frame in recon:
-                    res_frame_list.append(res_frame)
-            
-            # Pad generated images to original video size
-            print("Padding generated images to original video size")
-            for i, res_frame in enumerate(tqdm(res_frame_list)):
-                bbox = coord_list_cycle[i%(len(coord_list_cycle))]
-                ori_frame = copy.deepcopy(frame_list_cycle[i%(len(frame_list_cycle))])
-                x1, y1, x2, y2 = bbox
-                if args.version == "v15":
-                    y2 = y2 + args.extra_margin
-                    y2 = min(y2, frame.shape[0])
-                try:
-                    res_frame = cv2.resize(res_frame.astype(np.uint8), (x2-x1, y2-y1))
-                except:
-                    continue
-                
-                # Merge results with version-specific parameters
-                if args.version == "v15":
-                    combine_frame = get_image(ori_frame, res_frame, [x1, y1, x2, y2], mode=args.parsing_mode, fp=fp)
-                else:
-                    combine_frame = get_image(ori_frame, res_frame, [x1, y1, x2, y2], fp=fp)
-                cv2.imwrite(f"{result_img_save_path}/{str(i).zfill(8)}.png", combine_frame)
-
-            # Save prediction results
-            temp_vid_path = f"{temp_dir}/temp_{input_basename}_{audio_basename}.mp4"
-            cmd_img2video = f"ffmpeg -y -v warning -r {fps} -f image2 -i {result_img_save_path}/%08d.png -vcodec libx264 -vf format=yuv420p -crf 18 {temp_vid_path}"
-            print("Video generation command:", cmd_img2video)
-            os.system(cmd_img2video)   
-            
-            cmd_combine_audio = f"ffmpeg -y -v warning -i {audio_path} -i {temp_vid_path} {output_vid_name}"
-            print("Audio combination command:", cmd_combine_audio) 
-            os.system(cmd_combine_audio)
-            
-            # Clean up temporary files
-            shutil.rmtree(result_img_save_path)
-            os.remove(temp_vid_path)
-            
-            shutil.rmtree(save_dir_full)
-            if not args.saved_coord:
-                os.remove(crop_coord_save_path)
-                    
-            print(f"Results saved to {output_vid_name}")
-        except Exception as e:
-            print("Error occurred during processing:", e)
+
+    landmark_cache = LandmarkCache(args.landmark_cache_dir) if args.landmark_cache_dir else None
+    tasks = []
+
+    def source():
+        for task_id in inference_config:
+            task = InferenceTask(task_id, inference_config[task_id], args)
+            tasks.append(task)
+            yield task
+
+    @torch.no_grad()
+    def prepare(seq, task):
+        return task.run_step("prepare", prepare_task, audio_processor, whisper, vae, device, weight_dtype,
+                             landmark_cache, args)
+
+    @torch.no_grad()
+    def render(seq, task):
+        return task.run_step("render", render_task, vae, unet, pe, timesteps, fp, device, args)
+
+    # The models are loaded once for all tasks. While one task renders on the
+    # GPU the next one is decoded, detected and its audio encoded, and up to
+    # encode_workers finished tasks wait for ffmpeg to flush their output.
+    pipeline = StagedPipeline([
+        Stage("prepare", prepare, queue_size=args.prefetch_tasks),
+        Stage("render", render, queue_size=args.prefetch_tasks),
+        Stage("finish", lambda seq, task: task.run_step("finish", finish_task, args),
+              num_workers=args.encode_workers, queue_size=args.encode_workers),
+    ])
+    start_time = time.time()
+    pipeline.run(source())
+    elapsed = time.time() - start_time
+
+    print(f"{'task':<16} {'status':<7} {'total_s':>8}  steps")
+    for task in tasks:
+        steps = " ".join(f"{name}={t:.1f}s" for name, t in task.timings.items())
+        print(f"{task.task_id:<16} {task.status:<7} {sum(task.timings.values()):>8.1f}  {steps}")
+        if task.error is not None:
+            print(f"    {task.error}")
+    failed = [task for task in tasks if task.status == "failed"]
+    print(f"{len(tasks)} tasks in {elapsed:.1f}s, {len(failed)} failed")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -264,9 +412,28 @@ if __name__ == "__main__":
     parser.add_argument("--audio_padding_length_left", type=int, default=2, help="Left padding length for audio")
     parser.add_argument("--audio_padding_length_right", type=int, default=2, help="Right padding length for audio")
     parser.add_argument("--batch_size", type=int, default=8, help="Batch size for inference")
+    parser.add_argument("--source_window", type=int, default=32, help="Source frames kept decoded while blending")
+    parser.add_argument("--mask_cache_mb", type=int, default=256, help="Memory budget for cached blending masks")
+    parser.add_argument("--whisper_batch_size", type=int, default=8, help="30s audio segments per whisper encoder call, across tracks")
+    parser.add_argument("--vae_batch_size", type=int, default=32, help="Face crops per VAE encoder call")
     parser.add_argument("--output_vid_name", type=str, default=None, help="Name of output video file")
-    parser.add_argument("--use_saved_coord", action="store_true", help='Use saved coordinates to save time')
-    parser.add_argument("--saved_coord", action="store_true", help='Save coordinates for future use')
+    parser.add_argument("--detect_batch_size", type=int, default=4, help="Frames per DWPose/S3FD forward during face detection")
+    parser.add_argument("--detect_max_side", type=int, default=0,
+                        help="Run S3FD on frames downscaled to this longer side, e.g. 640 for HD sources; 0 for full resolution")
+    parser.add_argument("--detect_refine", action="store_true",
+                        help="Refine downscaled face boxes with a second S3FD pass around each face")
+    parser.add_argument("--track_interval", type=int, default=0,
+                        help="Run S3FD only every N frames (or on drift) and track the face box in between; 0 to detect every frame")
+    parser.add_argument("--detect_policy", type=str, default="s3fd", choices=["s3fd", "dwpose"],
+                        help="s3fd: check every frame for a face with S3FD; dwpose: trust confident DWPose landmarks, S3FD as fallback")
+    parser.add_argument("--landmark_cache_dir", type=str, default=DEFAULT_LANDMARK_CACHE_DIR,
+                        help="Cache of detected landmarks keyed by video content and detector settings; empty to disable")
+    parser.add_argument("--use_saved_coord", action="store_true", help='Deprecated, coordinates are always reused from --landmark_cache_dir')
+    parser.add_argument("--saved_coord", action="store_true", help='Deprecated, coordinates are always saved to --landmark_cache_dir')
+    parser.add_argument("--save_png_frames", action="store_true", help="Also dump every result frame as PNG for debugging")
+    parser.add_argument("--save_source_frames", action="store_true", help="Also dump the decoded source frames as PNG for debugging")
+    parser.add_argument("--prefetch_tasks", type=int, default=1, help="Tasks prepared ahead of the one being rendered")
+    parser.add_argument("--encode_workers", type=int, default=2, help="Finished tasks whose encoders are flushed in parallel")
     parser.add_argument("--use_float16", action="store_true", help="Use float16 for faster inference")
     parser.add_argument("--parsing_mode", default='jaw', help="Face blending parsing mode")
     parser.add_argument("--left_cheek_width", type=int, default=90, help="Width of left cheek region")
@@ -0,0 +1,178 @@
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import threading
+
+import torch
+from omegaconf import OmegaConf
+
+from musetalk.models.vae import VAE
+from musetalk.utils.face_parsing import FaceParsing
+from musetalk.utils.pipeline import Stage, StagedPipeline
+from musetalk.utils.landmark_cache import LandmarkCache, DEFAULT_LANDMARK_CACHE_DIR
+from musetalk.utils.avatar_prep import (AvatarJob, PREPARE_POLICIES, apply_policy, extract_frames,
+                                        detect_faces, encode_latents, parse_masks, write_store)
+
+
+def load_manifest(manifest_path):
+    """
+    Read (avatar_id, video_path, bbox_shift) entries.
+
+    A .csv manifest needs avatar_id,video_path[,bbox_shift] columns; anything
+    else is loaded with OmegaConf as a mapping avatar_id -> {video_path, bbox_shift},
+    so configs/inference/realtime.yaml works as a manifest too.
+    """
+    entries = []
+    if manifest_path.endswith(".csv"):
+        with open(manifest_path, newline="") as f:
+            for row in csv.DictReader(f):
+                entries.append((row["avatar_id"], row["video_path"], int(row.get("bbox_shift") or 0)))
+        return entries
+    manifest = OmegaConf.load(manifest_path)
+    for avatar_id in manifest:
+        entries.append((str(avatar_id), manifest[avatar_id]["video_path"],
+                        int(manifest[avatar_id].get("bbox_shift", 0))))
+    return entries
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(f"cuda:{args.gpu_id}" if torch.cuda.is_available() else "cpu")
+    # same precision as scripts/realtime_inference.py so the latents match
+    vae = VAE(model_path=os.path.join("models", args.vae_type))
+    vae.vae = vae.vae.half().to(device)
+    if args.version == "v15":
+        fp = FaceParsing(
+            left_cheek_width=args.left_cheek_width,
+            right_cheek_width=args.right_cheek_width
+        )
+        mode = args.parsing_mode
+        extra_margin = args.extra_margin
+    else:  # v1
+        fp = FaceParsing()
+        mode = "raw"
+        extra_margin = None
+
+    landmark_cache = LandmarkCache(args.landmark_cache_dir) if args.landmark_cache_dir else None
+    jobs = []
+    # a job holds its whole decoded clip from frame extraction until the store
+    # is written, so only max_inflight of them are admitted at a time
+    inflight = threading.BoundedSemaphore(args.max_inflight)
+    holding = set()
+
+    def source():
+        for avatar_id, video_path, bbox_shift in load_manifest(args.manifest):
+            if args.version == "v15":
+                bbox_shift = 0  # v15 uses fixed bbox_shift
+            job = AvatarJob(avatar_id, video_path, bbox_shift, args.version)
+            jobs.append(job)
+            job.run_step("policy", apply_policy, args.policy)
+            print(f"{avatar_id}: {job.status}")
+            if not job.done:
+                inflight.acquire()
+                holding.add(id(job))
+            yield job
+
+    @torch.no_grad()
+    def run_vae(seq, job):
+        return job.run_step("vae", encode_latents, vae, extra_margin=extra_margin, batch_size=args.vae_batch_size)
+
+    @torch.no_grad()
+    def run_parse(seq, job):
+        return job.run_step("parse", parse_masks, fp, mode=mode, batch_size=args.parse_batch_size)
+
+    def run_store(seq, job):
+        try:
+            return job.run_step("store", write_store)
+        finally:
+            if id(job) in holding:
+                holding.discard(id(job))
+                inflight.release()
+
+    # one avatar per item: the GPU-bound detection and VAE stages run on one
+    # thread each while frame extraction and face parsing use worker pools, so
+    # consecutive avatars overlap. Queues are short and max_inflight bounds the
+    # avatars in flight because an item holds a whole clip.
+    pipeline = StagedPipeline([
+        Stage("frames", lambda seq, job: job.run_step("frames", extract_frames),
+              num_workers=args.frame_workers, queue_size=args.queue_size),
+        Stage("detect", lambda seq, job: job.run_step("detect", detect_faces, landmark_cache=landmark_cache,
+                                                          batch_size=args.detect_batch_size,
+                                                          max_side=args.detect_max_side,
+                                                          refine=args.detect_refine,
+                                                          track_interval=args.track_interval,
+                                                          policy=args.detect_policy),
+              queue_size=args.queue_size),
+        Stage("vae", run_vae, queue_size=args.queue_size),
+        Stage("parse", run_parse, num_workers=args.parse_workers, queue_size=args.queue_size),
+        Stage("store", run_store, queue_size=args.queue_size),
+    ])
+    start_time = time.time()
+    pipeline_report = pipeline.run(source())
+    elapsed = time.time() - start_time
+
+    print(f"{'avatar':<24} {'status':<9} {'total_s':>8}  steps")
+    for job in jobs:
+        steps = " ".join(f"{name}={t:.1f}s" for name, t in job.timings.items() if name != "policy")
+        print(f"{job.avatar_id:<24} {job.status:<9} {sum(job.timings.values()):>8.1f}  {steps}")
+        if job.error is not None:
+            print(f"    {job.error}")
+    failed = [job for job in jobs if job.status == "failed"]
+    print(f"{len(jobs)} avatars in {elapsed:.1f}s, {len(failed)} failed")
+
+    if args.report:
+        report = {
+            "wall_time_s": round(elapsed, 3),
+            "avatars": [{"avatar_id": job.avatar_id, "status": job.status, "error": job.error,
+                         "timings_s": job.timings} for job in jobs],
+            "stages": pipeline_report["stages"],
+        }
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"report is save to {args.report}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    '''
+    Prepare avatars for scripts/realtime_inference.py in bulk, without prompts:
+
+    python -m scripts.prepare_avatars --manifest avatars.yaml --policy resume
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", type=str, required=True,
+                        help="YAML/JSON mapping avatar_id -> {video_path, bbox_shift}, or a CSV with those columns")
+    parser.add_argument("--policy", type=str, default="resume", choices=PREPARE_POLICIES,
+                        help="resume: keep finished avatars and continue partial ones, rebuilding those whose settings changed; "
+                             "rebuild: prepare everything from scratch; skip: leave existing avatars untouched")
+    parser.add_argument("--version", type=str, default="v15", choices=["v1", "v15"], help="Version of MuseTalk: v1 or v15")
+    parser.add_argument("--gpu_id", type=int, default=0, help="GPU ID to use")
+    parser.add_argument("--vae_type", type=str, default="sd-vae", help="Type of VAE model")
+    parser.add_argument("--extra_margin", type=int, default=10, help="Extra margin for face cropping")
+    parser.add_argument("--parsing_mode", default='jaw', help="Face blending parsing mode")
+    parser.add_argument("--left_cheek_width", type=int, default=90, help="Width of left cheek region")
+    parser.add_argument("--right_cheek_width", type=int, default=90, help="Width of right cheek region")
+    parser.add_argument("--detect_batch_size", type=int, default=4, help="Frames per DWPose/S3FD forward during face detection")
+    parser.add_argument("--detect_max_side", type=int, default=0,
+                        help="Run S3FD on frames downscaled to this longer side, e.g. 640 for HD sources; 0 for full resolution")
+    parser.add_argument("--detect_refine", action="store_true",
+                        help="Refine downscaled face boxes with a second S3FD pass around each face")
+    parser.add_argument("--track_interval", type=int, default=0,
+                        help="Run S3FD only every N frames (or on drift) and track the face box in between; 0 to detect every frame")
+    parser.add_argument("--detect_policy", type=str, default="s3fd", choices=["s3fd", "dwpose"],
+                        help="s3fd: check every frame for a face with S3FD; dwpose: trust confident DWPose landmarks, S3FD as fallback")
+    parser.add_argument("--landmark_cache_dir", type=str, default=DEFAULT_LANDMARK_CACHE_DIR,
+                        help="Cache of detected landmarks keyed by video content and detector settings; empty to disable")
+    parser.add_argument("--vae_batch_size", type=int, default=32, help="Face crops per VAE encoder call")
+    parser.add_argument("--parse_batch_size", type=int, default=16, help="Face crops per face parsing call")
+    parser.add_argument("--frame_workers", type=int, default=2, help="Threads extracting source frames")
+    parser.add_argument("--parse_workers", type=int, default=2, help="Threads running face parsing")
+    parser.add_argument("--queue_size", type=int, default=1, help="Avatars buffered between preparation stages")
+    parser.add_argument("--max_inflight", type=int, default=3,
+                        help="Avatars between frame extraction and store writing at once; each holds its decoded clip in RAM")
+    parser.add_argument("--report", type=str, default=None, help="Write per-avatar preparation times to this JSON file")
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -10,8 +10,8 @@ import decord
 import json
 import cv2
 from musetalk.utils.face_detection import FaceAlignment,LandmarksType
-from mmpose.apis import inference_topdown, init_model
-from mmpose.structures import merge_data_samples
+from mmpose.apis import init_model
+from musetalk.utils.batch_landmarks import dwpose_face_landmarks, s3fd_face_boxes, prefetch_batches, FaceTracker
 import sys
 
 def fast_check_ffmpeg():
@@ -44,30 +44,35 @@ class AnalyzeFace:
         self.dwpose = init_model(config_file, checkpoint_file, device=self.device)
         self.facedet = FaceAlignment(LandmarksType._2D, flip_input=False, device=self.device)
 
-    def __call__(self, im: np.ndarray) -> Tuple[List[np.ndarray], np.ndarray]:
+    def __call__(self, im: np.ndarray, tracker: FaceTracker = None) -> Tuple[np.ndarray, List]:
         """
-        Detect faces and keypoints in the given image.
+        Detect faces and keypoints in the given image or batch of images.
 
         Parameters:
-        im (np.ndarray): The input image.
-        maxface (bool): Whether to detect the maximum face. Default is True.
+        im (np.ndarray): The input image (H, W, C) or a batch of images (B, H, W, C).
+        tracker (FaceTracker): Tracks the face boxes of consecutive batches of one
+        video, running the face detector only on keyframes. Default is None.
 
         Returns:
-        Tuple[List[np.ndarray], np.ndarray]: A tuple containing the bounding boxes and keypoints.
+        Tuple[np.ndarray, List]: The face keypoints ([68, 2] for an image, [B, 68, 2]
+        for a batch) and the face bounding box (or None) of every image.
         """
         try:
             # Ensure the input image has the correct shape
-            if im.ndim == 3:
+            single = im.ndim == 3
+            if single:
                 im = np.expand_dims(im, axis=0)
-            elif im.ndim != 4 or im.shape[0] != 1:
-                raise ValueError("Input image must have shape (1, H, W, C)")
+            elif im.ndim != 4:
+                raise ValueError("Input image must have shape (H, W, C) or (B, H, W, C)")
             
-            bbox = self.facedet.get_detections_for_batch(np.asarray(im))
-            results = inference_topdown(self.dwpose, np.asarray(im)[0])
-            results = merge_data_samples(results)
-            keypoints = results.pred_instances.keypoints
-            face_land_mark= keypoints[0][23:91]
-            face_land_mark = face_land_mark.astype(np.int32)
+            landmarks, scores = dwpose_face_landmarks(self.dwpose, list(np.asarray(im)), return_scores=True)
+            if tracker is None:
+                bbox = s3fd_face_boxes(self.facedet, np.asarray(im))
+            else:
+                bbox = tracker.boxes(self.facedet, np.asarray(im), landmarks, scores)
+            face_land_mark = np.stack(landmarks)
+            if single:
+                face_land_mark = face_land_mark[0]
 
             return face_land_mark, bbox
         
@@ -204,7 +209,8 @@ def generate_train_list(cfg):
 
     print(val_list_hdtf)    
 
-def analyze_video(org_path: str, dst_path: str, vid_list: List[str]) -> None:
+def analyze_video(org_path: str, dst_path: str, vid_list: List[str], batch_size: int = 8,
+                  track_interval: int = 0) -> None:
     """
     Convert video files to a specified format and save them to the destination path.
 
@@ -212,6 +218,9 @@ def analyze_video(org_path: str, dst_path: str, vid_list: List[str]) -> None:
     org_path (str): The directory containing the original video files.
     dst_path (str): The directory where the meta json will be saved.
     vid_list (List[str]): A list of video file names to process.
+    batch_size (int): Frames analyzed per DWPose/S3FD forward. Default is 8.
+    track_interval (int): Run the face detector every track_interval frames and
+    track the face in between, see FaceTracker. Default is 0, detect every frame.
 
     Returns:
     None
@@ -245,35 +254,44 @@ def analyze_video(org_path: str, dst_path: str, vid_list: List[str]) -> None:
                 continue
 
             total_frames = len(cap)
-            for frame_idx in range(total_frames):
-                frame = cap[frame_idx]
+            # frames are decoded in a background thread while the previous batch is analyzed
+            frames = (cv2.cvtColor(cap[frame_idx].asnumpy(), cv2.COLOR_BGR2RGB) for frame_idx in range(total_frames))
+            batches = prefetch_batches(frames, batch_size)
+            tracker = FaceTracker(track_interval) if track_interval else None
+            frame_idx = 0
+            for batch in batches:
                 if frame_idx==0:
-                    video_height,video_width,_ = frame.shape
-                frame_bgr = cv2.cvtColor(frame.asnumpy(), cv2.COLOR_BGR2RGB)
-                pts_list, bbox_list = analyze_face(frame_bgr)
-
-                if len(bbox_list)>0 and None not in bbox_list:
-                    bbox = bbox_list[0]
-                else:
+                    video_height,video_width,_ = batch[0].shape
+                pts_batch, bbox_batch = analyze_face(np.stack(batch), tracker)
+
+                for pts_list, bbox in zip(pts_batch, bbox_batch):
+                    if bbox is None:
+                        isvalid = False
+                        print(f"set isvalid to False as broken img in {frame_idx} of {vid}")
+                        break
+
+                    #print(pts_list)
+                    if len(pts_list)>0 and pts_list is not None:
+                        pts = pts_list.tolist()
+                    else:
+                        isvalid = False
+                        break
+
+                    if frame_idx==0:
+                        x1,y1,x2,y2 = bbox 
+                        face_height, face_width = y2-y1,x2-x1
+
+                    total_pts_list.append(pts)
+                    total_bbox_list.append(bbox)
+                    frame_idx += 1
+
+                if len(bbox_batch) != len(batch):
                     isvalid = False
-                    bbox = []
                     print(f"set isvalid to False as broken img in {frame_idx} of {vid}")
+                if not isvalid:
                     break
-
-                #print(pts_list)
-                if len(pts_list)>0 and pts_list is not None:
-                    pts = pts_list.tolist()
-                else:
-                    isvalid = False
-                    pts = []
-                    break
-
-                if frame_idx==0:
-                    x1,y1,x2,y2 = bbox 
-                    face_height, face_width = y2-y1,x2-x1
-
-                total_pts_list.append(pts)
-                total_bbox_list.append(bbox)
+            # stops the reader thread when the video was abandoned early
+            batches.close()
 
             meta_data = {
                     "mp4_path": vid_path,
@@ -318,7 +336,8 @@ def main(cfg):
     extract_audio(cfg.video_audio_clip_root, cfg.video_audio_clip_root, clip_vid_list)
     
     # 4. Generate video metadata
-    analyze_video(cfg.video_audio_clip_root, cfg.meta_root, clip_vid_list)
+    analyze_video(cfg.video_audio_clip_root, cfg.meta_root, clip_vid_list,
+                  batch_size=cfg.get("detect_batch_size", 8), track_interval=cfg.get("track_interval", 0))
     
     # 5. Generate training and validation set lists
     generate_train_list(cfg)
@@ -14,11 +14,21 @@ from transformers import WhisperModel
 
 from musetalk.utils.face_parsing import FaceParsing
 from musetalk.utils.utils import datagen
-from musetalk.utils.preprocessing import get_landmark_and_bbox, read_imgs
-from musetalk.utils.blending import get_image_prepare_material, get_image_blending
+from musetalk.utils.preprocessing import read_imgs
+from musetalk.utils.blending import get_blending_alpha, blend_face_roi, FrameCompositor, CompositorRing
+from musetalk.utils.pipeline import Stage, StagedPipeline
+from musetalk.utils.latency import LatencyRecorder
+from musetalk.utils.silence_gate import PcmBuffer, SilenceGate
 from musetalk.utils.utils import load_all_model
-from musetalk.utils.audio_processor import AudioProcessor
-
+from musetalk.utils.audio_processor import AudioProcessor, pcm_to_float32
+from musetalk.utils.frame_sink import open_frame_sink, mux_audio
+from musetalk.utils.avatar_store import AvatarStore
+from musetalk.utils.landmark_cache import LandmarkCache, DEFAULT_LANDMARK_CACHE_DIR
+from musetalk.utils.avatar_prep import (AvatarJob, PREPARE_POLICIES, apply_policy, get_avatar_path, prepare_avatar,
+                                        reshift_avatar)
+
+import librosa
+import soundfile as sf
 import shutil
 import threading
 import queue
@@ -34,18 +44,17 @@ def fast_check_ffmpeg():
         return False
 
 
-def video2imgs(vid_path, save_path, ext='.png', cut_frame=10000000):
-    cap = cv2.VideoCapture(vid_path)
-    count = 0
-    while True:
-        if count > cut_frame:
-            break
-        ret, frame = cap.read()
-        if ret:
-            cv2.imwrite(f"{save_path}/{count:08d}.png", frame)
-            count += 1
-        else:
-            break
+def iter_pcm_chunks(audio_path, chunk_ms, sr=16000):
+    """Replay an audio file as int16 PCM chunks of chunk_ms, the way a TTS stream delivers them."""
+    pcm, _ = librosa.load(audio_path, sr=sr)
+    pcm = (np.clip(pcm, -1.0, 1.0) * 32767).astype(np.int16)
+    chunk_len = max(1, int(sr * chunk_ms / 1000))
+    for i in range(0, len(pcm), chunk_len):
+        yield pcm[i:i + chunk_len]
+
+
+# seconds RenderSession.wait blocks before giving up on a session
+DEFAULT_SESSION_TIMEOUT = 600.0
 
 
 def osmakedirs(path_list):
@@ -60,10 +69,7 @@ class Avatar:
         self.video_path = video_path
         self.bbox_shift = bbox_shift
         # 根据版本设置不同的基础路径
-        if args.version == "v15":
-            self.base_path = f"./results/{args.version}/avatars/{avatar_id}"
-        else:  # v1
-            self.base_path = f"./results/avatars/{avatar_id}"
+        self.base_path = get_avatar_path(avatar_id, args.version)
             
         self.avatar_path = self.base_path
         self.full_imgs_path = f"{self.avatar_path}/full_imgs"
@@ -73,6 +79,7 @@ class Avatar:
         self.mask_out_path = f"{self.avatar_path}/mask"
         self.mask_coords_path = f"{self.avatar_path}/mask_coords.pkl"
         self.avatar_info_path = f"{self.avatar_path}/avator_info.json"
+        self.store_path = f"{self.avatar_path}/store"
         self.avatar_info = {
             "avatar_id": avatar_id,
             "video_path": video_path,
@@ -81,10 +88,24 @@ class Avatar:
         }
         self.preparation = preparation
         self.batch_size = batch_size
-        self.idx = 0
+        self.ready = True  # False when the avatar was skipped without usable material
         self.init()
 
     def init(self):
+        if self.preparation and args.policy != "ask":
+            job = AvatarJob(self.avatar_id, self.video_path, self.bbox_shift, args.version,
+                            avatar_path=self.avatar_path)
+            apply_policy(job, args.policy)
+            if job.status == "skipped" and not job.complete:
+                # an interrupted preparation left the directory without a finished store
+                print(f"  skipping avator: {self.avatar_id} (incomplete, prepare it again with --policy resume)")
+                self.ready = False
+            elif job.status in ("reused", "skipped"):
+                self.load_material()
+            else:
+                print(f"  preparing avator: {self.avatar_id} ({job.status})")
+                self.prepare_material(job)
+            return
         if self.preparation:
             if os.path.exists(self.avatar_path):
                 response = input(f"{self.avatar_id} exists, Do you want to re-create it ? (y/n)")
@@ -93,25 +114,15 @@ class Avatar:
                     print("*********************************")
                     print(f"  creating avator: {self.avatar_id}")
                     print("*********************************")
-                    osmakedirs([self.avatar_path, self.full_imgs_path, self.video_out_path, self.mask_out_path])
+                    osmakedirs([self.avatar_path, self.video_out_path])
                     self.prepare_material()
                 else:
-                    self.input_latent_list_cycle = torch.load(self.latents_out_path)
-                    with open(self.coords_path, 'rb') as f:
-                        self.coord_list_cycle = pickle.load(f)
-                    input_img_list = glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-                    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                    self.frame_list_cycle = read_imgs(input_img_list)
-                    with open(self.mask_coords_path, 'rb') as f:
-                        self.mask_coords_list_cycle = pickle.load(f)
-                    input_mask_list = glob.glob(os.path.join(self.mask_out_path, '*.[jpJP][pnPN]*[gG]'))
-                    input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                    self.mask_list_cycle = read_imgs(input_mask_list)
+                    self.load_material()
             else:
                 print("*********************************")
                 print(f"  creating avator: {self.avatar_id}")
                 print("*********************************")
-                osmakedirs([self.avatar_path, self.full_imgs_path, self.video_out_path, self.mask_out_path])
+                osmakedirs([self.avatar_path, self.video_out_path])
                 self.prepare_material()
         else:
             if not os.path.exists(self.avatar_path):
@@ -122,123 +133,246 @@ class Avatar:
                 avatar_info = json.load(f)
 
             if avatar_info['bbox_shift'] != self.avatar_info['bbox_shift']:
-                response = input(f" 【bbox_shift】 is changed, you need to re-create it ! (c/continue)")
-                if response.lower() == "c":
+                if args.policy == "skip":
+                    job = AvatarJob(self.avatar_id, self.video_path, self.bbox_shift, args.version,
+                                    avatar_path=self.avatar_path)
+                    if not job.complete:
+                        print(f"  skipping avator: {self.avatar_id} (incomplete, prepare it again with --policy resume)")
+                        self.ready = False
+                        return
+                    print(f"{self.avatar_id}: bbox_shift changed, keeping the stored avatar (--policy skip)")
+                    self.load_material()
+                    return
+                if args.policy == "rebuild":
+                    print(f"{self.avatar_id}: bbox_shift changed, rebuilding (--policy {args.policy})")
                     shutil.rmtree(self.avatar_path)
-                    print("*********************************")
-                    print(f"  creating avator: {self.avatar_id}")
-                    print("*********************************")
-                    osmakedirs([self.avatar_path, self.full_imgs_path, self.video_out_path, self.mask_out_path])
+                    osmakedirs([self.avatar_path, self.video_out_path])
                     self.prepare_material()
+                    return
+                # frames and detections do not depend on bbox_shift, only the crops are redone
+                if args.policy == "ask":
+                    response = input(f" 【bbox_shift】 is changed ({avatar_info['bbox_shift']} -> {self.bbox_shift}), "
+                                     f"the face crops, latents and masks of {self.avatar_id} will be rewritten "
+                                     f"in place ! (c/continue)")
+                    if response.lower() != "c":
+                        sys.exit()
                 else:
-                    sys.exit()
+                    print(f"{self.avatar_id}: bbox_shift changed ({avatar_info['bbox_shift']} -> {self.bbox_shift}), "
+                          f"updating the face crops (--policy {args.policy})")
+                self.reshift_material()
             else:
-                self.input_latent_list_cycle = torch.load(self.latents_out_path)
-                with open(self.coords_path, 'rb') as f:
-                    self.coord_list_cycle = pickle.load(f)
-                input_img_list = glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-                input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                self.frame_list_cycle = read_imgs(input_img_list)
-                with open(self.mask_coords_path, 'rb') as f:
-                    self.mask_coords_list_cycle = pickle.load(f)
-                input_mask_list = glob.glob(os.path.join(self.mask_out_path, '*.[jpJP][pnPN]*[gG]'))
-                input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                self.mask_list_cycle = read_imgs(input_mask_list)
-
-    def prepare_material(self):
+                self.load_material()
+
+    def load_material(self):
+        if AvatarStore.exists(self.store_path):
+            store = AvatarStore(self.store_path,
+                                cache_bytes=args.frame_cache_mb * 1024 * 1024,
+                                prefetch=args.prefetch_frames)
+            self.frame_list_cycle = store.frames
+            self.mask_list_cycle = store.masks
+            self.input_latent_list_cycle = store.latents
+            self.coord_list_cycle = store.coords
+            self.mask_coords_list_cycle = store.crop_boxes
+            return
+
+        # avatars prepared before the binary store existed
+        self.input_latent_list_cycle = torch.load(self.latents_out_path)
+        with open(self.coords_path, 'rb') as f:
+            self.coord_list_cycle = pickle.load(f)
+        input_img_list = glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
+        input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+        self.frame_list_cycle = read_imgs(input_img_list)
+        with open(self.mask_coords_path, 'rb') as f:
+            self.mask_coords_list_cycle = pickle.load(f)
+        input_mask_list = glob.glob(os.path.join(self.mask_out_path, '*.[jpJP][pnPN]*[gG]'))
+        input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+        self.mask_list_cycle = read_imgs(input_mask_list)
+
+    def prepare_material(self, job=None):
         print("preparing data materials ... ...")
-        with open(self.avatar_info_path, "w") as f:
-            json.dump(self.avatar_info, f)
-
-        if os.path.isfile(self.video_path):
-            video2imgs(self.video_path, self.full_imgs_path, ext='png')
+        if job is None:
+            job = AvatarJob(self.avatar_id, self.video_path, self.bbox_shift, args.version,
+                            avatar_path=self.avatar_path)
+        prepare_avatar(job, vae, fp, **self.prepare_kwargs())
+        # reopen the store so the in-memory copies are replaced by shared, memory-mapped pages
+        self.load_material()
+
+    def reshift_material(self):
+        """Re-derive the face crops of the prepared avatar for the new bbox_shift."""
+        job = AvatarJob(self.avatar_id, self.video_path, self.bbox_shift, args.version,
+                        avatar_path=self.avatar_path)
+        reshift_avatar(job, vae, fp, **self.prepare_kwargs())
+        self.load_material()
+
+    def prepare_kwargs(self):
+        kwargs = dict(landmark_cache=landmark_cache, detect_batch_size=args.detect_batch_size,
+                      detect_max_side=args.detect_max_side, detect_refine=args.detect_refine,
+                      track_interval=args.track_interval, detect_policy=args.detect_policy)
+        if args.version == "v15":
+            kwargs.update(mode=args.parsing_mode, extra_margin=args.extra_margin)
         else:
-            print(f"copy files in {self.video_path}")
-            files = os.listdir(self.video_path)
-            files.sort()
-            files = [file for file in files if file.split(".")[-1] == "png"]
-            for filename in files:
-                shutil.copyfile(f"{self.video_path}/{filename}", f"{self.full_imgs_path}/{filename}")
-        input_img_list = sorted(glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]')))
-
-        print("extracting landmarks...")
-        coord_list, frame_list = get_landmark_and_bbox(input_img_list, self.bbox_shift)
-        input_latent_list = []
-        idx = -1
-        # maker if the bbox is not sufficient
-        coord_placeholder = (0.0, 0.0, 0.0, 0.0)
-        for bbox, frame in zip(coord_list, frame_list):
-            idx = idx + 1
-            if bbox == coord_placeholder:
-                continue
-            x1, y1, x2, y2 = bbox
-            if args.version == "v15":
-                y2 = y2 + args.extra_margin
-                y2 = min(y2, frame.shape[0])
-                coord_list[idx] = [x1, y1, x2, y2]  # 更新coord_list中的bbox
-            crop_frame = frame[y1:y2, x1:x2]
-            resized_crop_frame = cv2.resize(crop_frame, (256, 256), interpolation=cv2.INTER_LANCZOS4)
-            latents = vae.get_latents_for_unet(resized_crop_frame)
-            input_latent_list.append(latents)
-
-        self.frame_list_cycle = frame_list + frame_list[::-1]
-        self.coord_list_cycle = coord_list + coord_list[::-1]
-        self.input_latent_list_cycle = input_latent_list + input_latent_list[::-1]
-        self.mask_coords_list_cycle = []
-        self.mask_list_cycle = []
-
-        for i, frame in enumerate(tqdm(self.frame_list_cycle)):
-            cv2.imwrite(f"{self.full_imgs_path}/{str(i).zfill(8)}.png", frame)
-
-            x1, y1, x2, y2 = self.coord_list_cycle[i]
-            if args.version == "v15":
-                mode = args.parsing_mode
+            kwargs.update(mode="raw")
+        return kwargs
+
+    def open_sink(self, output_vid, fps, audio_path, skip_save_images):
+        """ffmpeg pipe sink for output_vid, plus the PNG debug dump if requested."""
+        if skip_save_images:
+            return None
+        png_dir = f"{self.avatar_path}/tmp" if args.save_png_frames else None
+        return open_frame_sink(output_vid, fps=fps, audio_path=audio_path, png_dir=png_dir)
+
+    def blend_frame(self, idx, res_frame, compositor=None):
+        """
+        Paste a generated face back into cycle frame idx; None if the box is unusable.
+        With a compositor the result lives in its output buffer until its next
+        call, without one a new frame is returned.
+        """
+        bbox = self.coord_list_cycle[idx % (len(self.coord_list_cycle))]
+        ori_frame = self.frame_list_cycle[idx % (len(self.frame_list_cycle))]
+        x1, y1, x2, y2 = bbox
+        try:
+            res_frame = cv2.resize(res_frame.astype(np.uint8), (x2 - x1, y2 - y1))
+        except:
+            return None
+        mask = self.mask_list_cycle[idx % (len(self.mask_list_cycle))]
+        mask_crop_box = self.mask_coords_list_cycle[idx % (len(self.mask_coords_list_cycle))]
+        if compositor is None:
+            return blend_face_roi(np.array(ori_frame), res_frame, bbox,
+                                  get_blending_alpha(mask, bbox, mask_crop_box))
+        return compositor(ori_frame, res_frame, bbox, mask, mask_crop_box)
+
+    def render(self, batches, sink, recorder=None, weight_fn=None):
+        """
+        Run (whisper_batch, latent_batch) batches through the staged pipeline
+        source -> UNet -> VAE decode -> resize/blend (args.blend_workers) -> sink
+        with bounded queues between the stages, and return its stage report.
+        If a LatencyRecorder is given every frame is timestamped at each stage.
+        weight_fn(frame_idx) gives the SilenceGate weight of a frame: frames with
+        weight 0 skip UNet/VAE and show the avatar frame, partial weights cross-fade.
+        """
+        def number(batches):
+            # tag each batch with the index of its first frame and the frame weights
+            first = 0
+            for whisper_batch, latent_batch in batches:
+                n = len(whisper_batch)
+                if recorder is not None:
+                    recorder.mark_range(first, n, "batch_ready")
+                if weight_fn is None:
+                    weights = [1.0] * n
+                else:
+                    weights = [weight_fn(i) for i in range(first, first + n)]
+                yield first, weights, whisper_batch, latent_batch
+                first += n
+
+        @torch.no_grad()
+        def run_unet(seq, batch):
+            first, weights, whisper_batch, latent_batch = batch
+            active = [i for i, w in enumerate(weights) if w > 0]
+            if not active:
+                return first, weights, None
+            if len(active) < len(weights):
+                whisper_batch = whisper_batch[active]
+                latent_batch = latent_batch[active]
+            if recorder is not None:
+                recorder.mark_range(first, len(weights), "unet_start")
+            audio_feature_batch = pe(whisper_batch.to(device))
+            latent_batch = latent_batch.to(device=device, dtype=unet.model.dtype)
+            pred_latents = unet.model(latent_batch,
+                                      timesteps,
+                                      encoder_hidden_states=audio_feature_batch).sample
+            pred_latents = pred_latents.to(device=device, dtype=vae.vae.dtype)
+            if recorder is not None:
+                if device.type == "cuda":
+                    # kernels are asynchronous, wait for them so the timestamp means something
+                    torch.cuda.synchronize(device)
+                recorder.mark_range(first, len(weights), "unet_end")
+            return first, weights, pred_latents
+
+        @torch.no_grad()
+        def run_vae(seq, batch):
+            first, weights, pred_latents = batch
+            recon = iter([] if pred_latents is None else vae.decode_latents(pred_latents))
+            if recorder is not None and pred_latents is not None:
+                recorder.mark_range(first, len(weights), "vae_end")
+            # silent frames keep their place in the sequence without a generated face
+            return [(first + i, w, next(recon) if w > 0 else None) for i, w in enumerate(weights)]
+
+        # output buffers for every frame the blend workers, the sink queue and the writer can hold
+        sink_queue_size = args.queue_size * self.batch_size
+        compositors = CompositorRing(sink_queue_size + args.blend_workers + 1)
+
+        def blend(seq, item):
+            idx, weight, res_frame = item
+            compositor = compositors.acquire(seq)
+            if compositor is None:
+                return None
+            ori_frame = self.frame_list_cycle[idx % (len(self.frame_list_cycle))]
+            if res_frame is None:
+                # the sink only reads frames, so a silent frame is the stored one
+                frame = np.asarray(ori_frame)
             else:
-                mode = "raw"
-            mask, crop_box = get_image_prepare_material(frame, [x1, y1, x2, y2], fp=fp, mode=mode)
-
-            cv2.imwrite(f"{self.mask_out_path}/{str(i).zfill(8)}.png", mask)
-            self.mask_coords_list_cycle += [crop_box]
-            self.mask_list_cycle.append(mask)
-
-        with open(self.mask_coords_path, 'wb') as f:
-            pickle.dump(self.mask_coords_list_cycle, f)
-
-        with open(self.coords_path, 'wb') as f:
-            pickle.dump(self.coord_list_cycle, f)
-
-        torch.save(self.input_latent_list_cycle, os.path.join(self.latents_out_path))
-
-    def process_frames(self, res_frame_queue, video_len, skip_save_images):
-        print(video_len)
-        while True:
-            if self.idx >= video_len - 1:
-                break
+                frame = self.blend_frame(idx, res_frame, compositor)
+                if frame is not None and weight < 1:
+                    frame = cv2.addWeighted(frame, weight, np.asarray(ori_frame), 1 - weight, 0, dst=frame)
+            if recorder is not None:
+                recorder.mark(idx, "blend_end")
+            return frame
+
+        def write(idx, frame):
             try:
-                start = time.time()
-                res_frame = res_frame_queue.get(block=True, timeout=1)
-            except queue.Empty:
-                continue
-
-            bbox = self.coord_list_cycle[self.idx % (len(self.coord_list_cycle))]
-            ori_frame = copy.deepcopy(self.frame_list_cycle[self.idx % (len(self.frame_list_cycle))])
-            x1, y1, x2, y2 = bbox
-            try:
-                res_frame = cv2.resize(res_frame.astype(np.uint8), (x2 - x1, y2 - y1))
-            except:
-                continue
-            mask = self.mask_list_cycle[self.idx % (len(self.mask_list_cycle))]
-            mask_crop_box = self.mask_coords_list_cycle[self.idx % (len(self.mask_coords_list_cycle))]
-            combine_frame = get_image_blending(ori_frame,res_frame,bbox,mask,mask_crop_box)
-
-            if skip_save_images is False:
-                cv2.imwrite(f"{self.avatar_path}/tmp/{str(self.idx).zfill(8)}.png", combine_frame)
-            self.idx = self.idx + 1
+                if frame is None:
+                    return
+                if sink is not None:
+                    sink.write(frame)
+                if recorder is not None:
+                    recorder.mark(idx, "sink_write")
+                    recorder.maybe_print_live()
+            finally:
+                compositors.release(idx)
+
+        pipeline = StagedPipeline([
+            Stage("unet", run_unet, queue_size=args.queue_size),
+            Stage("vae", run_vae, queue_size=args.queue_size, expand=True),
+            Stage("blend", blend, num_workers=args.blend_workers, queue_size=sink_queue_size),
+            Stage("sink", write, queue_size=sink_queue_size),
+        ], on_abort=compositors.close)
+        report = pipeline.run(number(batches))
+        for name, stats in report["stages"].items():
+            print(f"  {name:>6}: {stats['items']} items, occupancy {stats['occupancy']:.2f}, "
+                  f"queue depth mean {stats['queue_depth_mean']} max {stats['queue_depth_max']}")
+        return report
+
+    def create_silence_gate(self, fps):
+        if not args.silence_gate:
+            return None
+        return SilenceGate(fps,
+                           threshold_db=args.silence_threshold_db,
+                           min_silence_frames=args.silence_min_frames,
+                           crossfade_frames=args.silence_crossfade_frames,
+                           context=args.audio_padding_length_right)
+
+    def save_latency_report(self, recorder, pipeline_report, out_vid_name, gate=None):
+        """Print the clip's latency report and save it next to the video when --latency_report is set."""
+        report = recorder.report(pipeline_report)
+        report["avatar_id"] = self.avatar_id
+        if gate is not None:
+            report["silence_gate"] = gate.stats()
+            print("silence gate: " + json.dumps(report["silence_gate"]))
+        print("latency report: " + json.dumps({k: report[k] for k in
+                                               ["frames", "time_to_first_frame_ms", "achieved_fps",
+                                                "steady_fps", "realtime"]}))
+        if args.latency_report:
+            name = out_vid_name if out_vid_name is not None else f"{int(time.time())}"
+            report_path = os.path.join(self.video_out_path, name + "_latency.json")
+            with open(report_path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"latency report is save to {report_path}")
+        return report
 
     @torch.no_grad()
     def inference(self, audio_path, out_vid_name, fps, skip_save_images):
-        os.makedirs(self.avatar_path + '/tmp', exist_ok=True)
         print("start inference")
+        recorder = LatencyRecorder(fps, live_interval=args.latency_live_interval)
         ############################################## extract audio feature ##############################################
         start_time = time.time()
         # Extract audio features
@@ -253,39 +387,30 @@ class Avatar:
             audio_padding_length_left=args.audio_padding_length_left,
             audio_padding_length_right=args.audio_padding_length_right,
         )
+        # every chunk exists from here on, so the feature extraction shows up in the audio stage
+        recorder.mark_range(0, len(whisper_chunks), "audio_ready")
         print(f"processing audio:{audio_path} costs {(time.time() - start_time) * 1000}ms")
         ############################################## inference batch by batch ##############################################
         video_num = len(whisper_chunks)
-        res_frame_queue = queue.Queue()
-        self.idx = 0
-        # Create a sub-thread and start it
-        process_thread = threading.Thread(target=self.process_frames, args=(res_frame_queue, video_num, skip_save_images))
-        process_thread.start()
+        gate = self.create_silence_gate(fps)
+        weight_fn = None
+        if gate is not None:
+            pcm, _ = librosa.load(audio_path, sr=16000)
+            weight_fn = gate.weights(pcm, video_num).__getitem__
+        output_vid = None if out_vid_name is None else os.path.join(self.video_out_path, out_vid_name + ".mp4")
+        sink = self.open_sink(output_vid, fps, audio_path, skip_save_images)
 
         gen = datagen(whisper_chunks,
                      self.input_latent_list_cycle,
                      self.batch_size)
         start_time = time.time()
-        res_frame_list = []
-
-        frameTime = time.time()
-        for i, (whisper_batch, latent_batch) in enumerate(tqdm(gen, total=int(np.ceil(float(video_num) / self.batch_size)))):
-            audio_feature_batch = pe(whisper_batch.to(device))
-            latent_batch = latent_batch.to(device=device, dtype=unet.model.dtype)
-
-            pred_latents = unet.model(latent_batch,
-                                    timesteps,
-                                    encoder_hidden_states=audio_feature_batch).sample
-            pred_latents = pred_latents.to(device=device, dtype=vae.vae.dtype)
-            recon = vae.decode_latents(pred_latents)
-
-            if i == int(np.ceil(float(video_num) / self.batch_size)) - 1:
-                print("Before last batch, time cost: {}s".format(time.time() - frameTime))
-
-            for res_frame in recon:
-                res_frame_queue.put(res_frame)
-        # Close the queue and sub-thread after all tasks are completed
-        process_thread.join()
+        try:
+            pipeline_report = self.render(tqdm(gen, total=int(np.ceil(float(video_num) / self.batch_size))),
+                                          sink, recorder, weight_fn)
+        finally:
+            if sink is not None:
+                sink.close()
+        self.save_latency_report(recorder, pipeline_report, out_vid_name, gate)
 
         if args.skip_save_images is True:
             print('Total process time of {} frames without saving images = {}s'.format(
@@ -297,22 +422,365 @@ class Avatar:
                 time.time() - start_time))
 
         if out_vid_name is not None and args.skip_save_images is False:
-            # optional
-            cmd_img2video = f"ffmpeg -y -v warning -r {fps} -f image2 -i {self.avatar_path}/tmp/%08d.png -vcodec libx264 -vf format=yuv420p -crf 18 {self.avatar_path}/temp.mp4"
-            print(cmd_img2video)
-            os.system(cmd_img2video)
+            print(f"result is save to {output_vid}")
+        print("\n")
+
+    @torch.no_grad()
+    def inference_stream(self, audio_chunks, out_vid_name, fps, skip_save_images):
+        """
+        Render while the driving audio is still arriving.
+
+        audio_chunks yields 16kHz mono PCM chunks (int16 bytes or arrays). Whisper
+        chunks are produced incrementally by an AudioStreamSession and a UNet batch
+        is launched as soon as batch_size of them are ready, so the first frames do
+        not wait for the end of the utterance.
+        """
+        print("start streaming inference")
+        recorder = LatencyRecorder(fps, live_interval=args.latency_live_interval)
+        session = audio_processor.create_stream_session(
+            device,
+            weight_dtype,
+            whisper,
+            fps=fps,
+            audio_padding_length_left=args.audio_padding_length_left,
+            audio_padding_length_right=args.audio_padding_length_right,
+        )
+        # keep the received audio for muxing the result
+        audio_path = f"{self.avatar_path}/tmp_audio.wav"
+        audio_file = sf.SoundFile(audio_path, mode="w", samplerate=16000, channels=1)
 
-            output_vid = os.path.join(self.video_out_path, out_vid_name + ".mp4")  # on
-            cmd_combine_audio = f"ffmpeg -y -v warning -i {audio_path} -i {self.avatar_path}/temp.mp4 {output_vid}"
-            print(cmd_combine_audio)
-            os.system(cmd_combine_audio)
+        # the audio is still being written, so encode video only and mux afterwards
+        temp_vid = None if out_vid_name is None else f"{self.avatar_path}/temp.mp4"
+        sink = self.open_sink(temp_vid, fps, None, skip_save_images)
 
+        start_time = time.time()
+        num_latents = len(self.input_latent_list_cycle)
+        video_num = 0
+
+        def make_batch(whisper_chunks):
+            nonlocal video_num
+            whisper_batch = torch.stack(whisper_chunks)
+            latent_batch = torch.cat([self.input_latent_list_cycle[(video_num + j) % num_latents]
+                                      for j in range(len(whisper_chunks))], dim=0)
+            if video_num == 0:
+                print("First batch ready after {:.0f}ms".format((time.time() - start_time) * 1000))
+            video_num += len(whisper_chunks)
+            return whisper_batch, latent_batch
+
+        gate = self.create_silence_gate(fps)
+        received = PcmBuffer()
+
+        def weight_fn(idx):
+            # the whisper chunk of a frame is only emitted once its right context
+            # has arrived, so the audio around it is already in received
+            weight = gate.update(received.view(), idx, received.offset)
+            # frames come in order, later windows never read before the next one's start
+            received.trim(gate.window_start(idx + 1))
+            return weight
+
+        def batches():
+            pending = []
+            for pcm in audio_chunks:
+                pcm_float = pcm_to_float32(pcm)
+                audio_file.write(pcm_float)
+                if gate is not None:
+                    received.append(pcm_float)
+                produced = session.push(pcm)
+                recorder.mark_range(video_num + len(pending), len(produced), "audio_ready")
+                pending += produced
+                while len(pending) >= self.batch_size:
+                    yield make_batch(pending[:self.batch_size])
+                    pending = pending[self.batch_size:]
+            audio_file.close()
+            produced = session.finish()
+            recorder.mark_range(video_num + len(pending), len(produced), "audio_ready")
+            pending += produced
+            for i in range(0, len(pending), self.batch_size):
+                yield make_batch(pending[i:i + self.batch_size])
+
+        try:
+            pipeline_report = self.render(batches(), sink, recorder, weight_fn if gate is not None else None)
+        finally:
+            if not audio_file.closed:
+                audio_file.close()
+            if sink is not None:
+                sink.close()
+        self.save_latency_report(recorder, pipeline_report, out_vid_name, gate)
+
+        print('Total process time of {} streamed frames = {}s'.format(video_num, time.time() - start_time))
+
+        if out_vid_name is not None and skip_save_images is False:
+            output_vid = os.path.join(self.video_out_path, out_vid_name + ".mp4")
+            mux_audio(f"{self.avatar_path}/temp.mp4", audio_path, output_vid)
             os.remove(f"{self.avatar_path}/temp.mp4")
-            shutil.rmtree(f"{self.avatar_path}/tmp")
             print(f"result is save to {output_vid}")
+        os.remove(audio_path)
         print("\n")
 
 
+class RenderSession:
+    """
+    One talking-head request rendered by the RenderScheduler.
+
+    The scheduler pushes generated faces into result_queue in frame order; a
+    per-session worker thread blends them into the avatar frames and encodes.
+    result_queue holds at most queue_size faces (0 for no limit), the scheduler
+    leaves a session out of its batches while the queue is full.
+    """
+
+    def __init__(self, session_id, avatar, audio_path, out_vid_name, fps, skip_save_images, queue_size=0,
+                 wakeup=None):
+        self.session_id = session_id
+        self.avatar = avatar
+        self.audio_path = audio_path
+        self.out_vid_name = out_vid_name
+        self.fps = fps
+        self.skip_save_images = skip_save_images
+        self.whisper_chunks = None
+        self.next_frame = 0          # next frame index to put into a UNet batch
+        self.num_frames = 0          # frames blended so far
+        self.result_queue = queue.Queue(maxsize=queue_size)
+        self.wakeup = wakeup         # set whenever the worker frees a slot in result_queue
+        self.done = threading.Event()
+        self.error = None
+        self.submit_time = time.time()
+        self.first_frame_time = None
+        self.finish_time = None
+        self.output_vid = None
+        if out_vid_name is not None:
+            self.output_vid = os.path.join(avatar.video_out_path, out_vid_name + ".mp4")
+
+    @property
+    def remaining(self):
+        return len(self.whisper_chunks) - self.next_frame
+
+    @property
+    def free_slots(self):
+        """Faces that can still be put into result_queue without blocking."""
+        if self.result_queue.maxsize <= 0:
+            return self.remaining
+        return self.result_queue.maxsize - self.result_queue.qsize()
+
+    def start_worker(self):
+        self.sink = self.avatar.open_sink(self.output_vid, self.fps, self.audio_path, self.skip_save_images)
+        self.worker = threading.Thread(target=self._blend_worker, daemon=True)
+        self.worker.start()
+
+    def fail(self, error):
+        """End the session with error; the blend worker closes the sink and wait() raises it."""
+        if self.error is None:
+            self.error = error
+        try:
+            # wakes a worker waiting for frames; a worker with frames queued sees the error first
+            self.result_queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _blend_worker(self):
+        compositor = FrameCompositor()
+        try:
+            while self.num_frames < len(self.whisper_chunks):
+                res_frame = self.result_queue.get()
+                if self.wakeup is not None:
+                    self.wakeup.set()
+                if res_frame is None or self.error is not None:
+                    break
+                combine_frame = self.avatar.blend_frame(self.num_frames, res_frame, compositor)
+                if combine_frame is not None and self.sink is not None:
+                    self.sink.write(combine_frame)
+                if self.first_frame_time is None:
+                    self.first_frame_time = time.time()
+                self.num_frames += 1
+            if self.sink is not None:
+                self.sink.close()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finish_time = time.time()
+            self.done.set()
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+    def wait(self, timeout=DEFAULT_SESSION_TIMEOUT):
+        """The output video once the session is done; raises its error, or TimeoutError after timeout seconds."""
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"session {self.session_id} did not finish within {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.output_vid
+
+
+class RenderScheduler:
+    """
+    Long-running renderer that serves many sessions with one set of models.
+
+    VAE, UNet, PositionalEncoding and Whisper are the module level models loaded
+    once at start-up. Submitted sessions get their whisper chunks computed on an
+    audio thread; the render thread then packs frames from all active sessions
+    (round-robin, up to batch_size) into a single UNet/VAE batch, taking the
+    latents from each session's avatar and the audio from each session's
+    whisper chunks, and fans the decoded faces out to the per-session blend and
+    encode workers.
+    """
+
+    def __init__(self, batch_size, queue_size=4):
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self._requests = queue.Queue()
+        self._ready = queue.Queue()
+        self._active = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # set when a session becomes ready, a worker frees queue slots or on stop
+        self._wakeup = threading.Event()
+        self.num_batches = 0
+        self.num_frames = 0
+        self._audio_thread = threading.Thread(target=self._audio_loop, daemon=True)
+        self._render_thread = threading.Thread(target=self._render_loop, daemon=True)
+        self._audio_thread.start()
+        self._render_thread.start()
+
+    def submit(self, avatar, audio_path, out_vid_name, fps=25, skip_save_images=False):
+        with self._lock:
+            session_id = self._next_id
+            self._next_id += 1
+        # each session buffers at most queue_size batches of decoded faces
+        session = RenderSession(session_id, avatar, audio_path, out_vid_name, fps, skip_save_images,
+                                queue_size=self.queue_size * self.batch_size, wakeup=self._wakeup)
+        self._requests.put(session)
+        return session
+
+    def stop(self):
+        """Stop the scheduler; sessions that have not finished yet fail with RuntimeError."""
+        self._stopped.set()
+        self._requests.put(None)
+        self._wakeup.set()
+        self._audio_thread.join()
+        self._render_thread.join()
+        error = RuntimeError("scheduler stopped")
+        pending = list(self._active)
+        self._active = []
+        for q in [self._ready, self._requests]:
+            while True:
+                try:
+                    session = q.get_nowait()
+                except queue.Empty:
+                    break
+                if session is not None:
+                    pending.append(session)
+        for session in pending:
+            if session.done.is_set():
+                continue
+            if session.whisper_chunks is None:
+                # never reached the audio thread, there is no worker to end
+                session.error = error
+                session.done.set()
+            else:
+                session.fail(error)
+
+    @torch.no_grad()
+    def _audio_loop(self):
+        while not self._stopped.is_set():
+            session = self._requests.get()
+            if session is None:
+                break
+            try:
+                whisper_input_features, librosa_length = audio_processor.get_audio_feature(
+                    session.audio_path, weight_dtype=weight_dtype)
+                session.whisper_chunks = audio_processor.get_whisper_chunk(
+                    whisper_input_features,
+                    device,
+                    weight_dtype,
+                    whisper,
+                    librosa_length,
+                    fps=session.fps,
+                    audio_padding_length_left=args.audio_padding_length_left,
+                    audio_padding_length_right=args.audio_padding_length_right,
+                )
+                session.start_worker()
+            except Exception as e:
+                session.error = e
+                session.done.set()
+                continue
+            self._ready.put(session)
+            self._wakeup.set()
+
+    def _collect_batch(self):
+        """
+        Round-robin frames from the active sessions into one batch.
+
+        Sessions that ended (their worker failed) are dropped, and sessions are
+        skipped once their result_queue has no room for another face.
+        """
+        self._active = [s for s in self._active if not s.done.is_set() and s.error is None]
+        slots = {s: min(s.free_slots, s.remaining) for s in self._active}
+        batch = []
+        while len(batch) < self.batch_size:
+            progressed = False
+            for session in self._active:
+                if len(batch) >= self.batch_size:
+                    break
+                if slots[session] > 0:
+                    batch.append((session, session.next_frame))
+                    session.next_frame += 1
+                    slots[session] -= 1
+                    progressed = True
+            if not progressed:
+                break
+        return batch
+
+    @torch.no_grad()
+    def _render_batch(self, batch):
+        """UNet and VAE decode for (session, frame index) pairs; the generated faces in batch order."""
+        whisper_batch = torch.stack([s.whisper_chunks[i] for s, i in batch])
+        latent_batch = torch.cat([
+            s.avatar.input_latent_list_cycle[i % len(s.avatar.input_latent_list_cycle)] for s, i in batch
+        ], dim=0)
+        audio_feature_batch = pe(whisper_batch.to(device))
+        latent_batch = latent_batch.to(device=device, dtype=unet.model.dtype)
+        pred_latents = unet.model(latent_batch,
+                                  timesteps,
+                                  encoder_hidden_states=audio_feature_batch).sample
+        pred_latents = pred_latents.to(device=device, dtype=vae.vae.dtype)
+        return vae.decode_latents(pred_latents)
+
+    @torch.no_grad()
+    def _render_loop(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            while True:
+                try:
+                    self._active.append(self._ready.get_nowait())
+                except queue.Empty:
+                    break
+
+            batch = self._collect_batch()
+            if len(batch) == 0:
+                # nothing ready or every queue is full: wait for a new session or a free slot
+                self._wakeup.wait()
+                continue
+            try:
+                recon = self._render_batch(batch)
+            except Exception as e:
+                # a failed batch (e.g. CUDA OOM) ends the sessions in it, the others keep rendering
+                print(f"render batch failed: {type(e).__name__}: {e}")
+                for s in dict.fromkeys(s for s, _ in batch):
+                    s.fail(e)
+                    self._active.remove(s)
+                if device.type == "cuda":
+                    torch.cuda.empty_cache()
+                continue
+            for (s, _), res_frame in zip(batch, recon):
+                # _collect_batch only takes frames that fit into the queue
+                s.result_queue.put_nowait(res_frame)
+            self.num_batches += 1
+            self.num_frames += len(batch)
+
+            # the workers stop by themselves after the last frame
+            self._active = [s for s in self._active if s.remaining > 0]
+
+
 if __name__ == "__main__":
     '''
     This script is used to simulate online chatting and applies necessary pre-processing such as face detection and face parsing in advance. During online chatting, only UNet and the VAE decoder are involved, which makes MuseTalk real-time.
@@ -335,15 +803,56 @@ if __name__ == "__main__":
     parser.add_argument("--audio_padding_length_right", type=int, default=2, help="Right padding length for audio")
     parser.add_argument("--batch_size", type=int, default=20, help="Batch size for inference")
     parser.add_argument("--output_vid_name", type=str, default=None, help="Name of output video file")
+    parser.add_argument("--detect_batch_size", type=int, default=4, help="Frames per DWPose/S3FD forward during face detection")
+    parser.add_argument("--detect_max_side", type=int, default=0,
+                        help="Run S3FD on frames downscaled to this longer side, e.g. 640 for HD sources; 0 for full resolution")
+    parser.add_argument("--detect_refine", action="store_true",
+                        help="Refine downscaled face boxes with a second S3FD pass around each face")
+    parser.add_argument("--track_interval", type=int, default=0,
+                        help="Run S3FD only every N frames (or on drift) and track the face box in between; 0 to detect every frame")
+    parser.add_argument("--detect_policy", type=str, default="s3fd", choices=["s3fd", "dwpose"],
+                        help="s3fd: check every frame for a face with S3FD; dwpose: trust confident DWPose landmarks, S3FD as fallback")
+    parser.add_argument("--landmark_cache_dir", type=str, default=DEFAULT_LANDMARK_CACHE_DIR,
+                        help="Cache of detected landmarks keyed by video content and detector settings; empty to disable")
     parser.add_argument("--use_saved_coord", action="store_true", help='Use saved coordinates to save time')
     parser.add_argument("--saved_coord", action="store_true", help='Save coordinates for future use')
     parser.add_argument("--parsing_mode", default='jaw', help="Face blending parsing mode")
     parser.add_argument("--left_cheek_width", type=int, default=90, help="Width of left cheek region")
     parser.add_argument("--right_cheek_width", type=int, default=90, help="Width of right cheek region")
+    parser.add_argument("--frame_cache_mb", type=int, default=128,
+                       help="Per-avatar budget for frames/masks kept in RAM (LRU); 0 reads straight from the memory-mapped store")
+    parser.add_argument("--prefetch_frames", type=int, default=8,
+                       help="Frames loaded ahead of the renderer in the background")
+    parser.add_argument("--policy", type=str, default="ask", choices=["ask"] + PREPARE_POLICIES,
+                       help="What to do when preparing an avatar that already exists; 'ask' prompts, "
+                            "the others behave as in scripts/prepare_avatars.py")
     parser.add_argument("--skip_save_images",
                        action="store_true",
                        help="Whether skip saving images for better generation speed calculation",
                        )
+    parser.add_argument("--save_png_frames", action="store_true",
+                       help="Also dump every blended frame as PNG into {avatar_path}/tmp for debugging")
+    parser.add_argument("--blend_workers", type=int, default=2, help="Number of resize/blend worker threads")
+    parser.add_argument("--queue_size", type=int, default=4,
+                       help="Capacity, in batches, of each queue between the render stages")
+    parser.add_argument("--latency_report", action="store_true",
+                       help="Save a per-frame latency report (JSON) next to each result video")
+    parser.add_argument("--latency_live_interval", type=float, default=0,
+                       help="Print a rolling latency summary every N seconds while rendering (0 disables)")
+    parser.add_argument("--silence_gate", action="store_true",
+                       help="Skip UNet/VAE for silent frames and show the avatar frame instead")
+    parser.add_argument("--silence_threshold_db", type=float, default=-40.0,
+                       help="Audio level (dBFS) below which a frame counts as silent")
+    parser.add_argument("--silence_min_frames", type=int, default=5,
+                       help="Quiet frames in a row before the gate closes, so short pauses are still rendered")
+    parser.add_argument("--silence_crossfade_frames", type=int, default=2,
+                       help="Frames over which the generated face fades in/out at speech boundaries")
+    parser.add_argument("--concurrent", action="store_true",
+                       help="Render all audio clips of all avatars as concurrent sessions batched together by one scheduler")
+    parser.add_argument("--session_timeout", type=float, default=DEFAULT_SESSION_TIMEOUT,
+                       help="Seconds to wait for each --concurrent session before reporting it as failed (0 waits forever)")
+    parser.add_argument("--audio_chunk_ms", type=int, default=0,
+                       help="Feed each audio clip as PCM chunks of this many ms through the streaming path (0 disables streaming)")
 
     args = parser.parse_args()
 
@@ -387,10 +896,12 @@ if __name__ == "__main__":
         )
     else:  # v1
         fp = FaceParsing()
+    landmark_cache = LandmarkCache(args.landmark_cache_dir) if args.landmark_cache_dir else None
 
     inference_config = OmegaConf.load(args.inference_config)
     print(inference_config)
 
+    avatars = {}
     for avatar_id in inference_config:
         data_preparation = inference_config[avatar_id]["preparation"]
         video_path = inference_config[avatar_id]["video_path"]
@@ -404,11 +915,47 @@ if __name__ == "__main__":
             bbox_shift=bbox_shift,
             batch_size=args.batch_size,
             preparation=data_preparation)
+        if not avatar.ready:
+            continue
+        avatars[avatar_id] = avatar
+        if args.concurrent:
+            continue
 
         audio_clips = inference_config[avatar_id]["audio_clips"]
         for audio_num, audio_path in audio_clips.items():
             print("Inferring using:", audio_path)
-            avatar.inference(audio_path,
-                           audio_num,
-                           args.fps,
-                           args.skip_save_images)
+            if args.audio_chunk_ms > 0:
+                avatar.inference_stream(iter_pcm_chunks(audio_path, args.audio_chunk_ms),
+                                      audio_num,
+                                      args.fps,
+                                      args.skip_save_images)
+            else:
+                avatar.inference(audio_path,
+                               audio_num,
+                               args.fps,
+                               args.skip_save_images)
+
+    if args.concurrent:
+        scheduler = RenderScheduler(batch_size=args.batch_size, queue_size=args.queue_size)
+        start_time = time.time()
+        sessions = []
+        for avatar_id, avatar in avatars.items():
+            for audio_num, audio_path in inference_config[avatar_id]["audio_clips"].items():
+                print(f"Submitting {avatar_id}/{audio_num}: {audio_path}")
+                sessions.append(scheduler.submit(avatar, audio_path, audio_num, args.fps, args.skip_save_images))
+        total_frames = 0
+        for session in sessions:
+            try:
+                output_vid = session.wait(args.session_timeout or None)
+            except Exception as e:
+                print(f"session {session.session_id} ({session.avatar.avatar_id}) failed: {e}")
+                continue
+            total_frames += session.num_frames
+            elapsed = session.finish_time - session.submit_time
+            print(f"session {session.session_id} ({session.avatar.avatar_id}): {session.num_frames} frames "
+                  f"in {elapsed:.2f}s ({session.num_frames / max(elapsed, 1e-6):.1f} fps) -> {output_vid}")
+        scheduler.stop()
+        elapsed = time.time() - start_time
+        print(f"{len(sessions)} sessions, {total_frames} frames in {elapsed:.2f}s: "
+              f"aggregate {total_frames / max(elapsed, 1e-6):.1f} fps, "
+              f"mean batch {scheduler.num_frames / max(scheduler.num_batches, 1):.1f} frames")
@@ -0,0 +1,8 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(params=range(5))
+def rng(request):
+    """Seeded generator; a test taking it runs once per seed."""
+    return np.random.default_rng(request.param)
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("librosa")
+pytest.importorskip("transformers")
+pytest.importorskip("einops")
+
+from musetalk.utils.audio_processor import AudioProcessor
+
+SR = 16000
+SAMPLES_PER_FEATURE = SR // 50
+SEGMENT_FEATURES = 1500
+
+
+def feature_extractor(pcm, return_tensors="pt", sampling_rate=SR):
+    """Takes the first sample of every 20 ms, zero padded to a 30 s segment."""
+    values = np.zeros(SEGMENT_FEATURES, dtype=np.float32)
+    first = np.asarray(pcm[::SAMPLES_PER_FEATURE], dtype=np.float32)
+    values[:len(first)] = first
+    return SimpleNamespace(input_features=torch.from_numpy(values)[None])
+
+
+class IndexWhisper:
+    """Encoder whose hidden states repeat the input, so features keep their position."""
+
+    def encoder(self, input_feature, output_hidden_states=True):
+        states = input_feature[..., None].expand(-1, -1, 384)
+        return SimpleNamespace(hidden_states=(states,) * 5)
+
+
+def indexed_pcm(num_samples):
+    """PCM whose value is 1 + the index of the 50 fps whisper feature it belongs to."""
+    return (np.arange(num_samples) // SAMPLES_PER_FEATURE + 1).astype(np.float32)
+
+
+def offline_chunks(processor, pcm, **kwargs):
+    segment_length = 30 * SR
+    features = [feature_extractor(pcm[i:i + segment_length]).input_features
+                for i in range(0, len(pcm), segment_length)]
+    return processor.get_whisper_chunk(
+        features, "cpu", torch.float32, IndexWhisper(), len(pcm), **kwargs)
+
+
+@pytest.mark.parametrize("seconds", [0.52, 1.03, 7.9, 31.7])
+@pytest.mark.parametrize("left,right", [(2, 2), (0, 3), (1, 1)])
+def test_stream_windows_match_get_whisper_chunk(seconds, left, right):
+    processor = AudioProcessor.__new__(AudioProcessor)
+    processor.feature_extractor = feature_extractor
+    pcm = indexed_pcm(int(seconds * SR))
+    padding = dict(audio_padding_length_left=left, audio_padding_length_right=right)
+    expected = offline_chunks(processor, pcm, **padding)
+
+    session = processor.create_stream_session("cpu", torch.float32, IndexWhisper(), **padding)
+    chunks = []
+    rng = np.random.default_rng(0)
+    start = 0
+    while start < len(pcm):
+        size = int(rng.integers(800, 12000))
+        chunks += session.push(pcm[start:start + size])
+        start += size
+    chunks += session.finish()
+
+    assert len(chunks) == len(expected)
+    for idx, (chunk, reference) in enumerate(zip(chunks, expected)):
+        assert torch.equal(chunk, reference), idx
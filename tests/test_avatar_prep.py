@@ -0,0 +1,95 @@
+import importlib
+import json
+import sys
+import types
+
+import numpy as np
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip("torch")
+
+from musetalk.utils.avatar_store import AvatarStore, write_avatar_store
+from musetalk.utils.face_boxes import coord_placeholder
+
+
+@pytest.fixture
+def avatar_prep(monkeypatch):
+    """musetalk.utils.avatar_prep with a stand-in preprocessing module, which loads DWPose and S3FD at import."""
+    preprocessing = types.ModuleType("musetalk.utils.preprocessing")
+    preprocessing.coord_placeholder = coord_placeholder
+    preprocessing.DETECT_BATCH_SIZE = 4
+    preprocessing.get_landmark_and_bbox_cached = None
+    monkeypatch.setitem(sys.modules, "musetalk.utils.preprocessing", preprocessing)
+    sys.modules.pop("musetalk.utils.avatar_prep", None)
+    yield importlib.import_module("musetalk.utils.avatar_prep")
+    sys.modules.pop("musetalk.utils.avatar_prep", None)
+
+
+class StubVae:
+    """Encodes every crop to a latent filled with 100 + its call-wide index."""
+
+    def __init__(self):
+        self.encoded = 0
+
+    def get_latents_for_unet_batch(self, crops, batch_size=32):
+        crops = list(crops)
+        assert all(crop.shape == (256, 256, 3) for crop in crops)
+        latents = torch.stack([torch.full((8, 32, 32), 100.0 + self.encoded + i) for i in range(len(crops))])
+        self.encoded += len(crops)
+        return latents
+
+
+class StubFaceParsing:
+    def __init__(self):
+        self.parsed = 0
+
+    def parse_batch(self, images, size=(512, 512), mode="raw"):
+        self.parsed += len(images)
+        return [Image.new("L", size, 255) for _ in images]
+
+
+@pytest.mark.parametrize("changed", [[], [1, 4, 6], list(range(8))])
+def test_reshift_reencodes_changed_crops_only(tmp_path, rng, avatar_prep, changed):
+    n, no_face = 8, 3
+    frames = [rng.integers(0, 256, (96, 96, 3), dtype=np.uint8) for _ in range(n)]
+    old_coords = [coord_placeholder if idx == no_face else (10 + idx, 20, 70, 80) for idx in range(n)]
+    new_coords = [(box[0], box[1] + 5, box[2], box[3]) if idx in changed and box != coord_placeholder else box
+                  for idx, box in enumerate(old_coords)]
+    face_idxs = [idx for idx in range(n) if idx != no_face]
+    latents = torch.stack([torch.full((8, 32, 32), float(idx)) for idx in face_idxs])
+    masks = [np.full((4, 4), idx, dtype=np.uint8) for idx in range(n)]
+    crop_boxes = [[idx, idx, idx + 4, idx + 4] for idx in range(n)]
+
+    avatar_path = tmp_path / "avatar"
+    job = avatar_prep.AvatarJob("a", "clip.mp4", 5, "v1", avatar_path=str(avatar_path))
+    old_info = dict(job.avatar_info, bbox_shift=0)
+    write_avatar_store(job.store_path, frames, masks, latents, old_coords, crop_boxes, avatar_info=old_info,
+                       cycle="pingpong")
+    with open(job.avatar_info_path, "w") as f:
+        json.dump(old_info, f)
+
+    def get_landmark_and_bbox_cached(img_list, upperbondrange=0, **kwargs):
+        assert upperbondrange == 5
+        return list(new_coords), img_list
+
+    avatar_prep.get_landmark_and_bbox_cached = get_landmark_and_bbox_cached
+    vae, fp = StubVae(), StubFaceParsing()
+    avatar_prep.reshift_avatar(job, vae, fp)
+
+    reencoded = [idx for idx in face_idxs if new_coords[idx] != old_coords[idx]]
+    assert vae.encoded == fp.parsed == len(reencoded)
+    store = AvatarStore(job.store_path)
+    assert [tuple(store.coords[idx]) for idx in range(n)] == [tuple(box) for box in new_coords]
+    for k, idx in enumerate(face_idxs):
+        value = float(store.latents[k].flatten()[0])
+        if idx in reencoded:
+            assert value == 100 + reencoded.index(idx)
+        else:
+            assert value == idx
+            np.testing.assert_array_equal(store.masks[idx], masks[idx])
+            assert list(store.crop_boxes[idx]) == crop_boxes[idx]
+    for idx in range(n):
+        np.testing.assert_array_equal(store.frames[idx], frames[idx])
+    with open(job.avatar_info_path) as f:
+        assert json.load(f)["bbox_shift"] == 5
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from musetalk.utils.avatar_store import AvatarStore, FrameCache, PingPongView, RaggedArrayView, write_avatar_store
+
+
+def synthetic_avatar(rng, n=6, h=48, w=64):
+    frames = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for _ in range(n)]
+    # masks differ in size per frame, as face crops do
+    masks = [rng.integers(0, 256, (int(rng.integers(4, 40)), int(rng.integers(4, 40))), dtype=np.uint8)
+             for _ in range(n)]
+    latents = torch.from_numpy(rng.standard_normal((n, 8, 32, 32)).astype(np.float32))
+    coords = [tuple(int(v) for v in rng.integers(0, 40, 4)) for _ in range(n)]
+    crop_boxes = [[int(v) for v in rng.integers(0, 60, 4)] for _ in range(n)]
+    return frames, masks, latents, coords, crop_boxes
+
+
+def test_ragged_array_view(rng):
+    arrays = [rng.integers(0, 256, tuple(rng.integers(1, 9, 2)), dtype=np.uint8) for _ in range(5)]
+    index, offset = [], 0
+    for a in arrays:
+        index.append((offset, a.shape[0], a.shape[1]))
+        offset += a.size
+    view = RaggedArrayView(np.concatenate([a.reshape(-1) for a in arrays]), np.array(index))
+    assert len(view) == len(arrays)
+    for a, b in zip(arrays, view):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_store_round_trip(tmp_path, rng):
+    frames, masks, latents, coords, crop_boxes = synthetic_avatar(rng)
+    store_path = str(tmp_path / "store")
+    assert not AvatarStore.exists(store_path)
+    write_avatar_store(store_path, frames, masks, latents, coords, crop_boxes, avatar_info={"avatar_id": "a"})
+    assert AvatarStore.exists(store_path)
+
+    store = AvatarStore(store_path)
+    assert store.avatar_info == {"avatar_id": "a"}
+    assert len(store.frames) == len(frames)
+    for i in range(len(frames)):
+        np.testing.assert_array_equal(store.frames[i], frames[i])
+        np.testing.assert_array_equal(store.masks[i], masks[i])
+        np.testing.assert_array_equal(store.latents[i].numpy(), latents[i:i + 1].numpy())
+        assert tuple(store.coords[i]) == coords[i]
+        assert list(store.crop_boxes[i]) == crop_boxes[i]
+
+
+@pytest.mark.parametrize("cache_bytes", [0, 48 * 64 * 3 * 3])
+def test_pingpong_store_plays_frames_then_reversed(tmp_path, rng, cache_bytes):
+    frames, masks, latents, coords, crop_boxes = synthetic_avatar(rng)
+    store_path = str(tmp_path / "store")
+    write_avatar_store(store_path, frames, masks, latents, coords, crop_boxes, cycle="pingpong")
+
+    store = AvatarStore(store_path, cache_bytes=cache_bytes, prefetch=2)
+    cycle = list(range(len(frames))) + list(range(len(frames)))[::-1]
+    assert len(store.frames) == len(store.masks) == len(store.coords) == len(cycle)
+    for i, j in enumerate(cycle):
+        np.testing.assert_array_equal(store.frames[i], frames[j])
+        np.testing.assert_array_equal(store.masks[i], masks[j])
+        np.testing.assert_array_equal(store.latents[i].numpy(), latents[j:j + 1].numpy())
+        assert tuple(store.coords[i]) == coords[j]
+        assert list(store.crop_boxes[i]) == crop_boxes[j]
+
+
+def test_pingpong_view_wraps_indices():
+    items = ["a", "b", "c"]
+    view = PingPongView(items)
+    cycle = items + items[::-1]
+    assert len(view) == 6
+    for i in range(-12, 18):
+        assert view[i] == cycle[i % len(cycle)]
+
+
+def test_frame_cache_evicts_least_recently_used():
+    frame = lambda value: np.full(100, value, dtype=np.uint8)
+    cache = FrameCache(budget_bytes=300)
+    for key in "abc":
+        cache.put(key, frame(ord(key)))
+    assert cache.nbytes == 300
+    assert cache.get("a") is not None  # "a" is now the most recently used
+    cache.put("d", frame(0))
+    assert "b" not in cache and all(key in cache for key in "acd")
+    cache.put("e", frame(0))
+    assert "c" not in cache and all(key in cache for key in "ade")
+    assert cache.nbytes == 300
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_frame_cache_skips_arrays_over_budget():
+    cache = FrameCache(budget_bytes=100)
+    cache.put("big", np.zeros(101, dtype=np.uint8))
+    assert "big" not in cache and cache.nbytes == 0
+    array = np.zeros(100, dtype=np.uint8)
+    cache.put("fits", array)
+    assert cache.get("fits") is array and not array.flags.writeable
@@ -0,0 +1,114 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from musetalk.utils.blending import (BlendingMaskCache, CompositorRing, FrameCompositor, StillFrameCompositor,
+                                     get_image, get_image_blending)
+from musetalk.utils.pipeline import Stage, StagedPipeline
+
+
+class StubFaceParsing:
+    """Deterministic stand-in for FaceParsing: a 512x512 'L' mask thresholded from the crop."""
+
+    def __call__(self, image, size=(512, 512), mode="raw"):
+        gray = np.asarray(image.convert("L").resize(size, Image.BILINEAR))
+        return Image.fromarray(np.where(gray > 100, 255, 0).astype(np.uint8))
+
+    def parse_batch(self, images, size=(512, 512), mode="raw"):
+        return [self(image, size=size, mode=mode) for image in images]
+
+
+def random_case(rng, h=160, w=200):
+    frame = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    bw, bh = int(rng.integers(16, 80)), int(rng.integers(16, 80))
+    x, y = int(rng.integers(0, w - bw)), int(rng.integers(0, h - bh))
+    face = rng.integers(0, 256, (bh, bw, 3), dtype=np.uint8)
+    return frame, face, [x, y, x + bw, y + bh]
+
+
+def test_mask_cache_matches_get_image(rng):
+    fp = StubFaceParsing()
+    cache = BlendingMaskCache(fp)
+    cases = [random_case(rng) for _ in range(4)]
+    # half the entries come from the batched prepare, the rest from get's single-frame path
+    cache.prepare([(idx, frame, box) for idx, (frame, _, box) in enumerate(cases[:2])])
+    for idx, (frame, face, box) in enumerate(cases):
+        mask_array, crop_box = cache.get(idx, frame, box)
+        expected = get_image(frame, face, box, fp=fp)
+        np.testing.assert_array_equal(get_image_blending(frame, face, box, mask_array, crop_box), expected)
+
+
+def test_compositors_match_get_image_blending(rng):
+    fp = StubFaceParsing()
+    cache = BlendingMaskCache(fp)
+    compositor = FrameCompositor()
+    frame, face, box = random_case(rng)
+    mask_array, crop_box = cache.get(0, frame, box)
+    still = StillFrameCompositor(frame, box, mask_array, crop_box)
+    for _ in range(3):
+        face = rng.integers(0, 256, face.shape, dtype=np.uint8)
+        expected = get_image_blending(frame, face, box, mask_array, crop_box)
+        np.testing.assert_array_equal(compositor(frame, face, box, mask_array, crop_box), expected)
+        np.testing.assert_array_equal(still(face), expected)
+
+
+def run_ring_pipeline(rng, ring, n, fail_at=None):
+    """The blend -> sink part of Avatar.render: parallel compositing into ring buffers, in-order writes."""
+    delays = rng.uniform(0, 0.003, n)
+    face = np.zeros((2, 2, 3), dtype=np.uint8)
+    mask = np.zeros((2, 2), dtype=np.uint8)
+    written = []
+
+    def blend(seq, idx):
+        compositor = ring.acquire(seq)
+        if compositor is None:
+            return None
+        time.sleep(delays[idx])
+        return idx, compositor(np.full((6, 6, 3), idx % 256, dtype=np.uint8), face, [2, 2, 4, 4], mask, [2, 2, 4, 4])
+
+    def write(seq, item):
+        try:
+            idx, frame = item
+            if idx == fail_at:
+                raise ValueError("sink failed")
+            time.sleep(delays[-idx - 1])
+            # the buffer must still hold this frame, not a later one
+            written.append((idx, int(frame[0, 0, 0])))
+        finally:
+            ring.release(seq)
+
+    pipeline = StagedPipeline([
+        Stage("blend", blend, num_workers=4, queue_size=3),
+        Stage("sink", write, queue_size=3),
+    ], on_abort=ring.close)
+    outcome = {}
+
+    def target():
+        try:
+            pipeline.run(range(n))
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), "pipeline did not finish"
+    return written, outcome
+
+
+def test_compositor_ring_keeps_queued_frames(rng):
+    ring = CompositorRing(5)
+    written, outcome = run_ring_pipeline(rng, ring, 120)
+    assert "error" not in outcome
+    assert written == [(idx, idx % 256) for idx in range(120)]
+
+
+def test_compositor_ring_wakes_workers_on_abort(rng):
+    # a failing sink never releases, so blocked workers must be woken by the pipeline's abort
+    ring = CompositorRing(2)
+    written, outcome = run_ring_pipeline(rng, ring, 50, fail_at=3)
+    assert isinstance(outcome["error"], ValueError)
+    assert [idx for idx, _ in written] == [0, 1, 2]
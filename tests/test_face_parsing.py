@@ -0,0 +1,33 @@
+import cv2
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+from musetalk.utils.face_parsing import FaceParsing
+
+
+@pytest.fixture
+def fp(monkeypatch):
+    # the morphology does not need BiSeNet
+    monkeypatch.setattr(FaceParsing, "model_init", lambda self: None)
+    return FaceParsing(left_cheek_width=90, right_cheek_width=90)
+
+
+def random_face_regions(rng, n):
+    regions = np.zeros((n, 512, 512), dtype=np.uint8)
+    for region in regions:
+        for _ in range(4):
+            center = tuple(int(v) for v in rng.integers(0, 512, 2))
+            axes = tuple(int(v) for v in rng.integers(10, 160, 2))
+            cv2.ellipse(region, center, axes, 0, 0, 360, 255, -1)
+        region[rng.random((512, 512)) < 0.005] = 255
+    return regions
+
+
+def test_batched_jaw_region_matches_cv2(fp, rng):
+    regions = random_face_regions(rng, 3)
+    jaw = fp._jaw_region_batch(torch.from_numpy(regions > 0)).numpy()
+    for region, mask in zip(regions, jaw):
+        np.testing.assert_array_equal(mask, fp._jaw_region(region) == 255)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from musetalk.utils.face_boxes import (add_fallback_boxes, coord_placeholder, coords_from_raw, is_valid_bbox,
+                                       landmark_bbox, landmark_bboxes)
+
+
+def baseline_bbox(face_land_mark, f, upperbondrange=0):
+    """The per-frame box of the original get_landmark_and_bbox loop."""
+    face_land_mark = face_land_mark.copy()
+    half_face_coord = face_land_mark[29]
+    if upperbondrange != 0:
+        half_face_coord[1] = upperbondrange + half_face_coord[1]
+    half_face_dist = np.max(face_land_mark[:, 1]) - half_face_coord[1]
+    upper_bond = max(0, half_face_coord[1] - half_face_dist)
+    f_landmark = (np.min(face_land_mark[:, 0]), int(upper_bond), np.max(face_land_mark[:, 0]), np.max(face_land_mark[:, 1]))
+    x1, y1, x2, y2 = f_landmark
+    if y2 - y1 <= 0 or x2 - x1 <= 0 or x1 < 0:
+        return f
+    return f_landmark
+
+
+def synthetic_faces(rng, n=64):
+    """Landmarks of random faces; some flat enough or off the left edge for the box check to fail."""
+    landmarks = []
+    for _ in range(n):
+        x, y = rng.integers(-20, 200), rng.integers(0, 200)
+        w, h = rng.integers(1, 120), rng.integers(1, 20 if rng.random() < 0.3 else 120)
+        landmarks.append(np.stack([rng.integers(x, x + w + 1, 68), rng.integers(y, y + h + 1, 68)], 1))
+    return np.asarray(landmarks, dtype=np.int32)
+
+
+@pytest.mark.parametrize("shift", [-7, 0, 7])
+def test_landmark_bbox_matches_baseline(rng, shift):
+    s3fd_box = (1, 2, 3, 4)
+    for face_land_mark in synthetic_faces(rng):
+        box = landmark_bbox(face_land_mark, shift)
+        expected = baseline_bbox(face_land_mark, s3fd_box, shift)
+        assert (box if is_valid_bbox(box) else s3fd_box) == tuple(int(v) for v in expected)
+
+
+def s3fd_boxes(landmarks):
+    """Stand-in S3FD boxes, distinct from any landmark box."""
+    return [(int(lm[:, 0].min()) - 5, int(lm[:, 1].min()) - 5, int(lm[:, 0].max()) + 5, int(lm[:, 1].max()) + 5)
+            for lm in landmarks]
+
+
+@pytest.mark.parametrize("shift", [-7, 0, 7])
+def test_coords_from_raw_matches_baseline(rng, shift):
+    landmarks = synthetic_faces(rng)
+    boxes = s3fd_boxes(landmarks)
+    has_face = rng.random(len(landmarks)) > 0.1
+    raw = {"landmarks": landmarks, "boxes": boxes, "has_face": has_face, "s3fd_box": [True] * len(landmarks)}
+    expected = [tuple(int(v) for v in baseline_bbox(lm, f, shift)) if face else coord_placeholder
+                for lm, f, face in zip(landmarks, boxes, has_face)]
+    assert coords_from_raw(raw, shift) == expected
+    assert [tuple(box) for box in landmark_bboxes(landmarks, shift)] == [landmark_bbox(lm, shift) for lm in landmarks]
+
+
+@pytest.mark.parametrize("shift", [-7, 0, 7])
+def test_dwpose_raw_gets_s3fd_boxes_for_a_new_shift(rng, shift):
+    landmarks = synthetic_faces(rng)
+    boxes = s3fd_boxes(landmarks)
+    frames = list(range(len(landmarks)))  # detect_fn below maps frame -> its S3FD box
+    # dwpose policy detected at shift 0: trusted landmarks keep their extent box and no S3FD box
+    trusted = [is_valid_bbox(landmark_bbox(lm)) for lm in landmarks]
+    raw = {"landmarks": landmarks,
+           "boxes": [tuple(int(v) for v in (lm[:, 0].min(), lm[:, 1].min(), lm[:, 0].max(), lm[:, 1].max()))
+                     if ok else box for lm, box, ok in zip(landmarks, boxes, trusted)],
+           "has_face": [True] * len(landmarks),
+           "s3fd_box": [not ok for ok in trusted]}
+    detected = []
+
+    def detect_fn(fb):
+        detected.extend(fb)
+        return [boxes[j] for j in fb]
+
+    add_fallback_boxes(raw, frames, shift, detect_fn)
+    expected = [tuple(int(v) for v in baseline_bbox(lm, f, shift)) for lm, f in zip(landmarks, boxes)]
+    assert coords_from_raw(raw, shift) == expected
+    # only frames whose box turned invalid at this shift were detected
+    assert all(trusted[j] and not is_valid_bbox(landmark_bbox(landmarks[j], shift)) for j in detected)
+    assert add_fallback_boxes(raw, frames, shift, detect_fn) == 0
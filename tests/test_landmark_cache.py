@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+from musetalk.utils.face_boxes import coords_from_raw
+from musetalk.utils.landmark_cache import LandmarkCache
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(b"not really a video" * 100)
+    return str(path)
+
+
+def synthetic_raw(rng, n=32):
+    """Raw detections of random faces, a few frames without a face and a few S3FD boxes."""
+    xy = rng.integers(0, 200, (n, 1, 2))
+    landmarks = (xy + rng.integers(0, 120, (n, 68, 2))).astype(np.int32)
+    boxes = np.concatenate([landmarks.min(axis=1) - 5, landmarks.max(axis=1) + 5], axis=1)
+    return {"landmarks": landmarks, "boxes": boxes,
+            "has_face": rng.random(n) > 0.1, "s3fd_box": rng.random(n) > 0.5}
+
+
+def test_key_changes_with_detection_params(tmp_path, video):
+    cache = LandmarkCache(str(tmp_path / "cache"))
+    base = cache.key(video)
+    assert cache.key(video) == base
+    changed = [
+        cache.key(video, detect_max_side=640),
+        cache.key(video, detect_max_side=640, detect_refine=True),
+        cache.key(video, track_interval=5),
+        cache.key(video, detect_policy="dwpose"),
+    ]
+    assert len(set(changed + [base])) == len(changed) + 1
+
+
+def test_changed_content_misses(tmp_path, video, rng):
+    cache = LandmarkCache(str(tmp_path / "cache"))
+    key = cache.key(video)
+    cache.save(key, synthetic_raw(rng))
+    assert cache.load(key) is not None
+
+    with open(video, "ab") as f:
+        f.write(b"edited")
+    new_key = cache.key(video)
+    assert new_key != key
+    assert cache.load(new_key) is None
+
+
+def test_renamed_source_hits(tmp_path, video, rng):
+    cache = LandmarkCache(str(tmp_path / "cache"))
+    key = cache.key(video)
+    cache.save(key, synthetic_raw(rng))
+    renamed = os.path.join(os.path.dirname(video), "renamed.mp4")
+    os.rename(video, renamed)
+    assert cache.key(renamed) == key
+
+
+def test_image_dir_key_follows_frames(tmp_path):
+    frames = tmp_path / "frames"
+    frames.mkdir()
+    for i in range(3):
+        (frames / f"{i:08d}.png").write_bytes(bytes([i]) * 64)
+    cache = LandmarkCache(str(tmp_path / "cache"))
+    key = cache.key(str(frames))
+    (frames / "00000001.png").write_bytes(b"\xff" * 64)
+    assert cache.key(str(frames)) != key
+
+
+@pytest.mark.parametrize("shift", [-7, 0, 7])
+def test_cached_raw_gives_uncached_coords(tmp_path, video, rng, shift):
+    cache = LandmarkCache(str(tmp_path / "cache"))
+    raw = synthetic_raw(rng)
+    key = cache.key(video)
+    cache.save(key, raw)
+    loaded = cache.load(key)
+    for name in raw:
+        np.testing.assert_array_equal(loaded[name], raw[name])
+    # the entry was saved once, crops for another shift come from the same raw detections
+    assert coords_from_raw(loaded, shift) == coords_from_raw(raw, shift)
+    assert coords_from_raw(loaded, shift) != coords_from_raw(loaded, shift + 20)
@@ -0,0 +1,67 @@
+import pytest
+
+from musetalk.utils.latency import LatencyRecorder
+
+START = 10.0
+FRAMES = 101
+FPS = 25
+
+
+def synthetic_recorder():
+    """
+    Recorder with hand-placed timestamps: audio for every frame is ready
+    100 ms after start, the unet of frame i takes i ms and frame i is written
+    at 500 ms + i / FPS, so TTFF is 500 ms and the steady rate is exactly FPS.
+    """
+    recorder = LatencyRecorder(target_fps=FPS, start_time=START)
+    recorder.mark_range(0, FRAMES, "audio_ready", t=START + 0.1)
+    for first in range(0, FRAMES, 4):
+        count = min(4, FRAMES - first)
+        recorder.mark_range(first, count, "batch_ready", t=START + 0.2)
+    for idx in range(FRAMES):
+        recorder.mark(idx, "unet_start", t=START + 0.3)
+        recorder.mark(idx, "unet_end", t=START + 0.3 + idx / 1000)
+        recorder.mark(idx, "sink_write", t=START + 0.5 + idx / FPS)
+    return recorder
+
+
+def test_report_frame_rates():
+    report = synthetic_recorder().report()
+    assert report["frames"] == FRAMES
+    assert report["time_to_first_frame_ms"] == pytest.approx(500, abs=0.01)
+    assert report["steady_fps"] == pytest.approx(FPS, abs=0.01)
+    assert report["achieved_fps"] == pytest.approx(FRAMES / (0.5 + (FRAMES - 1) / FPS), abs=0.01)
+    assert report["realtime"]
+
+
+def test_report_stage_percentiles():
+    stages = synthetic_recorder().report()["stages_ms"]
+    unet = stages["unet"]
+    assert unet["p50"] == pytest.approx(50, abs=0.01)
+    assert unet["p95"] == pytest.approx(95, abs=0.01)
+    assert unet["p99"] == pytest.approx(99, abs=0.01)
+    assert unet["max"] == pytest.approx(100, abs=0.01)
+    assert stages["audio"]["p50"] == pytest.approx(100, abs=0.01)
+    assert stages["batching"]["p99"] == pytest.approx(100, abs=0.01)
+    # no vae/blend events were recorded
+    assert stages["vae"] is None
+    assert stages["blend"] is None
+    total = stages["total"]
+    assert total["p50"] == pytest.approx(400 + 50 * 1000 / FPS, abs=0.01)
+
+
+def test_report_slow_run_is_not_realtime():
+    recorder = LatencyRecorder(target_fps=FPS, start_time=START)
+    for idx in range(10):
+        recorder.mark(idx, "sink_write", t=START + 1 + idx / 10)
+    report = recorder.report()
+    assert report["steady_fps"] == pytest.approx(10, abs=0.01)
+    assert not report["realtime"]
+
+
+def test_report_without_frames():
+    report = LatencyRecorder(target_fps=FPS, start_time=START).report()
+    assert report["frames"] == 0
+    assert report["time_to_first_frame_ms"] is None
+    assert report["steady_fps"] is None
+    assert report["realtime"] is None
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from musetalk.utils.pipeline import Stage, StagedPipeline
+
+
+def run_with_timeout(pipeline, source, timeout=10):
+    """pipeline.run(source) on a helper thread; fails instead of hanging the test run."""
+    outcome = {}
+
+    def target():
+        try:
+            outcome["report"] = pipeline.run(source)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "pipeline did not finish"
+    return outcome
+
+
+def test_parallel_stage_keeps_input_order(rng):
+    delays = rng.uniform(0, 0.005, 64)
+    out = []
+
+    def slow_square(seq, x):
+        time.sleep(delays[x])
+        return x * x
+
+    pipeline = StagedPipeline([
+        Stage("square", slow_square, num_workers=4, queue_size=2),
+        Stage("collect", lambda seq, x: out.append(x), queue_size=2),
+    ])
+    outcome = run_with_timeout(pipeline, range(64))
+    assert "error" not in outcome
+    assert out == [x * x for x in range(64)]
+    assert outcome["report"]["stages"]["square"]["items"] == 64
+
+
+def test_expanding_stage_keeps_order(rng):
+    delays = rng.uniform(0, 0.003, 16)
+    out = []
+
+    def slow_identity(seq, x):
+        time.sleep(delays[x // 4])
+        return x
+
+    pipeline = StagedPipeline([
+        Stage("split", lambda seq, batch: batch, expand=True, queue_size=1),
+        Stage("work", slow_identity, num_workers=3, queue_size=2),
+        Stage("collect", lambda seq, x: out.append(x), queue_size=2),
+    ])
+    # every element of a batch becomes its own item, in batch order
+    batches = [list(range(i, i + 4)) for i in range(0, 64, 4)]
+    outcome = run_with_timeout(pipeline, batches)
+    assert "error" not in outcome
+    assert out == list(range(64))
+
+
+def test_error_in_middle_stage_aborts_all_stages():
+    threads_before = threading.active_count()
+    consumed = []
+
+    def fail_on_five(seq, x):
+        if x == 5:
+            raise ValueError("bad item")
+        return x
+
+    def slow_sink(seq, x):
+        time.sleep(0.01)
+        consumed.append(x)
+
+    pipeline = StagedPipeline([
+        Stage("pass", lambda seq, x: x, queue_size=1),
+        Stage("fail", fail_on_five, num_workers=2, queue_size=1),
+        Stage("sink", slow_sink, queue_size=1),
+    ])
+    start = time.time()
+    # an endless source only stops because of the abort
+    outcome = run_with_timeout(pipeline, (i for i in range(10**9)))
+    assert isinstance(outcome.get("error"), ValueError)
+    assert time.time() - start < 5
+    assert 5 not in consumed
+    assert threading.active_count() == threads_before
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("scipy")
+
+from musetalk.utils.face_detection.detection.sfd.bbox import batch_decode, batch_nms, nms
+from musetalk.utils.face_detection.detection.sfd.detect import batch_detect, batch_detect_flat
+
+
+def random_dets(rng, n):
+    xy = rng.uniform(0, 200, (n, 2))
+    wh = rng.uniform(10, 80, (n, 2))
+    return np.concatenate([xy, xy + wh, rng.uniform(0.5, 1, (n, 1))], 1)
+
+
+def test_batch_nms_matches_per_image_nms(rng):
+    groups = [random_dets(rng, int(rng.integers(0, 30))) for _ in range(5)]
+    dets = np.concatenate(groups)
+    idxs = np.concatenate([np.full(len(g), i, dtype=np.int64) for i, g in enumerate(groups)])
+    keep = batch_nms(dets, idxs, 0.3)
+    for i, g in enumerate(groups):
+        np.testing.assert_array_equal(dets[keep][idxs[keep] == i], g[nms(g, 0.3)].reshape(-1, 5))
+
+
+class FakeS3FD:
+    """Random class and regression maps shaped like the six S3FD outputs."""
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def __call__(self, imgs):
+        B, _, H, W = imgs.shape
+        olist = []
+        for i in range(6):
+            stride = 2**(i + 2)
+            FH, FW = H // stride, W // stride
+            olist.append(torch.from_numpy(self.rng.normal(0, 2, (B, 2, FH, FW)).astype(np.float32)))
+            olist.append(torch.from_numpy(self.rng.normal(0, 1, (B, 4, FH, FW)).astype(np.float32)))
+        return olist
+
+
+def baseline_batch_detect(olist):
+    """The per-anchor loop batch_detect replaced."""
+    BB = olist[0].size(0)
+    bboxlist = []
+    olist = [torch.softmax(o, dim=1) if i % 2 == 0 else o for i, o in enumerate(olist)]
+    for i in range(len(olist) // 2):
+        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
+        stride = 2**(i + 2)
+        for Iindex, hindex, windex in zip(*np.where(ocls[:, 1, :, :] > 0.05)):
+            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
+            score = ocls[:, 1, hindex, windex]
+            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
+            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
+            box = batch_decode(loc, priors, [0.1, 0.2])[:, 0]
+            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).numpy())
+    return np.array(bboxlist)
+
+
+def test_batch_detect_keeps_the_candidate_layout(rng):
+    imgs = rng.integers(0, 256, (3, 128, 160, 3)).astype(np.float32)
+    net = FakeS3FD(np.random.default_rng(0))
+    expected = baseline_batch_detect(net(torch.zeros(3, 3, 128, 160)))
+    bboxlist = batch_detect(FakeS3FD(np.random.default_rng(0)), imgs, "cpu")
+    assert bboxlist.shape == expected.shape
+    np.testing.assert_allclose(bboxlist, expected, rtol=1e-5, atol=1e-4)
+
+
+def test_batch_detect_flat_selects_per_image_detections(rng):
+    imgs = rng.integers(0, 256, (3, 128, 160, 3)).astype(np.float32)
+    candidates = batch_detect(FakeS3FD(np.random.default_rng(1)), imgs, "cpu")
+    idxs, dets = batch_detect_flat(FakeS3FD(np.random.default_rng(1)), imgs, "cpu", score_thresh=0.5)
+    for i in range(len(imgs)):
+        per_image = np.unique(candidates[:, i][candidates[:, i, 4] > 0.5], axis=0)
+        np.testing.assert_allclose(np.unique(dets[idxs == i], axis=0), per_image, rtol=1e-5, atol=1e-4)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from musetalk.utils.silence_gate import PcmBuffer, SilenceGate
+
+
+def speech_with_pauses(rng, seconds=6, sr=16000):
+    pcm = rng.normal(0, 0.2, seconds * sr).astype(np.float32)
+    for _ in range(4):
+        start = int(rng.integers(0, len(pcm) - sr))
+        pcm[start:start + int(rng.integers(sr // 10, sr))] *= 1e-4
+    return pcm
+
+
+# crossfades longer than the look-ahead context only depend on the gate state, not on older audio
+@pytest.mark.parametrize("context,crossfade_frames", [(2, 2), (0, 3), (1, 8)])
+def test_streamed_weights_match_offline(rng, context, crossfade_frames):
+    fps = 25
+    pcm = speech_with_pauses(rng)
+    num_frames = len(pcm) * fps // 16000
+    expected = SilenceGate(fps, crossfade_frames=crossfade_frames, context=context).weights(pcm, num_frames)
+
+    gate = SilenceGate(fps, crossfade_frames=crossfade_frames, context=context)
+    received = PcmBuffer(capacity=1000)
+    streamed = []
+    pos = 0
+    for idx in range(num_frames):
+        # feed audio in irregular chunks until the frame's window has arrived
+        needed = min(len(pcm), int(round((idx + 1 + gate.context) * 16000 / fps)))
+        while pos < needed:
+            n = int(rng.integers(100, 5000))
+            received.append(pcm[pos:pos + n])
+            pos += n
+        streamed.append(gate.update(received.view(), idx, received.offset))
+        received.trim(gate.window_start(idx + 1))
+        # only the unread part of the stream is kept
+        assert received.offset == gate.window_start(idx + 1)
+    np.testing.assert_array_equal(np.array(streamed, dtype=np.float32), expected)